@@ -30,36 +30,90 @@ interval: image acquisition interval (in seconds)
 
 day_night: boolean, Day / Night mode (no image download for zenithal angles > sza_max)
 sza_max: the sun zenithal angle when downloading is stopped (in degrees) 
+pyramid: boolean, store 1/2, 1/4 and 1/8 previews next to the archive images
+skip_duplicates: boolean, do not archive byte identical consecutive frames
+    (a frozen camera serving a stale image)
+backend: "files" stores one file per frame in outdir/YYYYMMDD, "containers"
+    appends the frames to one container per camera and day in outdir/packs
+index: path of the archive index database (time, camera, solar angles,
+    exposure, size and checksum of each archived frame)
+feature_dir: directory of the feature store, per-frame values are stored
+    in compressed column chunks per camera and day (see features module)
+compaction: boolean, apply the retention policy (retention.DEFAULT_POLICY)
+    to old days of the archive in a background thread
+metrics_port, metrics_address, metrics_textfile: expose latency, throughput
+    and failure metrics of the camera, scheduler and pipeline (see metrics
+    module)
+conditional, change_threshold, max_age: skip unchanged scenes (night,
+    uniform overcast), savings are reported per day
+products_dir: keogram, mosaic and time-lapse of each day, written when the
+    next day starts
+frame_port, frame_address: clients get the latest frames from
+    http://host:frame_port/<camera>/latest.jpg instead of polling the camera
+    or current.jpg
+ring_slots, ring_shape, ring_scale: latest frames decoded in shared memory,
+    readers attach with ring.frame_ring(camera name)
+geometry: fisheye geometry of the camera (zenith pixel, horizon radius,
+    image size, north), enables the sun saturation and glare metrics of
+    each frame in the archive index
+adaptive_requests, link_budget: lower resolution and quality at night, for
+    calm skies and on slow links
+profile, profile_sample: record the duration of each stage (connect,
+    transfer, decode, font, draw, save, ...) of a sample of frames
+manifest: file describing several cameras (model, ip, port, user, location,
+    text), all cameras are acquired in parallel and share the connection
+    setup, retries, metrics and processing pipeline
+mask: pixels outside the mask (obstructions, below the horizon) are set to
+    black before the text is drawn
+workers, queue_size, policy: settings of the processing pipeline. The capture
+    loop only downloads the image, masking, drawing text and archiving is
+    done by the worker processes, so slow processing does not delay the next
+    frame.
 
 
 It uses the camera module and its methods.
 
-Note: The script is written to run operationally and continuously. In order to
-provide stable image acquisition, it should be run as a regular cronjob
-, e.g. once per minute. The process id file (pid) helps to check if the process
-is still running to avoid multiple instances.
+Note: The script is written to run operationally and continuously. It runs as
+a long-running service (e.g. started by systemd), the acquisition is scheduled
+at the interval boundaries by the acquire module. SIGTERM or Ctrl-C stop the
+script gracefully: frames still in the processing queue are archived.
 
 
 TS 09/2015
 """
-import sys, os, shutil
-
-from datetime import datetime, timedelta
-import time
+import os
 
 # the camera module
 import camera
-
-HOME = os.getenv('HOME')
-
-# pid
-pidfile = HOME + os.sep + '.cam_roof_g.pid'
-
-# camera configuration
+import pipeline
+import archive
+import container
+import fingerprint
+import features
+import retention
+import acquire
+import adaptive
+import trigger
+import ring
+import frameserver
+import products
+import sunglare
+import fleet
+import metrics
+import tracing
+
+# camera configuration (model: "vivotek" or "mobotix", see camera.register)
+camera_model = "vivotek"
 camera_ip = '192.168.135.3'
 camera_port = 443
 camera_user = None
 camera_pass = None
+camera_retries = 1
+
+# fleet manifest (JSON/YAML) describing several cameras of the site, None to
+# use the single camera above, see fleet module. Without an outdir in the
+# manifest, the images of each camera are stored in outdir/<camera name>
+manifest = None
 
 # location
 latitude = 53.13
@@ -78,66 +132,289 @@ outdir = "your-output-directory"
 # text to be drawn in image corner
 textstring = "My Location"
 
+# archive index (SQLite database), None to disable
+index = outdir + os.sep + "archive.db"
+
+# frozen camera detection: byte identical consecutive frames are not archived
+# if skip_duplicates is True, otherwise they are flagged in the archive index
+skip_duplicates = True
+
+# archive backend: "files" (one file per frame) or "containers" (one packed
+# container per camera and day, see container module)
+backend = "files"
+
+# store of per-frame features (solar angles, exposure, size), None to disable
+feature_dir = outdir + os.sep + "features"
+
+# retention: old days are downscaled and thinned in a background thread
+# with limited I/O bandwidth (bytes/s), see retention module
+compaction = True
+compaction_bandwidth = 5e6
+
+# metrics in Prometheus text format: HTTP port (None to disable, e.g. 9110)
+# and address ("" for all interfaces) and/or file for the node exporter
+# textfile collector
+metrics_port = None
+metrics_address = "127.0.0.1"
+metrics_textfile = None
+
+# profiling: file for per-stage timings (None to disable) and fraction of
+# frames to record, summary with "python src/tracing.py <file>"
+profile = None
+profile_sample = 0.1
+
+# adaptive requests: resolution and JPEG quality are chosen per frame from
+# solar zenith, sky variability and the measured link bandwidth, of which at
+# most link_budget is used (see adaptive module)
+adaptive_requests = False
+link_budget = 0.5
+
+# conditional capture: a low resolution probe is compared with the last
+# stored frame, the full frame is only captured if the scene changed or the
+# last stored frame is older than max_age seconds (see trigger module)
+conditional = False
+change_threshold = 6
+max_age = 600
+
+# shared memory ring of the latest decoded frames per camera for local
+# consumers (see ring module): number of frames (0 to disable), maximum frame
+# shape (height, width, channels) and downscale factor
+ring_slots = 0
+ring_shape = (1536, 1536, 3)
+ring_scale = 1
+
+# HTTP port serving the latest frame of each camera from memory to local
+# clients (ETag, pyramid levels, long-poll and server-sent events), None to
+# disable, see frameserver module. Address to bind, "" for all interfaces
+frame_port = None
+frame_address = "127.0.0.1"
+
+# daily products (keogram, mosaic, time-lapse) built incrementally from 1/8
+# scaled frames in a background thread, None to disable, see products module.
+# The size of the products is fixed by the full resolution (width, height) of
+# the camera frames
+products_dir = None
+frame_size = (1536, 1536)
+
+# fisheye geometry for the sun saturation and glare metrics written to the
+# index (see sunglare module), e.g. {'center': (768, 768), 'radius': 740,
+# 'size': (1536, 1536), 'north': 0.}, None to disable
+geometry = None
+
+# camera mask: image file (non-zero pixels are kept) or fisheye geometry
+# (dictionary as above, pixels above the horizon are kept), None to disable
+mask = None
+
+# build preview pyramid (1/2, 1/4, 1/8) next to each archive image
+pyramid = True
+
+# processing: number of worker processes (None = number of CPUs), size of
+# the frame queue and back-pressure policy ("block", "drop-oldest", "spill")
+workers = None
+queue_size = 16
+policy = "drop-oldest"
 
-if __name__ == "__main__":
 
+if __name__ == "__main__":
 
-    # Check if another instance is still running
-    if os.path.exists(pidfile):
-        # read pid
-        with open(pidfile, 'r') as f:
-            pid = int(f.read())
-        # check if there is a process with pid running
-        if os.path.exists('/proc/%d' % pid):
-            sys.exit(0)
-        os.remove(pidfile)
 
-    pid = os.getpid()
-    with open(pidfile, 'w') as f:
-        f.write(str(pid))
+    # initialise camera connections, either the cameras of the manifest or
+    # the single camera configured above
+    if manifest:
+        site = fleet.load(manifest, outdir=outdir)
+    else:
+        site = fleet.fleet()
+        site.add(camera.create(camera_model, ip=camera_ip, port=camera_port,
+            user=camera_user, passwd=camera_pass, retries=camera_retries),
+            outdir=outdir)
 
-    # Current date and time
-    dt = datetime.utcnow()
+    def setting(cam, key, default=None):
+        # per-camera setting of the manifest, default from the script
+        return site.settings(cam.name, key, default)
 
-    # initialise camera connection
-    cam = camera.vivotek(ip=camera_ip, port=camera_port, user=camera_user, passwd=camera_pass)
-    #cam = camera.mobotix(ip=camera_ip, port=camera_port, user=camera_user, passwd=camera_pass)
+    # read the current settings (one request per camera), only settings
+    # differing from them are sent
+    site.read_state(ttl=0)
 
     # set exposure level to -0.0
-    cam.set_exposure_level(6)
-
-    while 1:
-
-        # wait until next interval
-        now = datetime.utcnow().second + datetime.utcnow().microsecond/1e6
-        wait_time = interval - now % interval
-        if wait_time < 0: continue
-        time.sleep(wait_time)
-        dt = datetime.utcnow()
+    level = 6
+    site.map(lambda cam: cam.set_exposure_level(level))
+
+    # profiler hook, added before the worker processes are started
+    if profile: tracing.profiler(profile, sample=profile_sample).start()
+
+    # features of processed frames are stored in the main process, the
+    # probe of an archived frame becomes the reference of its change trigger
+    store = features.feature_store(feature_dir) if feature_dir else None
+    triggers = {}
+    def processed(frame):
+        if not isinstance(frame, dict): return
+        if frame['camera'] in triggers:
+            triggers[frame['camera']].accept(frame['dt'])
+        if store and 'features' in frame:
+            store.append_record(frame['camera'], frame['dt'], frame['features'])
+
+    # rings are created before the worker processes write into them
+    rings = [ring.frame_ring(cam.name, shape=ring_shape, slots=ring_slots,
+        create=True) for cam in site] if ring_slots else []
+
+    # processing steps run in worker processes, shared by all cameras
+    steps = [ring.ring_step] if rings else []
+    if mask or any(setting(cam, 'mask') for cam in site):
+        steps.append(pipeline.mask)
+    if backend == "containers":
+        steps += [pipeline.annotate, container.pack_step]
+    else:
+        steps += [pipeline.annotate, pipeline.archive]
+        if pyramid: steps.append(pipeline.previews)
+    if index and (geometry or any(setting(cam, 'geometry') for cam in site)):
+        steps.append(sunglare.glare_step)
+    if index: steps.append(archive.index_step)
+    pipe = pipeline.pipeline(steps=steps, workers=workers, maxsize=queue_size,
+        policy=policy, spill_dir=outdir + os.sep + 'spill',
+        config={'outdir': outdir, 'textstring': textstring, 'index': index,
+            'containers': outdir + os.sep + 'packs', 'ring_scale': ring_scale,
+            'latitude': latitude, 'longitude': longitude,
+            'geometry': geometry, 'mask': mask},
+        callback=processed).start()
+
+    # per-camera settings of the processing steps
+    frame_config = {}
+    for cam in site:
+        frame_config[cam.name] = {'outdir': setting(cam, 'outdir'),
+            'textstring': setting(cam, 'textstring', textstring),
+            'latitude': setting(cam, 'latitude', latitude),
+            'longitude': setting(cam, 'longitude', longitude),
+            'geometry': setting(cam, 'geometry', geometry),
+            'mask': setting(cam, 'mask', mask)}
+
+    detectors = dict((cam.name, fingerprint.frozen_detector()) for cam in site)
+    policies = dict((cam.name, adaptive.request_policy(interval,
+        budget=link_budget)) for cam in site) if adaptive_requests else {}
+    if conditional:
+        triggers.update((cam.name, trigger.change_trigger(change_threshold,
+            max_age=max_age)) for cam in site)
+
+    # background compaction of old archive days
+    compactors = []
+    if compaction and backend == "files":
+        for cam in site:
+            compactors.append(retention.compactor(setting(cam, 'outdir'),
+                index=index, camera=cam.name,
+                lat=setting(cam, 'latitude', latitude),
+                lon=setting(cam, 'longitude', longitude),
+                bandwidth=compaction_bandwidth / len(site),
+                base_interval=interval).start())
+
+    # metrics of the components are collected when the metrics are exposed
+    reg = metrics.REGISTRY
+    reg.add_collector("pipeline", pipe.stats, help="Processing pipeline")
+    for name, detector in detectors.items():
+        reg.add_collector("frozen", detector.stats,
+            help="Frozen frame detection", camera=name)
+    for name, trig in triggers.items():
+        reg.add_collector("trigger", trig.stats, help="Conditional capture",
+            camera=name)
+    for name, link in policies.items():
+        reg.add_collector("link", link.stats, help="Camera link usage",
+            camera=name)
+    for compactor in compactors:
+        reg.add_collector("retention", compactor.stats, help="Compaction",
+            outdir=compactor.outdir)
+    if metrics_port: reg.serve(metrics_port, metrics_address)
+
+    # daily products per camera
+    builders = dict((cam.name, products.product_thread(
+        products.product_builder(products_dir, interval=interval,
+        prefix=cam.name + "_", size=frame_size,
+        geometry=setting(cam, 'geometry', geometry)))) for cam in site) \
+        if products_dir else {}
+    for name, builder in builders.items():
+        reg.add_collector("products", builder.stats, help="Daily products",
+            camera=name)
+
+    # latest frames for local clients
+    frames = frameserver.latest_frames() if frame_port else None
+    if frames:
+        frames.serve(frame_port, frame_address)
+        reg.add_collector("frameserver", frames.stats, help="Latest frames")
+
+    def capture(dt):
+        # all cameras at once in the thread pool of the fleet
+        results = site.map(lambda cam: capture_camera(cam, dt))
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                print('Acquisition of ', name, ' at ', dt, ' failed -> ',
+                    repr(result))
+
+        if metrics_textfile: reg.write_textfile(metrics_textfile)
+
+    def capture_camera(cam, dt):
+        with tracing.frame(cam.name, dt):
+            acquire_frame(cam, dt)
+
+    def acquire_frame(cam, dt):
 
         # Day/Night mode
-        solar_data = camera.solar_data([dt], latitude, longitude)
-        if day_night and solar_data['zenith'][0] > sza_max: continue
-
-        # current temporary file
-        fname = outdir + os.sep + 'current.jpg'
-
-        # download image
-        img = cam.download_image_to_file(filename=fname)
-
-        # archive directory
-        dname = outdir + os.sep + dt.strftime("%Y%m%d")
-        if not os.path.exists(dname): os.makedirs(dname)
-
-        # draw text (date+time and location)
-        img, draw = cam.addText(fname, dt=dt, loc=textstring)
-        img.save(fname)
-
-        # archive filename
-        archiv = dt.strftime("%Y%m%d_%H%M%S.jpg")
-
-        # save/archive image
-        shutil.copy(fname, dname + os.sep + archiv)
-
-
-    os.remove(pidfile)
+        config = frame_config[cam.name]
+        solar_data = camera.solar_data([dt], config['latitude'],
+            config['longitude'])
+        if day_night and solar_data['zenith'][0] > sza_max: return
+
+        # conditional capture: probe frame first
+        trig = triggers.get(cam.name)
+        if trig:
+            probe, probe_info = cam.capture(resolution=trig.resolution,
+                quality=trig.quality)
+            if not trig.check(probe, dt)['capture']:
+                trig.record(dt, probe)
+                return
+
+        # download image, processing is done by the pipeline. The time of
+        # exposure is estimated from the request timing (the slot dt names
+        # the archive file)
+        link = policies.get(cam.name)
+        req = link.choose(solar_data['zenith'][0]) if link else \
+            {'level': 0, 'resolution': None, 'quality': None}
+        data, info = cam.capture(resolution=req['resolution'],
+            quality=req['quality'])
+
+        # frozen camera / duplicate detection
+        with tracing.span("fingerprint"):
+            fp = detectors[cam.name].check(data)
+        if link: link.record(req['level'], data, info, fp['distance'])
+        if trig: trig.record(dt, probe, data)
+        if builders: builders[cam.name].add(dt, data)
+        if frames:
+            frames.publish(cam.name, data, dt=dt,
+                capture_time=info['capture_time'],
+                zenith=solar_data['zenith'][0],
+                azimuth=solar_data['azimuth'][0], exposure_level=level)
+        if skip_duplicates and fp['duplicate'] == fingerprint.DUPLICATE: return
+
+        # the probe becomes the reference of the change trigger when the
+        # frame is archived (see processed)
+        pipe.submit(data, dt=dt, camera=cam.name, config=config,
+            capture_time=info['capture_time'],
+            capture_uncertainty=info['capture_uncertainty'],
+            exposure={'exposure_level': level},
+            index={'phash': fp['phash'], 'duplicate': fp['duplicate'],
+                'clock_offset': info['clock_offset']},
+            features={'zenith': solar_data['zenith'][0],
+                'azimuth': solar_data['azimuth'][0],
+                'eccentricity': solar_data['eccentricity'][0],
+                'exposure_level': level, 'size': len(data),
+                'duplicate': fp['duplicate'],
+                'capture_delay': (info['capture_time'] - dt).total_seconds(),
+                'capture_uncertainty': info['capture_uncertainty'],
+                'request_level': req['level']})
+
+    # acquisition at every interval boundary until SIGTERM/SIGINT
+    srv = acquire.service(interval, capture)
+    for compactor in compactors: srv.add_stop_callback(compactor.stop)
+    srv.add_stop_callback(pipe.close)
+    srv.add_stop_callback(site.close)
+    for rb in rings: srv.add_stop_callback(rb.close)
+    for builder in builders.values(): srv.add_stop_callback(builder.close)
+    if store: srv.add_stop_callback(store.close)
+    srv.run()
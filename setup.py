@@ -34,5 +34,9 @@ setup(
     keywords='skyimager clouds camera photovoltaic forecast',
     packages=[''],
     package_dir={'':'src'},
-    install_requires=['Pillow']
+    install_requires=['Pillow', 'numpy'],
+    extras_require={'yaml': ['PyYAML']},
+    entry_points={
+        'console_scripts': ['skycam = cli:main'],
+    },
     )
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module runs the image acquisition as a long-running service.
+
+Instead of restarting a script by cron every minute (with a pidfile to avoid
+multiple instances), the acquisition service runs permanently:
+
+    - the camera objects are created once and kept for the whole runtime
+    - a scheduler wakes up at the wall-clock interval boundaries (e.g. every
+      full 10 seconds). The waiting time is computed from a single reading
+      of the wall clock and measured with the monotonic clock, so the
+      schedule neither drifts nor is disturbed by clock adjustments during
+      the wait. Slots which could not be served in time are detected,
+      counted and logged, nothing is busy-waiting.
+    - SIGTERM and SIGINT stop the service gracefully after the current slot,
+      the stop callbacks (e.g. closing the processing pipeline) are run.
+
+Example::
+
+    cam = camera.vivotek(ip=..., port=...)
+    def capture(dt):
+        data = cam.download_image()
+        ...
+    service(interval=10, task=capture).run()
+
+
+Package requirements:
+    none (python standard library)
+"""
+
+import math
+import time
+import signal
+import threading
+from datetime import datetime
+
+import metrics
+
+
+
+class scheduler():
+    """
+    Drift-free scheduler of wall-clock aligned slots
+
+    :param interval: float, interval in seconds
+    :param offset: float, optional, offset of the slots to the interval
+        boundaries in seconds
+    :param stopped: threading.Event, optional, event to interrupt waiting
+    """
+
+    def __init__(self, interval, offset=0., stopped=None):
+        self.interval = float(interval)
+        self.offset = offset
+        self.stopped = stopped if stopped else threading.Event()
+        self.last = None
+
+        # statistics
+        self.slots = 0
+        self.missed = 0
+        self.lag = 0.
+
+
+
+    def next_slot(self, now=None):
+        """
+        Returns the next slot (unix time) after now
+
+        :param now: float, optional, unix time, default time.time()
+        """
+        if now is None: now = time.time()
+        n = math.floor((now - self.offset) / self.interval) + 1
+
+        return n * self.interval + self.offset
+
+
+
+    def wait(self):
+        """
+        Waits for the next slot
+
+        :returns: datetime of the slot (UTC) or None if the scheduler was
+            stopped while waiting
+        """
+        wall = time.time()
+        mono = time.monotonic()
+        slot = self.next_slot(wall)
+        if self.last is not None and slot <= self.last:
+            # woke up a bit before the boundary of the last slot
+            slot = self.last + self.interval
+
+        # slots between the last served one and this one were missed
+        if self.last is not None:
+            missed = int(round((slot - self.last) / self.interval)) - 1
+            if missed > 0:
+                self.missed += missed
+                metrics.REGISTRY.inc("acquire_missed_slots_total", missed,
+                    help="Acquisition slots missed")
+                print('Missed ', missed, ' slot(s) before ',
+                    datetime.utcfromtimestamp(slot), ' (last served ',
+                    datetime.utcfromtimestamp(self.last), ')')
+
+        # wait on the monotonic clock
+        deadline = mono + (slot - wall)
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: break
+            if self.stopped.wait(remaining): return None
+
+        self.lag = time.time() - slot
+        self.last = slot
+        self.slots += 1
+        metrics.REGISTRY.inc("acquire_slots_total", help="Acquisition slots served")
+        metrics.REGISTRY.observe("acquire_schedule_lag_seconds", self.lag,
+            help="Delay of wake-up after the slot boundary")
+
+        return datetime.utcfromtimestamp(slot)
+
+
+
+    def __iter__(self):
+        while not self.stopped.is_set():
+            dt = self.wait()
+            if dt is None: break
+            yield dt
+
+
+
+    def stats(self):
+        """
+        Returns the counters of the scheduler
+
+        :returns: dictionary with 'slots' (served), 'missed' and 'lag'
+            (seconds between the last slot and the wake-up)
+        """
+        return {'slots': self.slots, 'missed': self.missed, 'lag': self.lag}
+
+
+
+
+
+class service():
+    """
+    Acquisition service calling a task at every slot
+
+    :param interval: float, acquisition interval in seconds
+    :param task: function, called with the datetime (UTC) of each slot
+    :param offset: float, optional, offset of the slots in seconds
+    :param signals: boolean, optional, install handlers for SIGTERM/SIGINT
+        (only possible in the main thread)
+    """
+
+    def __init__(self, interval, task, offset=0., signals=True):
+        self.task = task
+        self.stopped = threading.Event()
+        self.scheduler = scheduler(interval, offset, self.stopped)
+        self.signals = signals
+        self.on_stop = []
+        self.errors = 0
+
+
+
+    def add_stop_callback(self, callback):
+        """ Registers a function called when the service stops """
+        self.on_stop.append(callback)
+
+
+
+    def stop(self, *args):
+        """ Stops the service after the current slot (also signal handler) """
+        self.stopped.set()
+
+
+
+    def run(self):
+        """ Runs the service until it is stopped """
+        if self.signals:
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+
+        try:
+            for dt in self.scheduler:
+                try:
+                    self.task(dt)
+                except Exception as e:
+                    # a failing capture must not end the service
+                    self.errors += 1
+                    metrics.REGISTRY.inc("acquire_errors_total",
+                        help="Failed acquisition tasks")
+                    print('Acquisition at ', dt, ' failed -> ', repr(e))
+        finally:
+            for callback in self.on_stop: callback()
+
+
+
+    def stats(self):
+        """ Returns the counters of the scheduler and the number of errors """
+        stats = self.scheduler.stats()
+        stats['errors'] = self.errors
+
+        return stats
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module chooses resolution and JPEG quality of each image request.
+
+At remote sites with cellular links, downloading every frame in full
+resolution and default quality saturates the link, although night frames
+and calm skies need far less. The request policy chooses one of a list of
+levels (resolution, quality) per frame from
+
+    - the solar zenith angle: at night (zenith > night_zenith) the lowest
+      level is used
+    - the sky variability: the mean perceptual hash distance of consecutive
+      frames (see fingerprint module); variable skies get the best level,
+      calm skies the second
+    - the link bandwidth measured from the recent downloads (first byte to
+      completion, without the response latency of the camera): the expected
+      bytes of a level (mean of its recent frames) per acquisition interval
+      must stay below budget * bandwidth, otherwise lower levels are chosen
+
+The resolution and quality values are passed to the image url of the camera
+(see camera.driver.image_request), their meaning depends on the model.
+
+Example::
+
+    policy = request_policy(interval=10)
+    req = policy.choose(zenith)
+    data, info = cam.capture(resolution=req['resolution'],
+        quality=req['quality'])
+    policy.record(req['level'], data, info, distance=fp['distance'])
+
+The statistics (stats) report bytes per frame, measured bandwidth and link
+utilization.
+
+
+Package requirements:
+    none (python standard library)
+"""
+
+import collections
+
+
+# Default levels (resolution, quality) from best to lowest. None requests
+# the default of the camera.
+LEVELS = [
+    (None, None),
+    (None, 3),
+    ("1024x1024", 3),
+    ("512x512", 2),
+]
+
+
+
+class request_policy():
+    """
+    Chooses the request options of each frame
+
+    :param interval: float, acquisition interval in seconds
+    :param levels: list, optional, (resolution, quality) from best to lowest
+    :param night_zenith: float, optional, solar zenith angle (degrees) above
+        which the lowest level is used
+    :param variable: float, optional, mean hash distance (bits) above which
+        the sky is variable and the best level is used
+    :param budget: float, optional, maximum fraction of the measured
+        bandwidth used by the acquisition
+    :param window: int, optional, number of recent downloads for bandwidth,
+        frame sizes and variability
+    """
+
+    def __init__(self, interval, levels=LEVELS, night_zenith=96., variable=4.,
+            budget=0.5, window=30):
+        self.interval = float(interval)
+        self.levels = list(levels)
+        self.night_zenith = night_zenith
+        self.variable = variable
+        self.budget = budget
+
+        self.downloads = collections.deque(maxlen=window)
+        self.distances = collections.deque(maxlen=window)
+        self.sizes = [collections.deque(maxlen=window) for l in self.levels]
+        self.counts = [0] * len(self.levels)
+        self.frames = 0
+        self.bytes = 0
+
+
+
+    def bandwidth(self):
+        """ Returns the measured bandwidth in bytes/s (None without data) """
+        seconds = sum(d[1] for d in self.downloads)
+        if seconds <= 0: return None
+
+        return sum(d[0] for d in self.downloads) / seconds
+
+
+
+    def variability(self):
+        """ Returns the mean hash distance of recent frames (None without) """
+        if not self.distances: return None
+
+        return sum(self.distances) / float(len(self.distances))
+
+
+
+    def expected_size(self, level):
+        """
+        Returns the expected bytes of a frame of a level, estimated from the
+        next better level with measurements if the level was not used yet
+        """
+        for i in range(level, -1, -1):
+            if self.sizes[i]:
+                size = sum(self.sizes[i]) / float(len(self.sizes[i]))
+                # unknown lower level: assume half of the better one
+                return size / 2 ** (level - i)
+
+        return None
+
+
+
+    def choose(self, zenith=None):
+        """
+        Chooses the request options of the next frame
+
+        :param zenith: float, optional, solar zenith angle in degrees
+
+        :returns: dictionary with 'level' (index), 'resolution' and 'quality'
+        """
+        lowest = len(self.levels) - 1
+        if zenith is not None and zenith > self.night_zenith:
+            level = lowest
+        else:
+            var = self.variability()
+            level = 0 if var is None or var >= self.variable else min(1, lowest)
+
+            # stay within the bandwidth budget
+            bw = self.bandwidth()
+            if bw is not None:
+                while level < lowest:
+                    size = self.expected_size(level)
+                    if size is None or size / self.interval <= self.budget * bw:
+                        break
+                    level += 1
+
+        resolution, quality = self.levels[level]
+
+        return {'level': level, 'resolution': resolution, 'quality': quality}
+
+
+
+    def record(self, level, data, info=None, distance=None):
+        """
+        Records a download
+
+        :param level: int, level of the request (see choose)
+        :param data: bytes, the downloaded image (or its size)
+        :param info: dictionary, optional, timing of camera.driver.capture
+            ('first_byte' and 'complete'), used for the bandwidth; the
+            transfer is measured from the first byte, so the response
+            latency of the camera does not count
+        :param distance: int, optional, hash distance to the previous frame
+        """
+        size = data if isinstance(data, int) else len(data)
+        self.sizes[level].append(size)
+        self.counts[level] += 1
+        self.frames += 1
+        self.bytes += size
+        if info is not None and info.get('complete') is not None and \
+                info.get('first_byte') is not None:
+            seconds = info['complete'] - info['first_byte']
+            if seconds > 0: self.downloads.append((size, seconds))
+        if distance is not None: self.distances.append(distance)
+
+
+
+    def stats(self):
+        """
+        Returns the statistics of the link
+
+        :returns: dictionary with 'frames', 'bytes' (total), 'bytes_per_frame'
+            (recent mean), 'bandwidth' (bytes/s), 'utilization' (fraction of
+            the bandwidth used at the acquisition interval), 'variability'
+            and 'level_<n>' (number of frames per level)
+        """
+        recent = [s for sizes in self.sizes for s in sizes]
+        last = [d[0] for d in self.downloads]
+        per_frame = sum(last) / float(len(last)) if last else \
+            (sum(recent) / float(len(recent)) if recent else 0.)
+        bw = self.bandwidth()
+        stats = {
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'bytes_per_frame': per_frame,
+            'bandwidth': bw if bw else 0.,
+            'utilization': per_frame / self.interval / bw if bw else 0.,
+            'variability': self.variability() or 0.,
+        }
+        for i, n in enumerate(self.counts): stats['level_%d' % i] = n
+
+        return stats
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module provides an index of the image archive.
+
+The archive itself is organised as one directory per day containing one file
+per frame (outdir/YYYYMMDD/YYYYMMDD_HHMMSS.jpg). Selecting frames by time,
+camera or sun position from the directory tree means listing directories and
+parsing file names. Instead, the archiving step writes one record per frame
+into an SQLite database, which answers range and predicate queries from an
+index in milliseconds, also over years of data.
+
+Each record contains
+    - time (UTC, stored as unix timestamp) and camera id
+    - path of the image
+    - solar zenith and azimuth angle (see camera.solar_data)
+    - exposure settings (level, minimum and maximum exposure time)
+    - file size and SHA-1 checksum of the image
+    - perceptual hash and duplicate flag (see fingerprint module)
+    - estimated time of exposure with uncertainty and the offset of the
+      camera clock (see camera.driver.capture)
+
+It consists of
+    - the index database (archive_index)
+    - a pipeline step writing archived frames to the index (index_step)
+    - functions to parse and scan the directory layout (parse_filename,
+      scan_directory), used to build an index of an existing archive
+
+
+Package requirements:
+    sqlite3 (python standard library), numpy
+"""
+
+import os
+import re
+import hashlib
+import sqlite3
+import calendar
+from datetime import datetime
+
+
+# Columns of the frame table, (name, SQL type)
+COLUMNS = [
+    ("time", "REAL NOT NULL"),
+    ("camera", "TEXT NOT NULL"),
+    ("path", "TEXT NOT NULL UNIQUE"),
+    ("zenith", "REAL"),
+    ("azimuth", "REAL"),
+    ("exposure_level", "INTEGER"),
+    ("maxexposure", "INTEGER"),
+    ("minexposure", "INTEGER"),
+    ("size", "INTEGER"),
+    ("checksum", "TEXT"),
+    ("phash", "TEXT"),
+    ("duplicate", "INTEGER"),
+    ("capture_time", "REAL"),
+    ("capture_uncertainty", "REAL"),
+    ("clock_offset", "REAL"),
+    ("sun_saturated_area", "REAL"),
+    ("sun_bloom_radius", "REAL"),
+    ("circumsolar_brightness", "REAL"),
+    ("sun_profile", "TEXT"),
+    ("glare_flag", "INTEGER"),
+]
+
+# File names of archive images: YYYYMMDD_HHMMSS.jpg
+FILENAME = re.compile(r"^(\d{8}_\d{6})\.jpg$")
+
+
+
+def to_timestamp(dt):
+    """ Converts a naive UTC datetime to a unix timestamp """
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+
+def from_timestamp(ts):
+    """ Converts a unix timestamp to a naive UTC datetime """
+    return datetime.utcfromtimestamp(ts)
+
+
+
+def checksum(data):
+    """
+    Returns the SHA-1 checksum of image data
+
+    :param data: bytes
+
+    :returns: string, hex digest
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+
+def parse_filename(filename):
+    """
+    Returns the acquisition time encoded in an archive file name
+
+    :param filename: string, path or basename YYYYMMDD_HHMMSS.jpg
+
+    :returns: datetime or None if the name does not match (e.g. previews)
+    """
+    m = FILENAME.match(os.path.basename(filename))
+    if not m: return None
+
+    return datetime.strptime(m.group(1), "%Y%m%d_%H%M%S")
+
+
+
+def scan_directory(outdir, start=None, end=None):
+    """
+    Generator over the archive images of the directory layout
+    outdir/YYYYMMDD/YYYYMMDD_HHMMSS.jpg in chronological order.
+
+    :param outdir: string, archive directory
+    :param start: datetime, optional, first time (inclusive)
+    :param end: datetime, optional, last time (exclusive)
+
+    :yields: (datetime, path)
+    """
+    days = sorted(d for d in os.listdir(outdir) \
+        if len(d) == 8 and d.isdigit())
+    for day in days:
+        if start and day < start.strftime("%Y%m%d"): continue
+        if end and day > end.strftime("%Y%m%d"): break
+        dname = outdir + os.sep + day
+        for fname in sorted(os.listdir(dname)):
+            dt = parse_filename(fname)
+            if dt is None: continue
+            if start and dt < start: continue
+            if end and dt >= end: continue
+            yield dt, dname + os.sep + fname
+
+
+
+
+
+class archive_index():
+    """
+    SQLite index of archived frames.
+
+    The database is opened in WAL mode, so several worker processes can add
+    frames while queries are running. Every process has to open its own
+    archive_index object.
+
+    :param filename: string, path of the database file
+    :param timeout: float, optional, seconds to wait for a locked database
+    """
+
+    def __init__(self, filename, timeout=30):
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=timeout)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self._create()
+
+
+
+    def _create(self):
+        """ Creates the table and indices, adds columns missing in old files """
+        cols = ", ".join(name + " " + typ for name, typ in COLUMNS)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS frames (" \
+                "id INTEGER PRIMARY KEY, " + cols + ")")
+            existing = [row[1] for row in \
+                self.db.execute("PRAGMA table_info(frames)")]
+            for name, typ in COLUMNS:
+                if name not in existing:
+                    typ = typ.replace("NOT NULL", "").replace("UNIQUE", "")
+                    self.db.execute("ALTER TABLE frames ADD COLUMN " + name \
+                        + " " + typ)
+            self.db.execute("CREATE INDEX IF NOT EXISTS frames_camera_time " \
+                "ON frames (camera, time)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS frames_time " \
+                "ON frames (time)")
+
+
+
+    def add(self, dt, camera, path, **kwargs):
+        """
+        Adds (or replaces) the record of one frame
+
+        :param dt: datetime, acquisition time (UTC)
+        :param camera: string, camera id
+        :param path: string, path of the image
+        :param kwargs: further columns, e.g. zenith, azimuth, exposure_level,
+            maxexposure, minexposure, size, checksum
+        """
+        self.add_many([dict(kwargs, time=dt, camera=camera, path=path)])
+
+
+
+    def add_many(self, records):
+        """
+        Adds (or replaces) many records in one transaction
+
+        :param records: list of dictionaries with the keys time (datetime),
+            camera, path and optional further columns
+        """
+        names = [name for name, typ in COLUMNS]
+        sql = "INSERT OR REPLACE INTO frames (" + ", ".join(names) + \
+            ") VALUES (" + ", ".join("?" * len(names)) + ")"
+        rows = []
+        for rec in records:
+            rec = dict(rec)
+            rec['time'] = to_timestamp(rec['time'])
+            unknown = set(rec) - set(names)
+            if unknown: raise ValueError("Unknown index columns %s" % unknown)
+            rows.append([rec.get(name) for name in names])
+        with self.db:
+            self.db.executemany(sql, rows)
+
+
+
+    def update_many(self, records):
+        """
+        Sets columns of existing records in one transaction, e.g. metrics
+        computed later (see sunglare.analyze)
+
+        :param records: list of dictionaries with the key path and the
+            columns to set
+        """
+        names = [name for name, typ in COLUMNS]
+        with self.db:
+            for rec in records:
+                rec = dict(rec)
+                path = rec.pop('path')
+                unknown = set(rec) - set(names)
+                if unknown:
+                    raise ValueError("Unknown index columns %s" % unknown)
+                if not rec: continue
+                self.db.execute("UPDATE frames SET " + ", ".join(k + " = ?" \
+                    for k in rec) + " WHERE path = ?", list(rec.values()) + \
+                    [path])
+
+
+
+    def add_file(self, path, dt=None, camera="", lat=None, lon=None,
+            **kwargs):
+        """
+        Adds an image file, size and checksum are computed from the file, the
+        solar angles are computed if latitude and longitude are given
+
+        :param path: string, path of the image
+        :param dt: datetime, optional, acquisition time, default from file name
+        :param camera: string, optional, camera id
+        :param lat: float, optional, latitude of camera (degrees)
+        :param lon: float, optional, longitude of camera (degrees)
+        :param kwargs: further columns
+        """
+        if dt is None: dt = parse_filename(path)
+        if 'size' not in kwargs or 'checksum' not in kwargs:
+            with open(path, "rb") as f:
+                data = f.read()
+            kwargs.setdefault('size', len(data))
+            kwargs.setdefault('checksum', checksum(data))
+        if lat is not None and lon is not None and 'zenith' not in kwargs:
+            import camera as cam
+            sd = cam.solar_data([dt], lat, lon)
+            kwargs['zenith'] = float(sd['zenith'][0])
+            kwargs['azimuth'] = float(sd['azimuth'][0])
+
+        self.add(dt, camera, path, **kwargs)
+
+
+
+    def build(self, outdir, camera="", lat=None, lon=None):
+        """
+        Indexes an existing archive directory (outdir/YYYYMMDD/*.jpg)
+
+        :param outdir: string, archive directory
+        :param camera: string, optional, camera id of all images
+        :param lat: float, optional, latitude of camera (degrees)
+        :param lon: float, optional, longitude of camera (degrees)
+
+        :returns: int, number of indexed frames
+        """
+        frames = list(scan_directory(outdir))
+        if not frames: return 0
+
+        records = []
+        for dt, path in frames:
+            with open(path, "rb") as f:
+                data = f.read()
+            records.append({'time': dt, 'camera': camera, 'path': path,
+                'size': len(data), 'checksum': checksum(data)})
+
+        if lat is not None and lon is not None:
+            import camera as cam
+            sd = cam.solar_data([dt for dt, path in frames], lat, lon)
+            for rec, zen, azi in zip(records, sd['zenith'], sd['azimuth']):
+                rec['zenith'] = float(zen)
+                rec['azimuth'] = float(azi)
+
+        self.add_many(records)
+
+        return len(records)
+
+
+
+    def _where(self, camera=None, start=None, end=None, where=None,
+            **predicates):
+        """ Builds the WHERE clause of a query """
+        clauses, params = [], []
+        if camera is not None:
+            if isinstance(camera, str): camera = [camera]
+            clauses.append("camera IN (" + ",".join("?" * len(camera)) + ")")
+            params.extend(camera)
+        if start is not None:
+            clauses.append("time >= ?")
+            params.append(to_timestamp(start))
+        if end is not None:
+            clauses.append("time < ?")
+            params.append(to_timestamp(end))
+
+        names = [name for name, typ in COLUMNS]
+        for key, value in predicates.items():
+            if value is None: continue
+            op = key[:4]
+            col = key[4:]
+            if op not in ("min_", "max_") or col not in names:
+                raise ValueError("Unknown predicate %s, use min_<column> or " \
+                    "max_<column>" % key)
+            clauses.append(col + (" >= ?" if op == "min_" else " <= ?"))
+            params.append(value)
+
+        if where:
+            clauses.append("(" + where[0] + ")")
+            params.extend(where[1:])
+
+        sql = " WHERE " + " AND ".join(clauses) if clauses else ""
+
+        return sql, params
+
+
+
+    def query(self, camera=None, start=None, end=None, where=None,
+            **predicates):
+        """
+        Returns the records of all frames matching the conditions, ordered by
+        time
+
+        Parameters
+        -----------
+        :param camera: string or list of strings, optional, camera id(s)
+        :param start: datetime, optional, first time (inclusive)
+        :param end: datetime, optional, last time (exclusive)
+        :param where: tuple, optional, additional SQL condition and its
+            parameters, e.g. ("size > ?", 100000)
+        :param predicates: range conditions on columns as min_<column> or
+            max_<column>, e.g. max_zenith=80
+
+        :returns: list of dictionaries, time is converted to datetime
+
+        Example: all frames of camera "roof" with zenith < 80 in 2016::
+
+            idx.query("roof", datetime(2016,1,1), datetime(2017,1,1),
+                max_zenith=80)
+        """
+        sql, params = self._where(camera, start, end, where, **predicates)
+        rows = self.db.execute("SELECT * FROM frames" + sql + \
+            " ORDER BY time", params)
+        records = []
+        for row in rows:
+            rec = dict(row)
+            rec['time'] = from_timestamp(rec['time'])
+            records.append(rec)
+
+        return records
+
+
+
+    def paths(self, camera=None, start=None, end=None, where=None,
+            **predicates):
+        """
+        Returns the paths of all frames matching the conditions, ordered by
+        time. For the parameters see query.
+
+        :returns: list of strings
+        """
+        sql, params = self._where(camera, start, end, where, **predicates)
+        rows = self.db.execute("SELECT path FROM frames" + sql + \
+            " ORDER BY time", params)
+
+        return [row[0] for row in rows]
+
+
+
+    def count(self, camera=None, start=None, end=None, where=None,
+            **predicates):
+        """ Returns the number of frames matching the conditions (see query) """
+        sql, params = self._where(camera, start, end, where, **predicates)
+
+        return self.db.execute("SELECT COUNT(*) FROM frames" + sql,
+            params).fetchone()[0]
+
+
+
+    def remove(self, path):
+        """ Removes the record of an image """
+        with self.db:
+            self.db.execute("DELETE FROM frames WHERE path = ?", (path,))
+
+
+
+    def close(self):
+        self.db.close()
+
+
+
+    def __enter__(self):
+        return self
+
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+
+
+# Index connections of the worker processes, one per database file
+_indices = {}
+
+def index_step(frame):
+    """
+    Processing step (see pipeline module): adds the archived frame to the
+    index. Has to run after the step archive.
+
+    Uses config keys 'index' (database file), 'latitude' and 'longitude'
+    (optional, for solar angles) and the frame keys 'exposure' (optional,
+    dictionary with the columns exposure_level, maxexposure, minexposure) and
+    'index' (optional, dictionary with further columns). Size and checksum
+    are computed from the archived file if not given in frame['index'].
+    The frame keys 'capture_time' and 'capture_uncertainty' (optional) are
+    stored in the columns of the same name.
+    """
+    config = frame['config']
+    fname = config['index']
+    if fname not in _indices: _indices[fname] = archive_index(fname)
+
+    columns = dict(frame.get('exposure', {}))
+    columns.update(frame.get('index', {}))
+    if frame.get('capture_time') is not None:
+        columns['capture_time'] = to_timestamp(frame['capture_time'])
+        columns['capture_uncertainty'] = frame.get('capture_uncertainty')
+
+    _indices[fname].add_file(frame['filename'], dt=frame['dt'],
+        camera=frame['camera'], lat=config.get('latitude'),
+        lon=config.get('longitude'), **columns)
+
+    return frame
@@ -13,9 +13,19 @@ It consists of methods in order to
     - draw basic text (date,time,location-string) to image (add_text)
     - calculate solar position (solar_data)
 
+The camera models share one driver class (driver) with the requests, retries,
+metrics and tracing. A model only defines the urls and the names of its
+parameters and is registered under a model name (register), Vivotek and
+Mobotix are included. Many cameras are described by a manifest file, see
+fleet module.
+
 
 Package requirements:
-    PIL, urllib
+    PIL, numpy, urllib
+
+PIL and numpy are imported on first use of the image and solar functions,
+the SSL context and url opener on the first request to the camera. Importing
+the module and changing a setting is therefore fast (see cli module).
 
 Please care about the access to the camera via command-line and set proxies
 if needed.
@@ -30,11 +40,16 @@ History:
 
 import urllib.request, urllib.error, urllib.parse
 import os
-from PIL import Image, ImageDraw, ImageFont
-from datetime import datetime
-import numpy as np
-from numpy import pi, cos, sin, radians, degrees, arcsin, arccos
+import time
+import socket
+from datetime import datetime, timedelta, timezone
+import email.utils
+import collections
 import ssl
+import threading
+
+import metrics
+import tracing
 
 __author__ = "Thomas Schmidt"
 __copyright__ = "Copyright 2015, Universität Oldenburg"
@@ -47,416 +62,580 @@ __status__ = "Production"
 
 
 
-class vivotek():
+def _request_once(cam, url, operation, timeout=None, timing=None):
     """
-    This methods are written for Vivotek FE8172V/FE8174V camera. The camera uses
-    cgi-scripts to handle some settings like exposure time, gain, etc.
-    Be careful to set only values that are accepted by the camera, otherwise
-    nothing will happen or errors occur.
+    Opens an url (string or request object) with the opener of the camera
+    and reads the response. Latency, result and received bytes are recorded per
+    camera and operation in the metrics registry (see metrics module).
+
+    :param cam: camera object
+    :param url: string or urllib.request.Request
+    :param operation: string, name of the operation, e.g. "download"
+    :param timeout: float, optional, timeout in seconds
+    :param timing: dictionary, optional, filled with the monotonic times
+        'send', 'first_byte' (response header received) and 'complete', the
+        wall clock time 'wall' at sending and the HTTP header 'date'
+
+    :returns data: bytes, the response body
     """
+    reg = metrics.REGISTRY
+    result = "error"
+    data = b""
+    start = time.perf_counter()
+    if timing is not None:
+        timing['send'] = time.monotonic()
+        timing['wall'] = time.time()
+    try:
+        # connect: TCP/TLS setup and request until the response header
+        with tracing.span("connect", camera=cam.name, operation=operation):
+            if timeout is None:
+                resource = cam.opener.open(url)
+            else:
+                resource = cam.opener.open(url, timeout=timeout)
+        if timing is not None:
+            timing['first_byte'] = time.monotonic()
+            timing['date'] = resource.headers.get("Date")
+        with tracing.span("transfer", camera=cam.name, operation=operation):
+            data = resource.read()
+        if timing is not None: timing['complete'] = time.monotonic()
+        result = "success"
+    except urllib.error.HTTPError:
+        result = "http_error"
+        raise
+    except urllib.error.URLError as e:
+        result = "timeout" if isinstance(e.reason, socket.timeout) \
+            else "url_error"
+        raise
+    except socket.timeout:
+        result = "timeout"
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        reg.observe("camera_request_seconds", elapsed,
+            help="Latency of camera requests", camera=cam.name,
+            operation=operation)
+        reg.inc("camera_requests_total", help="Camera requests by result",
+            camera=cam.name, operation=operation, result=result)
+        if data:
+            reg.inc("camera_received_bytes_total", len(data),
+                help="Bytes received from camera", camera=cam.name)
+            if operation == "download":
+                reg.observe("camera_frame_bytes", len(data),
+                    buckets=metrics.SIZE_BUCKETS, help="Size of frames",
+                    camera=cam.name)
+
+    return data
+
+
+
+def _request(cam, url, operation, timeout=None, timing=None):
+    """
+    Opens an url with the opener of the camera, see _request_once. Requests
+    failing due to a timeout or an unreachable camera are repeated
+    cam.retries times, the waiting time starts with cam.backoff seconds and
+    is doubled after each repetition. HTTP errors (e.g. wrong parameters or
+    authentication) are raised immediately.
 
+    :returns data: bytes, the response body
+    """
+    for attempt in range(cam.retries + 1):
+        try:
+            return _request_once(cam, url, operation, timeout=timeout,
+                timing=timing)
+        except urllib.error.HTTPError:
+            raise
+        except (urllib.error.URLError, socket.timeout, ConnectionError):
+            if attempt >= cam.retries: raise
+            metrics.REGISTRY.inc("camera_retries_total",
+                help="Repeated camera requests", camera=cam.name,
+                operation=operation)
+            time.sleep(cam.backoff * 2 ** attempt)
 
-    def __init__(self,ip="",port="",http=None,https=None,user="",passwd=""):
-        if port != "":
-            self.ip = ip + ':' + str(port)
-        else:
-            self.ip = ip
-        self.image_url = "https://" + self.ip + "/cgi-bin/viewer/video.jpg"
-        self.settings_url = "https://" + self.ip + "/cgi-bin/admin/setparam.cgi?"
-        self.maxexposure = 5
-        self.minexposure = 32000
-        self.level = 6
-        self.maxgain = 100
-        self.mingain = 0
-        self.redgain = 37
-        self.bluegain = 30
-        self.ssl_context = ""
-
-        # These two lines should only be used in context with Vivotek cameras
-        # due to old ssl versions
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-        ssl_context.set_ciphers('ALL')
-
-        opprox = self._proxy(http=http,https=https)
-        httpshandl = urllib.request.HTTPSHandler(context=ssl_context)
-
-        if user != "":
-            opauth = self._auth(user,passwd)
-            opener = urllib.request.build_opener(httpshandl,opauth,opprox)
-        else:
-            opener = urllib.request.build_opener(httpshandl,opprox)
 
-        self.opener = opener
 
-        urllib.request.install_opener(self.opener)
+class clock_estimator():
+    """
+    Estimates the offset of the camera clock from the HTTP Date headers.
+
+    The camera writes the header between sending the request and receiving
+    the first byte of the response, with its clock truncated to full
+    seconds. Each response therefore bounds the offset (camera - local
+    clock) to an interval [date - first_byte, date + 1 - send]. The
+    intersection of the intervals of the recent responses narrows down to
+    the network round trip time as the responses fall on different fractions
+    of a second. If the camera clock is set (intervals without intersection),
+    older responses are discarded.
+
+    :param window: int, optional, number of responses used
+    """
 
+    def __init__(self, window=64):
+        self.samples = collections.deque(maxlen=window)
 
 
 
-    def _auth(self,user,passwd):
+    def add(self, date, send, first_byte):
         """
-        Setup basic http authentification
+        Adds a response
 
-        Parameters
-        ----------
-        :params user: string, usernamer
-        :params passwd: string, password
+        :param date: string, HTTP Date header
+        :param send: float, unix time of sending the request (local clock)
+        :param first_byte: float, unix time of the response header
+        """
+        try:
+            camera = email.utils.parsedate_to_datetime(date)
+        except (TypeError, ValueError, IndexError):
+            return
+        if camera.tzinfo is None: camera = camera.replace(tzinfo=timezone.utc)
+        camera = camera.timestamp()
+        self.samples.append((camera - first_byte, camera + 1 - send))
 
-        Returns
-        -------
-        :returns handler: HTTP handler object
 
-        Notes
-        ------
 
+    def bounds(self):
         """
-        password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        password_mgr.add_password(None,'https://'+self.ip, user, passwd)
-        handler = urllib.request.HTTPBasicAuthHandler(password_mgr)
+        Returns the interval (lower, upper) of the offset in seconds or None
+        """
+        if not self.samples: return None
+        lower, upper = self.samples[-1]
+        for n, (lo, up) in enumerate(reversed(self.samples)):
+            if max(lower, lo) > min(upper, up):
+                # the camera clock was set, forget the older responses
+                for i in range(len(self.samples) - n): self.samples.popleft()
+                break
+            lower, upper = max(lower, lo), min(upper, up)
 
-        return handler
+        return lower, upper
 
 
 
+    def offset(self):
+        """
+        Returns the estimated offset and its uncertainty (half width of the
+        interval) in seconds, or (None, None) without responses
+        """
+        bounds = self.bounds()
+        if bounds is None: return None, None
 
+        return (bounds[0] + bounds[1]) / 2., (bounds[1] - bounds[0]) / 2.
 
 
 
-    def _proxy(self,http='',https=''):
-        """
-        Sets the proxy for the requests.
 
-        If http is None, the environment variable (if set)
-        is overwritten by an empty dictionary -< No proxy is used.
 
-        If http is empty (""), the default environment proxy is used
+# Registered camera models, model name -> driver class (see register)
+DRIVERS = {}
 
-        If http is an address, the specified address is used
+# SSL contexts shared by all cameras of a process (see driver.ssl_context)
+_ssl_contexts = {}
+_ssl_lock = threading.Lock()
 
-        Parameters:
-        -----------
 
-        :param http: string, optional, address of proxy
-        :param https: string, optional, address of https proxy
 
-        """
-        if http == None:
-            proxy = urllib.request.ProxyHandler({})
-        elif http == "" and https == "":
-            proxy = urllib.request.ProxyHandler({'http': os.getenv('http_proxy'), \
-                'https': os.getenv('https_proxy') })
-        else:
-            http = urllib.request.ProxyHandler({'http': http})
+def register(model):
+    """
+    Class decorator registering a camera driver under a model name, e.g.
 
-        return proxy
+        @camera.register("mymodel")
+        class mymodel(camera.driver):
+            image_path = "/snapshot.jpg"
+            params = {'exposure_level': 'exposure', ...}
 
+    The model name is used by create, the command line interface and the
+    fleet manifest (see fleet module).
+    """
+    def decorator(cls):
+        cls.model = model
+        DRIVERS[model] = cls
+        return cls
 
+    return decorator
 
 
 
+def get_driver(model):
+    """ Returns the driver class of a model name (ValueError if unknown) """
+    try:
+        return DRIVERS[model]
+    except KeyError:
+        raise ValueError("Unknown camera model '%s', registered: %s" % (model,
+            ", ".join(sorted(DRIVERS))))
 
-    def set_exposure_time(self,maxexposure=-1, minexposure=-1):
-        """
-        Sets exposure time for Vivotek network camera
 
-        Parameters
-        -----------
 
-        :param minexposure, maxexposure: int, optional
+def create(model, **kwargs):
+    """
+    Creates a camera object of a registered model
 
-              Exposure time range
-              Possible  values:
-              5, 15, 25, 50, 100, 200, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000
+    :param model: string, model name, e.g. "vivotek"
+    :param kwargs: arguments of the driver (ip, port, user, passwd, ...)
+    """
+    return get_driver(model)(**kwargs)
 
-        """
-        if maxexposure < 0: maxexposure = self.maxexposure
-        if minexposure < 0: minexposure = self.minexposure
 
-        elist = [5, 15, 25, 50, 100, 200, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000]
 
-        if not minexposure in elist or not maxexposure in elist:
-            print( 'Exposure times out of possible values: Use one of these values:', elist, ' -> Exit')
-            return False
 
-        if maxexposure > minexposure:
-            print( 'Maximum exposure time must be smaller than minimum exposure time:', \
-                maxexposure, ' > ', minexposure, ' -> Exit')
 
-        url = self.settings_url + "videoin_c0_maxexposure=" + str(maxexposure) + \
-            "&videoin_c0_minexposure=" + str(minexposure)
-        req = urllib.request.Request(url)
-        try:
-            urllib.request.urlopen(req)
-        except urllib.error.HTTPError as e:
-            print( 'The server couldn\'t fulfill the request -> ', e.code)
-            raise
-        except urllib.error.URLError as e:
-            print('Fail in reaching the server -> ' ,e.reason)
-            raise
+class driver():
+    """
+    Common base of the camera drivers. Settings are changed by HTTP requests
+    to a cgi-script of the camera, the image is downloaded from an url.
+
+    A camera model only defines the vendor specific parts as class
+    attributes:
+
+        image_path      path of the current image
+        settings_path   path of the settings script, ending with "?" or "&"
+        getparams_path  path of the script reading parameters back, ending
+                        with "?" or "&" (optional)
+        image_params    dictionary request option -> parameter of the image
+                        url (resolution, quality), optional
+        params          dictionary generic setting -> parameter of the camera
+                        (maxexposure, minexposure, exposure_level, maxgain,
+                        mingain, redgain, bluegain, ircut_mode)
+        legacy_tls      use TLSv1 with all ciphers (old firmware)
+
+    Settings without a parameter in the map are not supported by the model.
+
+    The camera keeps a mirror of its settings (state): read_params reads all
+    mapped parameters in a single request, successful writes update the
+    mirror. While the mirror is younger than state_ttl seconds, settings
+    equal to the mirrored value are not sent again, so a reconfiguration of
+    unchanged settings costs no request. Differences between the settings
+    read back and the mirror (e.g. a change via the web interface) are
+    counted as camera_param_changes_total.
+
+    All cameras of a process share the SSL contexts; the url opener of a
+    camera is built on first use. Requests failing due to a timeout or an
+    unreachable camera are repeated retries times with exponential backoff,
+    all requests are recorded in the metrics registry and traced.
+
+    :param ip: string, ip address or host name of the camera
+    :param port: string/int, optional, https port
+    :param http: string, optional, http proxy (see _proxy)
+    :param https: string, optional, https proxy
+    :param user: string, optional, user name for basic authentication
+    :param passwd: string, optional, password
+    :param name: string, optional, camera id used in metrics, traces and
+        archive, default ip[:port]
+    :param retries: int, optional, repetitions of failed requests
+    :param backoff: float, optional, waiting time before the first repetition
+        in seconds, doubled for each further one
+    :param state_ttl: float, optional, validity of the mirrored settings in
+        seconds
+    """
 
+    model = None
+    scheme = "https"
+    image_path = ""
+    settings_path = ""
+    getparams_path = ""
+    params = {}
+    image_params = {}
+    legacy_tls = False
 
+    # allowed values
+    exposure_times = [5, 15, 25, 50, 100, 200, 250, 500, 1000, 2000, 4000,
+        8000, 16000, 32000]
+    ircut_modes = ["day", "night", "auto", "di", "schedule"]
 
 
+    def __init__(self,ip="",port="",http=None,https=None,user="",passwd="",
+            name=None,retries=0,backoff=1.,state_ttl=300.):
+        if port != "" and port is not None:
+            self.ip = ip + ':' + str(port)
+        else:
+            self.ip = ip
+        self.name = name if name else self.ip
+        self.image_url = self.scheme + "://" + self.ip + self.image_path
+        self.settings_url = self.scheme + "://" + self.ip + self.settings_path
+        self.getparams_url = self.scheme + "://" + self.ip + self.getparams_path
+        self.maxexposure = 5
+        self.minexposure = 32000
+        self.level = 6
+        self.maxgain = 100
+        self.mingain = 0
+        self.redgain = 37
+        self.bluegain = 30
+        self.retries = retries
+        self.backoff = backoff
 
+        # offset of the camera clock, see capture
+        self.clock = clock_estimator()
 
-    def set_exposure_level(self,level=-1):
-        """
-        Sets exposure level for Vivotek network camera
+        # mirror of the camera settings, generic setting -> value
+        self.state = {}
+        self.state_time = None
+        self.state_ttl = state_ttl
 
-        Parameters
-        -----------
+        # The SSL context and the url opener are built on first use (see
+        # opener), so invocations changing only one setting start fast
+        self.proxies = (http, https)
+        self.user = user
+        self.passwd = passwd
+        self._opener = None
 
-        :param level: int, optional
-              Exposure between 0-12, 6 is equal to neutral
-              If level is not given, the default (=6) is set. Can be used to reset settings
 
-        """
-        if level < 0: level = self.level
 
-        url = self.settings_url + "videoin_c0_exposurelevel=" + str(level)
-        req = urllib.request.Request(url)
-        try:
-            urllib.request.urlopen(req)
-        except urllib.error.HTTPError as e:
-            print( 'The server couldn\'t fulfill the request -> ', e.code)
-            raise
-        except urllib.error.URLError as e:
-            print('Fail in reaching the server -> ' ,e.reason)
-            raise
+    def __repr__(self):
+        return "%s(name=%r, ip=%r)" % (self.__class__.__name__, self.name,
+            self.ip)
 
 
 
+    def ssl_context(self):
+        """ SSL context of the model, shared by all cameras of a process """
+        with _ssl_lock:
+            context = _ssl_contexts.get(self.legacy_tls)
+            if context is not None: return context
+            if self.legacy_tls:
+                # old Vivotek firmware only speaks TLSv1
+                context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+                context.set_ciphers('ALL')
+            else:
+                # cameras use self-signed certificates
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            _ssl_contexts[self.legacy_tls] = context
 
+        return context
 
 
-    def cut_filter_mode(self,mode="day"):
+
+    @property
+    def opener(self):
         """
-        Sets IR cut filter mode for Vivotek network camera
+        url opener of the camera (SSL context, proxy and authentication),
+        built on first use and installed as default opener of urllib
+        """
+        if self._opener is not None: return self._opener
 
-        Parameters
-        -----------
+        opprox = self._proxy(http=self.proxies[0],https=self.proxies[1])
+        httpshandl = urllib.request.HTTPSHandler(context=self.ssl_context())
 
-        :param mode: str, optional
-              IR cut mode: "day" (default), "night", "auto", "di", "schedule"
-        """
-        if mode not in ["day", "night", "auto", "di", "schedule"]:
-            print( 'Mode ', mode , ' not allowed, choose one of: ' \
-                "day", "night", "auto", "di", "schedule" ' -> do nothing')
-            return
-        url = self.settings_url + "ircutcontrol_mode=" + str(mode)
-        req = urllib.request.Request(url)
-        try:
-            urllib.request.urlopen(req)
-        except urllib.error.HTTPError as e:
-            print( 'The server couldn\'t fulfill the request -> ', e.code)
-            raise
-        except urllib.error.URLError as e:
-            print('Fail in reaching the server -> ' ,e.reason)
-            raise
+        if self.user:
+            opauth = self._auth(self.user,self.passwd)
+            opener = urllib.request.build_opener(httpshandl,opauth,opprox)
+        else:
+            opener = urllib.request.build_opener(httpshandl,opprox)
 
+        self._opener = opener
 
+        urllib.request.install_opener(self._opener)
 
+        return self._opener
 
 
 
-    def set_gain(self,maxgain=None, mingain=None):
+    def _auth(self,user,passwd):
         """
-        Sets gain for Vivotek network camera
+        Setup basic http authentification
 
         Parameters
-        -----------
-        :params maxgain: int, optional, maximum gain, default 100
-        :params mingain: int, optional, minimum gain, default 0
+        ----------
+        :params user: string, usernamer
+        :params passwd: string, password
 
+        Returns
+        -------
+        :returns handler: HTTP handler object
         """
-        if not maxgain: maxgain = self.maxgain
-        if not mingain: mingain = self.mingain
-
-        urllib.request.urlopen(self.settings_url + "videoin_c0_maxgain=" + maxgain + \
-            "&videoin_c0_mingain=" + mingain)
-
-
-
+        password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
+        password_mgr.add_password(None, self.scheme + '://' + self.ip, user,
+            passwd)
+        handler = urllib.request.HTTPBasicAuthHandler(password_mgr)
 
+        return handler
 
-    def white_balance(self,redgain=None, bluegain=None):
-        """
-        Sets white balance for Vivotek network camera in manual mode
-        Corresponds to browser settings in media -> image -> image settings ->
-        white balance
 
-        Parameters
-        -----------
-        :params redgain: int, optional, red color gain (range 0-100)
-        :params bluegain: int, optional, blue color gain (range 0-100)
 
+    def _proxy(self,http='',https=''):
         """
-        if redgain:
-            urllib.request.urlopen(self.settings_url + "videoin_c0_rgain=" + str(redgain) )
+        Sets the proxy for the requests.
 
-        if bluegain:
-            urllib.request.urlopen(self.settings_url + "videoin_c0_bgain=" + str(bluegain) )
+        If http is None, the environment variable (if set)
+        is overwritten by an empty dictionary -< No proxy is used.
 
+        If http is empty (""), the default environment proxy is used
 
+        If http is an address, the specified address is used (also for https
+        if https is not given)
 
+        Parameters:
+        -----------
 
+        :param http: string, optional, address of proxy
+        :param https: string, optional, address of https proxy
 
-    def download_image_to_file(self, filename = None ):
-        """Store the url content to filename
+        """
+        if http == None:
+            proxy = urllib.request.ProxyHandler({})
+        elif http == "" and not https:
+            proxy = urllib.request.ProxyHandler({'http': os.getenv('http_proxy'), \
+                'https': os.getenv('https_proxy') })
+        else:
+            proxy = urllib.request.ProxyHandler({'http': http,
+                'https': https if https else http})
 
-        Parameters:
-        -----------
-        :param filename: string, optional
+        return proxy
 
-            path + filename for output image, if not given the basename of the url
-            is used as filename and image is stored at current directory.
 
-        :returns flag: boolean
 
-            True if saving was successful, otherwise False
+    def parse_params(self, text):
         """
+        Parses the response of the parameter script, lines name='value'
 
+        :returns: dictionary camera parameter -> value (int if numeric)
+        """
+        values = {}
+        for line in text.splitlines():
+            if "=" not in line: continue
+            key, value = line.split("=", 1)
+            value = value.strip().strip("'\"")
+            values[key.strip()] = int(value) if value.lstrip("-").isdigit() \
+                else value
 
-        flag = False
-        url = self.image_url
+        return values
 
-        if not filename:
-            filename = os.path.basename( os.path.realpath(url) )
-        resource = urllib.request.urlopen(url, timeout=5)
 
-        with open(filename,"wb") as output:
-            output.write( resource.read() )
-            output.close()
-            flag = True
 
-        return flag
+    def read_params(self, settings=None):
+        """
+        Reads settings back from the camera in a single request and updates
+        the mirror (state)
 
+        :param settings: list, optional, generic settings, default all mapped
 
+        :returns: dictionary generic setting -> value, None if the model does
+            not support reading
+        """
+        if not self.getparams_path or not self.params:
+            print('Reading settings not supported by camera model ', self.model)
+            return None
+        if settings is None: settings = list(self.params)
 
+        query = "&".join(self.params[k] for k in settings)
+        text = _request(self, self.getparams_url + query, "read_params")
+        values = self.parse_params(text.decode("utf-8", "replace"))
 
+        names = dict((v, k) for k, v in self.params.items())
+        state = dict((names[k], v) for k, v in values.items() if k in names)
+        changed = [k for k, v in state.items() \
+            if k in self.state and str(self.state[k]) != str(v)]
+        if changed:
+            metrics.REGISTRY.inc("camera_param_changes_total", len(changed),
+                help="Settings changed outside of the driver", camera=self.name)
+            print('Settings of camera ', self.name, ' changed: ', ", ".join( \
+                "%s %s -> %s" % (k, self.state[k], state[k]) for k in changed))
+        self.state.update(state)
+        self.state_time = time.monotonic()
 
-    def addText(self,img, dt=None, loc=""):
-        """ Adds some text into the image ( timestamp, name )
+        return state
 
-        :params img: image object
-        :params dt: datetime, optional, date and time to draw in image corners
-        :params loc: string, optional, string to draw in image corner
-         """
 
-        image = Image.open(img)
-        draw = ImageDraw.Draw(image)
-        lx, ly = image.size
 
-        # Font
-        try:
-            f = '/usr/share/fonts/liberation/LiberationSans-Bold.ttf'
-            txtfont = ImageFont.truetype(f, 50)
-        except:
-            print('Font ' + f + ' could not be found!')
-            txtfont = ""
+    def get_state(self, ttl=None):
+        """
+        Returns the mirrored settings, read from the camera if older than ttl
 
-        # Draw Timestring
-        string = dt.strftime("%H:%M:%S %Z")
-        if dt: draw.text((lx-350, 20),string,fill = 'red',font=txtfont)
+        :param ttl: float, optional, maximum age in seconds, default state_ttl
+        """
+        if ttl is None: ttl = self.state_ttl
+        if self.state_time is None or time.monotonic() - self.state_time > ttl:
+            self.read_params()
 
-        # Draw Datestring
-        string = dt.strftime("%Y/%m/%d")
-        if dt: draw.text((20, 20),string,fill = 'red',font=txtfont)
+        return dict(self.state)
 
-        # Draw Location
-        string = loc
-        draw.text((20, ly-80),string,fill = 'red',font=txtfont)
 
-        return image, draw
 
+    def changed(self, **values):
+        """
+        Returns the settings differing from the valid mirror (all settings if
+        the mirror is expired)
 
-class mobotix():
-    """
-    This methods are written for Mobotix camera. The camera uses
-    cgi-scripts to handle some settings like exposure time, gain, etc.
-    Be careful to set only values that are accepted by the camera, otherwise
-    nothing will happen or errors occur.
-    """
+        :param values: generic setting -> value
+        """
+        if self.state_time is None or \
+                time.monotonic() - self.state_time > self.state_ttl:
+            return dict(values)
 
+        return dict((k, v) for k, v in values.items() \
+            if k not in self.state or str(self.state[k]) != str(v))
 
-    def __init__(self,ip="",port="",http=None,https=None,user="",passwd=""):
-        if port != "":
-            self.ip = ip + ':' + str(port)
-        else:
-            self.ip = ip
-        self.image_url = "https://" + self.ip + "/record/current.jpg"
-        self.settings_url = "https://" + self.ip + "/cgi-bin/admin/setparam.cgi?"
-        self.maxexposure = 5
-        self.minexposure = 32000
-        self.level = 6
-        self.maxgain = 100
-        self.mingain = 0
-        self.redgain = 37
-        self.bluegain = 30
-        self.ssl_context = ""
 
-        # These two lines should only be used in context with Vivotek cameras
-        # due to old ssl versions
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-        ssl_context.set_ciphers('ALL')
 
-        opprox = self._proxy(http=http,https=https)
-        httpshandl = urllib.request.HTTPSHandler(context=ssl_context)
+    def audit(self, **expected):
+        """
+        Reads the settings back and compares them with the expected values
 
-        opener = urllib.request.build_opener(httpshandl,opprox)
+        :param expected: generic setting -> value
+        :returns: dictionary setting -> (expected, actual) of the differences
+        """
+        state = self.read_params(list(k for k in expected if k in self.params))
+        if state is None: return {}
 
-        self.opener = opener
+        return dict((k, (v, state.get(k))) for k, v in expected.items() \
+            if str(state.get(k)) != str(v))
 
-        urllib.request.install_opener(self.opener)
 
 
-    def _proxy(self,http='',https=''):
+    def set_params(self, operation, force=False, **values):
         """
-        Sets the proxy for the requests.
+        Sends generic settings to the camera in one request. Settings equal
+        to the valid mirror are skipped (see changed)
 
-        If http is None, the environment variable (if set)
-        is overwritten by an empty dictionary -< No proxy is used.
+        :param operation: string, name of the operation (metrics, traces)
+        :param force: boolean, optional, send also unchanged settings
+        :param values: generic setting -> value, translated with params
 
-        If http is empty (""), the default environment proxy is used
+        :returns: False if a setting is not supported by the model, else True
+        """
+        missing = [k for k in values if k not in self.params]
+        if missing or not self.settings_path:
+            print('Setting(s) ', missing if missing else list(values),
+                ' not supported by camera model ', self.model, ' -> do nothing')
+            return False
 
-        If http is an address, the specified address is used
+        if not force: values = self.changed(**values)
+        if not values: return True
 
-        Parameters:
-        -----------
+        query = urllib.parse.urlencode([(self.params[k], str(v)) \
+            for k, v in values.items()])
+        req = urllib.request.Request(self.settings_url + query)
+        try:
+            _request(self, req, operation)
+        except urllib.error.HTTPError as e:
+            print( 'The server couldn\'t fulfill the request -> ', e.code)
+            raise
+        except urllib.error.URLError as e:
+            print('Fail in reaching the server -> ' ,e.reason)
+            raise
 
-        :param http: string, optional, address of proxy
-        :param https: string, optional, address of https proxy
+        self.state.update(values)
 
-        """
-        if http == None:
-            proxy = urllib.request.ProxyHandler({})
-        elif http == "" and https == "":
-            proxy = urllib.request.ProxyHandler({'http': os.getenv('http_proxy'), \
-                'https': os.getenv('https_proxy') })
-        else:
-            http = urllib.request.ProxyHandler({'http': http})
+        return True
 
-        return proxy
 
 
     def set_exposure_time(self,maxexposure=-1, minexposure=-1):
         """
-        Sets exposure time for Vivotek network camera
+        Sets exposure time
 
         Parameters
         -----------
 
         :param minexposure, maxexposure: int, optional
 
-              Exposure time range
-              Possible  values:
+              Exposure time range (1/s)
+              Possible  values (exposure_times):
               5, 15, 25, 50, 100, 200, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000
 
         """
         if maxexposure < 0: maxexposure = self.maxexposure
         if minexposure < 0: minexposure = self.minexposure
 
-        elist = [5, 15, 25, 50, 100, 200, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000]
+        elist = self.exposure_times
 
         if not minexposure in elist or not maxexposure in elist:
             print( 'Exposure times out of possible values: Use one of these values:', elist, ' -> Exit')
@@ -466,26 +645,14 @@ class mobotix():
             print( 'Maximum exposure time must be smaller than minimum exposure time:', \
                 maxexposure, ' > ', minexposure, ' -> Exit')
 
-        url = self.settings_url + "videoin_c0_maxexposure=" + str(maxexposure) + \
-            "&videoin_c0_minexposure=" + str(minexposure)
-        req = urllib.request.Request(url)
-        try:
-            urllib.request.urlopen(req)
-        except urllib.error.HTTPError as e:
-            print( 'The server couldn\'t fulfill the request -> ', e.code)
-            raise
-        except urllib.error.URLError as e:
-            print('Fail in reaching the server -> ' ,e.reason)
-            raise
-
-
-
+        return self.set_params("set_exposure_time", maxexposure=maxexposure,
+            minexposure=minexposure)
 
 
 
     def set_exposure_level(self,level=-1):
         """
-        Sets exposure level for Vivotek network camera
+        Sets exposure level
 
         Parameters
         -----------
@@ -497,25 +664,13 @@ class mobotix():
         """
         if level < 0: level = self.level
 
-        url = self.settings_url + "videoin_c0_exposurelevel=" + str(level)
-        req = urllib.request.Request(url)
-        try:
-            urllib.request.urlopen(req)
-        except urllib.error.HTTPError as e:
-            print( 'The server couldn\'t fulfill the request -> ', e.code)
-            raise
-        except urllib.error.URLError as e:
-            print('Fail in reaching the server -> ' ,e.reason)
-            raise
-
-
-
+        return self.set_params("set_exposure_level", exposure_level=level)
 
 
 
     def cut_filter_mode(self,mode="day"):
         """
-        Sets IR cut filter mode for Vivotek network camera
+        Sets IR cut filter mode
 
         Parameters
         -----------
@@ -523,29 +678,17 @@ class mobotix():
         :param mode: str, optional
               IR cut mode: "day" (default), "night", "auto", "di", "schedule"
         """
-        if mode not in ["day", "night", "auto", "di", "schedule"]:
-            print( 'Mode ', mode , ' not allowed, choose one of: ' \
-                "day", "night", "auto", "di", "schedule" ' -> do nothing')
+        if mode not in self.ircut_modes:
+            print( 'Mode ', mode , ' not allowed, choose one of: ',
+                self.ircut_modes, ' -> do nothing')
             return
-        url = self.settings_url + "ircutcontrol_mode=" + str(mode)
-        req = urllib.request.Request(url)
-        try:
-            urllib.request.urlopen(req)
-        except urllib.error.HTTPError as e:
-            print( 'The server couldn\'t fulfill the request -> ', e.code)
-            raise
-        except urllib.error.URLError as e:
-            print('Fail in reaching the server -> ' ,e.reason)
-            raise
-
-
-
+        return self.set_params("cut_filter_mode", ircut_mode=mode)
 
 
 
     def set_gain(self,maxgain=None, mingain=None):
         """
-        Sets gain for Vivotek network camera
+        Sets gain
 
         Parameters
         -----------
@@ -553,21 +696,16 @@ class mobotix():
         :params mingain: int, optional, minimum gain, default 0
 
         """
-        if not maxgain: maxgain = self.maxgain
-        if not mingain: mingain = self.mingain
-
-        urllib.request.urlopen(self.settings_url + "videoin_c0_maxgain=" + maxgain + \
-            "&videoin_c0_mingain=" + mingain)
-
+        if maxgain is None: maxgain = self.maxgain
+        if mingain is None: mingain = self.mingain
 
+        return self.set_params("set_gain", maxgain=maxgain, mingain=mingain)
 
 
 
     def white_balance(self,redgain=None, bluegain=None):
         """
-        Sets white balance for Vivotek network camera in manual mode
-        Corresponds to browser settings in media -> image -> image settings ->
-        white balance
+        Sets white balance in manual mode
 
         Parameters
         -----------
@@ -575,13 +713,106 @@ class mobotix():
         :params bluegain: int, optional, blue color gain (range 0-100)
 
         """
-        if redgain:
-            urllib.request.urlopen(self.settings_url + "videoin_c0_rgain=" + str(redgain) )
+        values = {}
+        if redgain: values['redgain'] = redgain
+        if bluegain: values['bluegain'] = bluegain
+        if not values: return
+
+        return self.set_params("white_balance", **values)
+
+
+
+    def download_image(self, timeout=5, resolution=None, quality=None):
+        """Returns the url content (raw JPEG bytes) without decoding or storing
+
+        This is the only step required in the capture loop, all further
+        processing can be done afterwards (see pipeline module). See capture
+        for the time of exposure and the request options.
+
+        Parameters:
+        -----------
+        :param timeout: float, optional, timeout of the request in seconds
+        :param resolution: string, optional, e.g. "1024x1024"
+        :param quality: int, optional, JPEG quality of the camera
+
+        :returns data: bytes, the encoded image
+        """
+        return self.capture(timeout=timeout, resolution=resolution,
+            quality=quality)[0]
+
+
+
+    def image_request(self, resolution=None, quality=None):
+        """
+        Returns the image url with the request options. Options not
+        supported by the model (image_params) are ignored.
+
+        :param resolution: string, optional, e.g. "1024x1024", default
+            resolution of the camera if None
+        :param quality: optional, JPEG quality (values of the camera model),
+            default quality of the camera if None
+        """
+        options = [(self.image_params[k], v) for k, v in \
+            (('resolution', resolution), ('quality', quality)) \
+            if v is not None and k in self.image_params]
+        if not options: return self.image_url
+
+        return self.image_url + ("&" if "?" in self.image_url else "?") + \
+            urllib.parse.urlencode(options)
+
+
+
+    def capture(self, timeout=5, resolution=None, quality=None):
+        """Downloads the current image and estimates the time of exposure
+
+        The camera takes the image after the request arrived and before the
+        response header is sent, so the capture time is estimated as the
+        middle between sending the request and receiving the first byte
+        (local clock, which should be synchronized by NTP), the uncertainty is
+        half of this interval. The offset of the camera clock is estimated from
+        the HTTP Date headers (see clock_estimator).
+
+        Parameters:
+        -----------
+        :param timeout: float, optional, timeout of the request in seconds
+        :param resolution, quality: optional, request options, see
+            image_request (adaptive module chooses them per frame)
+
+        :returns data, info: bytes, the encoded image, and a dictionary with
+
+            'capture_time'          datetime (UTC), estimated time of exposure
+            'capture_uncertainty'   seconds
+            'send', 'first_byte', 'complete'  monotonic times of the request
+            'clock_offset'          seconds, camera clock - local clock (or
+                                    None without Date header)
+            'clock_uncertainty'     seconds
+        """
+        timing = {}
+        data = _request(self, self.image_request(resolution, quality),
+            "download", timeout=timeout, timing=timing)
+
+        wait = timing['first_byte'] - timing['send']
+        self.clock.add(timing.get('date'), timing['wall'], timing['wall'] + wait)
+        offset, uncertainty = self.clock.offset()
 
-        if bluegain:
-            urllib.request.urlopen(self.settings_url + "videoin_c0_bgain=" + str(bluegain) )
+        info = dict(timing)
+        info['capture_time'] = datetime.utcfromtimestamp(timing['wall']) + \
+            timedelta(seconds=wait / 2.)
+        info['capture_uncertainty'] = wait / 2.
+        info['clock_offset'] = offset
+        info['clock_uncertainty'] = uncertainty
+        del info['date'], info['wall']
 
+        reg = metrics.REGISTRY
+        reg.observe("camera_first_byte_seconds", wait,
+            help="Time from request to response header (capture window)",
+            camera=self.name)
+        if offset is not None:
+            reg.set("camera_clock_offset_seconds", offset,
+                help="Offset of the camera clock (camera - local)",
+                camera=self.name)
 
+        return data, info
 
 
 
@@ -606,10 +837,10 @@ class mobotix():
 
         if not filename:
             filename = os.path.basename( os.path.realpath(url) )
-        resource = urllib.request.urlopen(url, timeout=5)
+        data = self.download_image()
 
         with open(filename,"wb") as output:
-            output.write( resource.read() )
+            output.write( data )
             output.close()
             flag = True
 
@@ -617,43 +848,134 @@ class mobotix():
 
 
 
-
-
-    def addText(self,img, dt=None, loc=""):
-        """ Adds some text into the image ( timestamp, name )
+    def addText(self,img, dt=None, loc="", uncertainty=None):
+        """ Adds some text into the image ( timestamp, name ), see add_text
 
         :params img: image object
         :params dt: datetime, optional, date and time to draw in image corners
         :params loc: string, optional, string to draw in image corner
+        :params uncertainty: float, optional, uncertainty of dt in seconds
          """
 
-        image = Image.open(img)
-        draw = ImageDraw.Draw(image)
-        lx, ly = image.size
+        return add_text(img, dt=dt, loc=loc, uncertainty=uncertainty)
+
+
+
+
+
+@register("vivotek")
+class vivotek(driver):
+    """
+    This methods are written for Vivotek FE8172V/FE8174V camera. The camera uses
+    cgi-scripts to handle some settings like exposure time, gain, etc.
+    Be careful to set only values that are accepted by the camera, otherwise
+    nothing will happen or errors occur.
+    """
+
+    image_path = "/cgi-bin/viewer/video.jpg"
+    settings_path = "/cgi-bin/admin/setparam.cgi?"
+    getparams_path = "/cgi-bin/admin/getparam.cgi?"
+    image_params = {'resolution': "resolution", 'quality': "quality"}
+    params = {
+        'maxexposure': "videoin_c0_maxexposure",
+        'minexposure': "videoin_c0_minexposure",
+        'exposure_level': "videoin_c0_exposurelevel",
+        'maxgain': "videoin_c0_maxgain",
+        'mingain': "videoin_c0_mingain",
+        'redgain': "videoin_c0_rgain",
+        'bluegain': "videoin_c0_bgain",
+        'ircut_mode': "ircutcontrol_mode",
+    }
+    legacy_tls = True
+
+
 
-        # Font
+
+
+@register("mobotix")
+class mobotix(driver):
+    """
+    This methods are written for Mobotix camera. The current image is served
+    at /record/current.jpg, settings are changed via the control interface
+    /control/control?set&section=<section>&<parameter>=<value>.
+
+    The exposure parameters differ between the Mobotix models and are not
+    mapped yet. Register a subclass for the model with settings_path
+    "/control/control?set&section=<section>&" and params (the names are
+    listed by /control/control?list of the camera). Until then, only the
+    download of images is supported.
+    """
+
+    image_path = "/record/current.jpg"
+    settings_path = ""
+    params = {}
+
+
+
+
+
+
+# Image width (pixels) of the text layout of add_text
+TEXT_WIDTH = 1536
+
+
+
+def add_text(img, dt=None, loc="", uncertainty=None):
+    """ Adds some text into the image ( timestamp, name )
+
+    Module level version of the camera method addText, it does not need a
+    camera connection and can therefore be used in worker processes.
+
+    :params img: string, file object or PIL image object, image
+    :params dt: datetime, optional, date and time to draw in image corners
+    :params loc: string, optional, string to draw in image corner
+    :params uncertainty: float, optional, uncertainty of dt in seconds, the
+        time is drawn with 1/100 s and the uncertainty (e.g. the estimated
+        capture time, see capture)
+
+    Font size and positions are scaled with the image width relative to
+    TEXT_WIDTH, so frames of lower resolution (see adaptive module) get the
+    same layout.
+     """
+    from PIL import Image, ImageDraw, ImageFont
+
+    with tracing.span("decode"):
+        image = img if isinstance(img, Image.Image) else Image.open(img)
+        image.load()
+    draw = ImageDraw.Draw(image)
+    lx, ly = image.size
+    k = lx / float(TEXT_WIDTH)
+    def pos(x, y): return (int(round(x * k)), int(round(y * k)))
+
+    # Font
+    with tracing.span("font"):
         try:
             f = '/usr/share/fonts/liberation/LiberationSans-Bold.ttf'
-            txtfont = ImageFont.truetype(f, 50)
+            txtfont = ImageFont.truetype(f, max(8, int(round(50 * k))))
         except:
             print('Font ' + f + ' could not be found!')
-            txtfont = ""
+            txtfont = None
 
+    with tracing.span("draw"):
         # Draw Timestring
-        string = dt.strftime("%H:%M:%S %Z")
-        if dt: draw.text((lx-350, 20),string,fill = 'red',font=txtfont)
+        if dt and uncertainty is not None:
+            string = dt.strftime("%H:%M:%S.%f")[:-4] + \
+                u" \u00b1%.2fs" % uncertainty
+            draw.text(pos(TEXT_WIDTH-600, 20),string,fill = 'red',font=txtfont)
+        elif dt:
+            string = dt.strftime("%H:%M:%S %Z")
+            draw.text(pos(TEXT_WIDTH-350, 20),string,fill = 'red',font=txtfont)
 
         # Draw Datestring
-        string = dt.strftime("%Y/%m/%d")
-        if dt: draw.text((20, 20),string,fill = 'red',font=txtfont)
+        if dt:
+            string = dt.strftime("%Y/%m/%d")
+            draw.text(pos(20, 20),string,fill = 'red',font=txtfont)
 
         # Draw Location
         string = loc
-        draw.text((20, ly-80),string,fill = 'red',font=txtfont)
-
-        return image, draw
-
+        draw.text(pos(20, ly/k-80),string,fill = 'red',font=txtfont)
 
+    return image, draw
 
 
 
@@ -682,6 +1004,9 @@ def solar_data(dates, lat, lon):
         fundamentals and modeling techniques" from Zekai Sen
     """
 
+    import numpy as np
+    from numpy import pi, cos, sin, radians, degrees, arcsin, arccos
+
     dt_1600 = datetime(1600, 1, 1)
 
     # Compute julian dates relative to 1600-01-01 00:00.
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Lightweight command line interface for one-shot camera settings.
+
+Only the camera module is imported, which loads PIL and numpy on first use
+of image or solar functions only. A call changing one setting therefore does
+not pay for the import of the image libraries.
+
+Usage::
+
+    python cli.py --ip 192.168.1.10 --port 443 exposure-level 6
+    python cli.py --ip 192.168.1.10 exposure-time 5 32000
+    python cli.py --ip 192.168.1.10 gain 100 0
+    python cli.py --ip 192.168.1.10 white-balance 37 30
+    python cli.py --ip 192.168.1.10 ir-cut day
+    python cli.py --ip 192.168.1.10 snapshot image.jpg
+    python cli.py --ip 192.168.1.10 get-params
+    python cli.py startup-benchmark
+
+After installation the interface is also available as command skycam.
+
+The startup benchmark measures the time of new interpreter processes
+importing the camera module and creating a camera object, once lazily (as
+this interface does) and once with the image and solar dependencies loaded
+as in the module versions before.
+"""
+
+import sys
+import argparse
+
+
+
+def startup_benchmark(repeat=10):
+    """
+    Measures the startup time of one-shot invocations
+
+    :param repeat: int, optional, number of interpreter starts per case
+
+    :returns: dictionary case -> median time in seconds
+    """
+    import os
+    import time
+    import subprocess
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    cases = {
+        'interpreter': "pass",
+        'camera (lazy)': "import camera; camera.vivotek(ip='127.0.0.1')",
+        'camera (eager)': "import camera; camera.vivotek(ip='127.0.0.1')" \
+            ".opener; import PIL.Image, PIL.ImageDraw, PIL.ImageFont, numpy",
+        'cli --help': "import sys; sys.argv=['cli', '--help']; import cli; " \
+            "cli.main()",
+    }
+    env = dict(os.environ)
+    env['PYTHONPATH'] = here + os.pathsep + env.get('PYTHONPATH', "")
+    results = {}
+    for case, code in cases.items():
+        times = []
+        for i in range(repeat):
+            tic = time.perf_counter()
+            subprocess.call([sys.executable, "-c", code], env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - tic)
+        times.sort()
+        results[case] = times[len(times) // 2]
+
+    return results
+
+
+
+def main(argv=None):
+    """ Entry point of the command line interface """
+    parser = argparse.ArgumentParser(prog="skycam",
+        description="One-shot settings of Vivotek/Mobotix sky imagers")
+    parser.add_argument("--ip", default="", help="IP address of the camera")
+    parser.add_argument("--port", default="", help="https port")
+    parser.add_argument("--user", default="", help="user name")
+    parser.add_argument("--passwd", default="", help="password")
+    parser.add_argument("--model", default="vivotek",
+        help="registered camera model (vivotek, mobotix, ...)")
+    parser.add_argument("--proxy", default=None,
+        help="proxy address, empty string for the environment proxy")
+    sub = parser.add_subparsers(dest="command")
+
+    p = sub.add_parser("exposure-level", help="exposure level 0-12 (6 neutral)")
+    p.add_argument("level", type=int)
+    p = sub.add_parser("exposure-time", help="exposure time range")
+    p.add_argument("maxexposure", type=int)
+    p.add_argument("minexposure", type=int)
+    p = sub.add_parser("gain", help="gain range")
+    p.add_argument("maxgain", type=int)
+    p.add_argument("mingain", type=int)
+    p = sub.add_parser("white-balance", help="red and blue gain (0-100)")
+    p.add_argument("redgain", type=int)
+    p.add_argument("bluegain", type=int)
+    p = sub.add_parser("ir-cut", help="IR cut filter mode")
+    p.add_argument("mode", choices=("day", "night", "auto", "di", "schedule"))
+    p = sub.add_parser("snapshot", help="download the current image")
+    p.add_argument("filename")
+    p = sub.add_parser("get-params", help="read the settings back")
+    p = sub.add_parser("startup-benchmark", help="measure startup time")
+    p.add_argument("--repeat", type=int, default=10)
+
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.print_help()
+        return 1
+
+    if args.command == "startup-benchmark":
+        for case, t in startup_benchmark(args.repeat).items():
+            print("%-16s %8.1f ms" % (case, t * 1e3))
+        return 0
+
+    import camera
+
+    try:
+        cam = camera.create(args.model, ip=args.ip, port=args.port,
+            http=args.proxy, https=args.proxy, user=args.user,
+            passwd=args.passwd)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.command == "exposure-level":
+        result = cam.set_exposure_level(args.level)
+    elif args.command == "exposure-time":
+        result = cam.set_exposure_time(args.maxexposure, args.minexposure)
+    elif args.command == "gain":
+        result = cam.set_gain(args.maxgain, args.mingain)
+    elif args.command == "white-balance":
+        result = cam.white_balance(args.redgain, args.bluegain)
+    elif args.command == "ir-cut":
+        result = cam.cut_filter_mode(args.mode)
+    elif args.command == "snapshot":
+        result = cam.download_image_to_file(args.filename)
+    elif args.command == "get-params":
+        result = cam.read_params()
+        if result is None: return 1
+        for key, value in sorted(result.items()):
+            print("%-16s %s" % (key, value))
+
+    return 1 if result is False else 0
+
+
+
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module stores archive images in packed, append-only daily containers.
+
+With one file per frame, a camera with a 10 s interval creates 8640 files per
+day and millions of files per year, which is hard on inodes, backups and
+directory listings. Instead all frames of one camera and day are appended to
+one container file:
+
+    root/<camera>/YYYYMMDD.pack   concatenated JPEG images
+    root/<camera>/YYYYMMDD.idx    offset index, one fixed size record per frame
+
+An index record consists of the acquisition time (unix timestamp, float64),
+the offset (uint64) and the length (uint32) of the image in the pack file,
+little endian. The image data is written before the index record, so a crash
+while appending leaves at most unreferenced bytes at the end of the pack file.
+
+Single frames are read zero-copy from a memory map of the pack file. The
+containers can be exported to the usual directory layout
+outdir/YYYYMMDD/YYYYMMDD_HHMMSS.jpg at any time.
+
+A frame in a container is addressed by a locator string
+"root/<camera>/YYYYMMDD.pack#<number>", which can be stored in the archive
+index instead of a file path (see read).
+
+Run this module as a script for a benchmark of append and random access
+(each read opens the container or the file, reads with an open container are
+reported separately):
+
+    python container.py [directory]
+
+
+Package requirements:
+    numpy, fcntl (unix)
+"""
+
+import os
+import io
+import sys
+import mmap
+import time
+import fcntl
+import numpy as np
+from datetime import datetime
+
+import archive
+
+
+# Index record: time, offset and length of an image
+RECORD = np.dtype([('time', '<f8'), ('offset', '<u8'), ('length', '<u4')])
+
+
+
+def container_name(root, camera, dt):
+    """
+    Returns the pack file of a camera and day
+
+    :param root: string, container directory
+    :param camera: string, camera id
+    :param dt: datetime, any time of the day
+
+    :returns: string, path of the pack file
+    """
+    return root + os.sep + camera + os.sep + dt.strftime("%Y%m%d") + ".pack"
+
+
+
+def read(locator):
+    """
+    Reads an image from a container locator "file.pack#number" or from a
+    plain file path
+
+    :param locator: string
+
+    :returns data: bytes
+    """
+    if "#" in locator:
+        fname, number = locator.rsplit("#", 1)
+        with pack_reader(fname) as reader:
+            return bytes(reader.get(int(number)))
+
+    with open(locator, "rb") as f:
+        return f.read()
+
+
+
+
+
+class pack_writer():
+    """
+    Appends images to a daily container. Appending is guarded by an exclusive
+    file lock, so several processes can append to the same container.
+
+    :param fname: string, path of the pack file, directories are created
+    """
+
+    def __init__(self, fname):
+        dname = os.path.dirname(fname)
+        if dname and not os.path.exists(dname): os.makedirs(dname, exist_ok=True)
+        self.fname = fname
+        self.pack = open(fname, "ab")
+        self.idx = open(fname[:-5] + ".idx", "ab")
+
+
+
+    def append(self, dt, data):
+        """
+        Appends an image
+
+        :param dt: datetime, acquisition time (UTC)
+        :param data: bytes, encoded image
+
+        :returns: int, number of the frame in the container
+        """
+        rec = np.zeros(1, dtype=RECORD)
+        fcntl.flock(self.idx, fcntl.LOCK_EX)
+        try:
+            # drop a partially written record of a crashed writer
+            size = os.fstat(self.idx.fileno()).st_size
+            if size % RECORD.itemsize:
+                self.idx.truncate(size - size % RECORD.itemsize)
+            number = size // RECORD.itemsize
+
+            offset = os.fstat(self.pack.fileno()).st_size
+            self.pack.write(data)
+            self.pack.flush()
+
+            rec['time'] = archive.to_timestamp(dt)
+            rec['offset'] = offset
+            rec['length'] = len(data)
+            self.idx.write(rec.tobytes())
+            self.idx.flush()
+        finally:
+            fcntl.flock(self.idx, fcntl.LOCK_UN)
+
+        return number
+
+
+
+    def close(self):
+        self.pack.close()
+        self.idx.close()
+
+
+
+    def __enter__(self):
+        return self
+
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+
+
+class pack_reader():
+    """
+    Reads images of a daily container from a memory map.
+
+    The index is read when the reader is opened, frames appended later are
+    visible after calling refresh.
+
+    :param fname: string, path of the pack file
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.file = open(fname, "rb")
+        self.map = None
+        self.view = None
+        self.refresh()
+
+
+
+    def refresh(self):
+        """ Re-reads the index and re-maps the pack file """
+        index = np.fromfile(self.fname[:-5] + ".idx", dtype=np.uint8)
+        n = len(index) // RECORD.itemsize
+        self.index = index[:n * RECORD.itemsize].view(RECORD)
+
+        size = os.fstat(self.file.fileno()).st_size
+        self._unmap()
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ) \
+            if size else None
+        self.view = memoryview(self.map) if self.map is not None else None
+
+        # only frames completely written are valid
+        if n and self.index['offset'][-1] + self.index['length'][-1] > size:
+            end = self.index['offset'] + self.index['length']
+            self.index = self.index[:np.searchsorted(end, size, side='right')]
+
+        # several workers may append slightly out of order
+        self.order = np.argsort(self.index['time'], kind='stable')
+        self.sorted_times = self.index['time'][self.order]
+
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+
+    def times(self):
+        """ Returns the acquisition times as array of unix timestamps """
+        return self.index['time']
+
+
+
+    def get(self, number):
+        """
+        Returns an image without copying
+
+        :param number: int, number of the frame in the container
+
+        :returns: memoryview of the encoded image, only valid while the
+            reader is open
+        """
+        rec = self.index[number]
+        offset = int(rec['offset'])
+
+        return self.view[offset:offset + int(rec['length'])]
+
+
+
+    def find(self, dt):
+        """
+        Returns the number of the frame acquired at dt (exact to 1 ms) or None
+        """
+        ts = archive.to_timestamp(dt)
+        times = self.sorted_times
+        i = int(np.searchsorted(times, ts - 0.0005))
+        if i < len(times) and abs(times[i] - ts) < 0.0005:
+            return int(self.order[i])
+
+        return None
+
+
+
+    def frames(self, start=None, end=None):
+        """
+        Generator over the frames in a time range in chronological order
+
+        :param start: datetime, optional, first time (inclusive)
+        :param end: datetime, optional, last time (exclusive)
+
+        :yields: (datetime, memoryview)
+        """
+        times = self.sorted_times
+        i0 = 0 if start is None else \
+            int(np.searchsorted(times, archive.to_timestamp(start)))
+        i1 = len(times) if end is None else \
+            int(np.searchsorted(times, archive.to_timestamp(end)))
+        for i in self.order[i0:i1]:
+            yield archive.from_timestamp(self.index['time'][i]), self.get(i)
+
+
+
+    def export(self, outdir):
+        """
+        Writes all frames to the directory layout
+        outdir/YYYYMMDD/YYYYMMDD_HHMMSS.jpg
+
+        :param outdir: string, archive directory
+
+        :returns: list of written files
+        """
+        files = []
+        for dt, data in self.frames():
+            dname = outdir + os.sep + dt.strftime("%Y%m%d")
+            if not os.path.exists(dname): os.makedirs(dname)
+            fname = dname + os.sep + dt.strftime("%Y%m%d_%H%M%S.jpg")
+            with open(fname, "wb") as f:
+                f.write(data)
+            files.append(fname)
+
+        return files
+
+
+
+    def _unmap(self):
+        """ Closes the memory map, if frames returned by get are still
+        referenced the map is closed when the last of them is released """
+        if self.map is None: return
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+        self.map = None
+
+
+
+    def close(self):
+        self._unmap()
+        self.file.close()
+
+
+
+    def __enter__(self):
+        return self
+
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+
+
+class pack_archive():
+    """
+    Archive backend storing the frames of each camera and day in one
+    container below a root directory.
+
+    :param root: string, container directory
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.writers = {}
+
+
+
+    def append(self, dt, camera, data):
+        """
+        Appends an image to the container of its camera and day
+
+        :returns: string, locator of the frame
+        """
+        fname = container_name(self.root, camera, dt)
+        if fname not in self.writers:
+            # a new day started, close containers of the previous days
+            for old in [k for k in self.writers if k.startswith( \
+                    self.root + os.sep + camera + os.sep)]:
+                self.writers.pop(old).close()
+            self.writers[fname] = pack_writer(fname)
+        number = self.writers[fname].append(dt, data)
+
+        return fname + "#" + str(number)
+
+
+
+    def cameras(self):
+        """ Returns the camera ids with containers """
+        if not os.path.exists(self.root): return []
+
+        return sorted(d for d in os.listdir(self.root) \
+            if os.path.isdir(self.root + os.sep + d))
+
+
+
+    def days(self, camera):
+        """ Returns the days (YYYYMMDD strings) with a container """
+        dname = self.root + os.sep + camera
+        if not os.path.exists(dname): return []
+
+        return sorted(f[:-5] for f in os.listdir(dname) if f.endswith(".pack"))
+
+
+
+    def frames(self, camera, start=None, end=None):
+        """
+        Generator over the frames of a camera in a time range. The yielded
+        data is copied, as the containers are closed after each day.
+
+        :yields: (datetime, bytes)
+        """
+        for day in self.days(camera):
+            if start and day < start.strftime("%Y%m%d"): continue
+            if end and day > end.strftime("%Y%m%d"): break
+            fname = self.root + os.sep + camera + os.sep + day + ".pack"
+            with pack_reader(fname) as reader:
+                for dt, data in reader.frames(start, end):
+                    yield dt, bytes(data)
+
+
+
+    def export(self, camera, outdir, start=None, end=None):
+        """
+        Exports the frames of a camera to the directory layout
+        outdir/YYYYMMDD/YYYYMMDD_HHMMSS.jpg
+
+        :returns: int, number of exported frames
+        """
+        n = 0
+        for dt, data in self.frames(camera, start, end):
+            dname = outdir + os.sep + dt.strftime("%Y%m%d")
+            if not os.path.exists(dname): os.makedirs(dname)
+            with open(dname + os.sep + dt.strftime("%Y%m%d_%H%M%S.jpg"),
+                    "wb") as f:
+                f.write(data)
+            n += 1
+
+        return n
+
+
+
+    def close(self):
+        for writer in self.writers.values(): writer.close()
+        self.writers = {}
+
+
+
+
+
+# Container archives of the worker processes, one per root directory
+_archives = {}
+
+def pack_step(frame):
+    """
+    Processing step (see pipeline module): appends the (annotated) image to
+    the daily container of its camera. Can replace the step archive.
+
+    Uses config keys 'containers' (root directory) and 'quality' (optional,
+    JPEG quality of annotated images). Sets frame['filename'] to the locator
+    of the frame and size and checksum for the archive index.
+    """
+    root = frame['config']['containers']
+    if root not in _archives: _archives[root] = pack_archive(root)
+
+    if 'image' in frame:
+        buf = io.BytesIO()
+        frame['image'].save(buf, format="JPEG",
+            quality=frame['config'].get('quality', 95))
+        data = buf.getvalue()
+    else:
+        data = frame['data']
+
+    frame['filename'] = _archives[root].append(frame['dt'],
+        frame['camera'] or "camera", data)
+    frame.setdefault('index', {})
+    frame['index']['size'] = len(data)
+    frame['index']['checksum'] = archive.checksum(data)
+
+    return frame
+
+
+
+
+
+def benchmark(root, nframes=2000, size=300000, nreads=2000):
+    """
+    Measures append throughput and random-access latency of a container and
+    compares it with the one file per frame layout.
+
+    :param root: string, directory for the benchmark files (is filled)
+    :param nframes: int, optional, number of frames
+    :param size: int, optional, size of one frame in bytes
+    :param nreads: int, optional, number of random reads
+
+    :returns: dictionary with the results
+    """
+    data = os.urandom(size)
+    t0 = datetime(2016, 8, 12)
+    times = [archive.from_timestamp(archive.to_timestamp(t0) + 10 * i) \
+        for i in range(nframes)]
+    fname = container_name(root, "bench", t0)
+    res = {}
+
+    tic = time.perf_counter()
+    with pack_writer(fname) as writer:
+        for dt in times: writer.append(dt, data)
+    res['pack_append_s'] = (time.perf_counter() - tic) / nframes
+
+    tic = time.perf_counter()
+    for dt in times:
+        dname = root + os.sep + "files" + os.sep + dt.strftime("%Y%m%d")
+        if not os.path.exists(dname): os.makedirs(dname)
+        with open(dname + os.sep + dt.strftime("%Y%m%d_%H%M%S.jpg"), "wb") as f:
+            f.write(data)
+    res['file_append_s'] = (time.perf_counter() - tic) / nframes
+
+    # random reads of whole frames, each opening the container or the file
+    numbers = np.random.randint(0, nframes, nreads)
+    tic = time.perf_counter()
+    for i in numbers:
+        with pack_reader(fname) as reader:
+            bytes(reader.get(reader.find(times[i])))
+    res['pack_read_s'] = (time.perf_counter() - tic) / nreads
+
+    tic = time.perf_counter()
+    for i in numbers:
+        dt = times[i]
+        with open(root + os.sep + "files" + os.sep + dt.strftime("%Y%m%d") \
+                + os.sep + dt.strftime("%Y%m%d_%H%M%S.jpg"), "rb") as f:
+            f.read()
+    res['file_read_s'] = (time.perf_counter() - tic) / nreads
+
+    # the same with an open reader (e.g. archive_reader), no file
+    # counterpart
+    with pack_reader(fname) as reader:
+        tic = time.perf_counter()
+        for i in numbers: bytes(reader.get(reader.find(times[i])))
+        res['pack_read_open_s'] = (time.perf_counter() - tic) / nreads
+
+        tic = time.perf_counter()
+        for i in numbers: reader.find(times[i])
+        res['pack_find_s'] = (time.perf_counter() - tic) / nreads
+    res['pack_throughput_mb'] = size / res['pack_append_s'] / 1e6
+
+    return res
+
+
+
+if __name__ == "__main__":
+
+    import tempfile
+
+    root = sys.argv[1] if len(sys.argv) > 1 else tempfile.mkdtemp()
+    for key, value in sorted(benchmark(root).items()):
+        if key.endswith("_s"):
+            print("%-16s %10.1f us" % (key[:-2], value * 1e6))
+        else:
+            print("%-16s %10.1f" % (key, value))
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module stores per-frame derived features as a chunked, compressed
+column store.
+
+Derived values of each frame like cloud cover, sun-disk saturation, exposure
+settings or the solar angles from camera.solar_data are appended as records.
+Records are buffered and written in chunks, one compressed numpy archive
+(.npz) per chunk with one array per column. The chunks are partitioned by
+camera and day:
+
+    root/<camera>/YYYYMMDD/<tmin>_<tmax>_<pid>_<n>.npz
+
+The first and last time of a chunk are part of its file name, so a time
+range query only opens the chunks overlapping the range and only decompresses
+the requested columns. Several processes can write to the same store, as
+each chunk is written once under a unique name.
+
+Buffered records of a camera and day are also written when the oldest of
+them is older than flush_interval seconds, so a crash loses at most the
+records of this interval.
+
+Times are stored as unix timestamps (UTC, float64) in the column 'time'.
+Missing values of columns missing in some records or chunks are NaN, or
+empty strings for string columns. Values are
+numbers (None is stored as NaN) or strings, other objects are rejected as
+they could not be read without unpickling.
+
+Example::
+
+    store = feature_store("features")
+    store.append("roof", [datetime(2016,8,12,12)], {'cloud_cover': [0.3]})
+    store.flush()
+    data = store.read("roof", datetime(2016,8,1), datetime(2016,9,1),
+        columns=['cloud_cover'])
+
+
+Package requirements:
+    numpy
+"""
+
+import os
+import time
+import threading
+import numpy as np
+
+import archive
+
+
+# Default number of rows per chunk
+CHUNK_SIZE = 4096
+
+# Default maximum age of buffered records in seconds
+FLUSH_INTERVAL = 600
+
+
+
+def _column(name, values):
+    """ Returns the values of a column as array of numbers or strings """
+    values = np.asarray(values)
+    if values.dtype != object: return values
+    try:
+        return np.array([np.nan if v is None else v for v in values.ravel()],
+            dtype=np.float64).reshape(values.shape)
+    except (TypeError, ValueError):
+        raise ValueError("Column %s has values which are neither numbers " \
+            "nor strings" % name)
+
+
+
+def _concatenate(parts, name):
+    """ Concatenates a column of parts (dictionaries with 'time'), parts
+    without the column are filled with NaN, or '' for a string column """
+    present = [p[name] for p in parts if name in p]
+    fill = "" if any(v.dtype.kind in "US" for v in present) else np.nan
+
+    return np.concatenate([p[name] if name in p else \
+        np.full(len(p['time']), fill) for p in parts])
+
+
+
+
+
+class feature_store():
+    """
+    Append-only, chunked column store of per-frame features.
+
+    :param root: string, directory of the store
+    :param chunk_size: int, optional, number of rows per chunk
+    :param flush_interval: float, optional, maximum age in seconds of the
+        oldest buffered record of a camera and day, None to write full
+        chunks only
+    """
+
+    def __init__(self, root, chunk_size=CHUNK_SIZE,
+            flush_interval=FLUSH_INTERVAL):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.buffers = {}
+        self.oldest = {}
+        self.count = 0
+        self.lock = threading.Lock()
+
+
+
+    def append(self, camera, times, columns):
+        """
+        Appends a batch of records (vectorized)
+
+        :param camera: string, camera id
+        :param times: list or array of datetimes or unix timestamps
+        :param columns: dictionary column name -> list or array of values, all
+            of the length of times
+        """
+        ts = np.array([t if isinstance(t, (int, float, np.floating)) else \
+            archive.to_timestamp(t) for t in times], dtype=np.float64)
+        cols = dict((k, _column(k, v)) for k, v in columns.items())
+        for k, v in cols.items():
+            if len(v) != len(ts):
+                raise ValueError("Column %s has %d values for %d times" % \
+                    (k, len(v), len(ts)))
+
+        # partition by day
+        days = (ts // 86400).astype(np.int64)
+        with self.lock:
+            for day in np.unique(days):
+                sel = days == day
+                key = (camera, int(day))
+                buf = self.buffers.setdefault(key, [])
+                self.oldest.setdefault(key, time.monotonic())
+                part = dict((k, v[sel]) for k, v in cols.items())
+                part['time'] = ts[sel]
+                buf.append(part)
+                if sum(len(p['time']) for p in buf) >= self.chunk_size:
+                    self._write(key)
+
+            # age based flush, also of days without new records
+            if self.flush_interval is not None:
+                limit = time.monotonic() - self.flush_interval
+                for key in [k for k, t in self.oldest.items() if t <= limit]:
+                    self._write(key)
+
+
+
+    def append_record(self, camera, dt, record):
+        """
+        Appends a single record
+
+        :param camera: string, camera id
+        :param dt: datetime, acquisition time
+        :param record: dictionary column name -> value
+        """
+        self.append(camera, [dt], dict((k, [v]) for k, v in record.items()))
+
+
+
+    def _write(self, key):
+        """ Writes the buffered rows of a camera and day as one chunk """
+        parts = self.buffers.pop(key, [])
+        self.oldest.pop(key, None)
+        if not parts: return
+
+        names = set()
+        for p in parts: names.update(p)
+        data = dict((name, _concatenate(parts, name)) for name in names)
+
+        order = np.argsort(data['time'], kind='stable')
+        for name in data: data[name] = data[name][order]
+
+        camera, day = key
+        dname = self.root + os.sep + camera + os.sep + \
+            archive.from_timestamp(day * 86400).strftime("%Y%m%d")
+        if not os.path.exists(dname): os.makedirs(dname, exist_ok=True)
+        self.count += 1
+        fname = dname + os.sep + "%.3f_%.3f_%d_%d.npz" % (data['time'][0],
+            data['time'][-1], os.getpid(), self.count)
+        tmp = fname + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez_compressed(f, **data)
+        os.replace(tmp, fname)
+
+
+
+    def flush(self):
+        """ Writes all buffered records """
+        with self.lock:
+            for key in list(self.buffers): self._write(key)
+
+
+
+    def chunks(self, camera, start=None, end=None):
+        """
+        Returns the chunk files of a camera overlapping a time range
+
+        :param camera: string, camera id
+        :param start: datetime, optional, first time (inclusive)
+        :param end: datetime, optional, last time (exclusive)
+
+        :returns: list of file names
+        """
+        t0 = -np.inf if start is None else archive.to_timestamp(start)
+        t1 = np.inf if end is None else archive.to_timestamp(end)
+        cdir = self.root + os.sep + camera
+        if not os.path.exists(cdir): return []
+
+        files = []
+        for day in sorted(os.listdir(cdir)):
+            if start and day < start.strftime("%Y%m%d"): continue
+            if end and day > end.strftime("%Y%m%d"): break
+            for fname in sorted(os.listdir(cdir + os.sep + day)):
+                if not fname.endswith(".npz"): continue
+                tmin, tmax = [float(x) for x in fname.split("_")[:2]]
+                if tmax < t0 or tmin >= t1: continue
+                files.append(cdir + os.sep + day + os.sep + fname)
+
+        return files
+
+
+
+    def read(self, camera, start=None, end=None, columns=None):
+        """
+        Reads columns of a camera in a time range
+
+        Parameters
+        -----------
+        :param camera: string, camera id
+        :param start: datetime, optional, first time (inclusive)
+        :param end: datetime, optional, last time (exclusive)
+        :param columns: list of strings, optional, columns to read, default
+            all columns
+
+        :returns: dictionary column name -> numpy array, sorted by 'time'
+            (unix timestamps)
+        """
+        t0 = -np.inf if start is None else archive.to_timestamp(start)
+        t1 = np.inf if end is None else archive.to_timestamp(end)
+
+        parts = []
+        for fname in self.chunks(camera, start, end):
+            with np.load(fname) as chunk:
+                ts = chunk['time']
+                sel = (ts >= t0) & (ts < t1)
+                names = chunk.files if columns is None else columns
+                part = {'time': ts[sel]}
+                for name in names:
+                    if name != 'time' and name in chunk.files:
+                        part[name] = chunk[name][sel]
+                parts.append(part)
+
+        names = set(columns if columns else [])
+        names.add('time')
+        for p in parts: names.update(p)
+        if not parts:
+            return dict((name, np.array([])) for name in names)
+
+        data = dict((name, _concatenate(parts, name)) for name in names)
+        order = np.argsort(data['time'], kind='stable')
+
+        return dict((name, values[order]) for name, values in data.items())
+
+
+
+    def close(self):
+        self.flush()
+
+
+
+    def __enter__(self):
+        return self
+
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module detects frozen cameras and duplicate frames.
+
+After a firmware hiccup Vivotek cameras sometimes keep serving the same stale
+image. To detect this already in the capture loop, a cheap fingerprint of
+each downloaded frame is computed:
+
+    - a byte hash (SHA-1) of the encoded image, identical for a stale image
+    - a perceptual hash (64 bit DCT hash) of a small grayscale thumbnail,
+      similar for visually similar images
+
+The thumbnail is decoded with DCT scaling (1/8) in grayscale, so the
+perceptual hash costs only a few milliseconds per frame.
+
+Consecutive frames with the same byte hash are duplicates, several
+duplicates in a row mean the camera is frozen. Frames whose perceptual hash
+differs in only a few bits from the previous frame are near duplicates; at
+night or under uniform overcast this is normal, therefore near duplicates are
+only flagged. The detector counts frames, duplicates and frozen events for
+monitoring (see frozen_detector.stats).
+
+
+Package requirements:
+    PIL, numpy
+"""
+
+import io
+import numpy as np
+
+import archive
+
+
+# Size of the thumbnail the DCT is computed on
+HASH_SIZE = 32
+
+# Number of low frequency DCT coefficients per axis used for the hash
+HASH_BITS = 8
+
+# Values of the index column 'duplicate'
+UNIQUE = 0
+NEAR_DUPLICATE = 1
+DUPLICATE = 2
+
+
+
+def _dct_matrix(n):
+    """ Returns the orthonormal DCT-II matrix of size n """
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2. * n)) * np.sqrt(2. / n)
+    m[0] /= np.sqrt(2.)
+
+    return m
+
+_DCT = _dct_matrix(HASH_SIZE)
+
+
+
+def phash(img):
+    """
+    Computes a 64 bit perceptual hash (DCT hash) of an image
+
+    The image is decoded in grayscale at 1/8 size, resized to 32x32 pixels
+    and transformed by a 2D DCT. Each bit of the hash tells whether one of the
+    8x8 lowest frequency coefficients is above their median.
+
+    :param img: bytes, file name, file object or PIL image
+
+    :returns: int, hash
+    """
+    from PIL import Image
+
+    if isinstance(img, (bytes, bytearray, memoryview)):
+        img = io.BytesIO(img)
+    if not isinstance(img, Image.Image):
+        img = Image.open(img)
+        img.draft("L", (img.size[0] // 8, img.size[1] // 8))
+    small = img.convert("L").resize((HASH_SIZE, HASH_SIZE), Image.BILINEAR)
+
+    pixels = np.asarray(small, dtype=np.float64)
+    coeffs = (_DCT.dot(pixels).dot(_DCT.T))[:HASH_BITS, :HASH_BITS].ravel()
+    bits = coeffs > np.median(coeffs[1:])
+
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+
+def distance(hash1, hash2):
+    """ Returns the number of different bits of two hashes (Hamming) """
+    return bin(hash1 ^ hash2).count("1")
+
+
+
+def fingerprint(data):
+    """
+    Returns byte hash and perceptual hash of an encoded image
+
+    :param data: bytes, encoded image
+
+    :returns: (string, int), SHA-1 hex digest and perceptual hash
+    """
+    return archive.checksum(data), phash(data)
+
+
+
+
+
+class frozen_detector():
+    """
+    Compares each frame with its predecessor to detect duplicate frames and
+    frozen cameras.
+
+    :param threshold: int, optional, maximum Hamming distance of perceptual
+        hashes for near duplicates (default 2)
+    :param frozen_after: int, optional, number of consecutive byte identical
+        frames after which the camera is regarded as frozen (default 3)
+    """
+
+    def __init__(self, threshold=2, frozen_after=3):
+        self.threshold = threshold
+        self.frozen_after = frozen_after
+        self.last_checksum = None
+        self.last_phash = None
+        self.repeats = 0
+        self.frozen = False
+
+        # statistics
+        self.frames = 0
+        self.duplicates = 0
+        self.near_duplicates = 0
+        self.frozen_events = 0
+        self.errors = 0
+
+
+
+    def check(self, data):
+        """
+        Fingerprints a frame and compares it with the previous frame
+
+        :param data: bytes, encoded image
+
+        :returns: dictionary with 'checksum', 'phash' (hex string, None if
+            the frame could not be decoded), 'distance' (to previous frame,
+            None for the first frame or without phash), 'duplicate'
+            (UNIQUE, NEAR_DUPLICATE or DUPLICATE), 'repeats' (number of
+            consecutive byte identical frames before) and 'frozen' (boolean)
+        """
+        chk = archive.checksum(data)
+        self.frames += 1
+
+        if chk == self.last_checksum:
+            # identical bytes, no need to decode
+            ph = self.last_phash
+            dist = 0
+            dup = DUPLICATE
+            self.duplicates += 1
+            self.repeats += 1
+        else:
+            try:
+                ph = phash(data)
+            except Exception as e:
+                # truncated or corrupt download, the frame is passed on
+                print('Perceptual hash of frame failed -> ', repr(e))
+                ph = None
+                self.errors += 1
+            dist = None if ph is None or self.last_phash is None else \
+                distance(ph, self.last_phash)
+            dup = NEAR_DUPLICATE if dist is not None and \
+                dist <= self.threshold else UNIQUE
+            if dup == NEAR_DUPLICATE: self.near_duplicates += 1
+            self.repeats = 0
+
+        frozen = self.repeats >= self.frozen_after
+        if frozen and not self.frozen:
+            print('Camera seems to be frozen, ', self.repeats + 1, \
+                ' identical frames')
+            self.frozen_events += 1
+        self.frozen = frozen
+
+        self.last_checksum = chk
+        self.last_phash = ph
+
+        return {
+            'checksum': chk,
+            'phash': None if ph is None else "%016x" % ph,
+            'distance': dist,
+            'duplicate': dup,
+            'repeats': self.repeats,
+            'frozen': frozen,
+        }
+
+
+
+    def stats(self):
+        """
+        Returns the counters of the detector
+
+        :returns: dictionary with 'frames', 'duplicates', 'near_duplicates',
+            'frozen_events', 'errors' (frames which could not be decoded) and
+            'frozen' (current state, 0 or 1)
+        """
+        return {
+            'frames': self.frames,
+            'duplicates': self.duplicates,
+            'near_duplicates': self.near_duplicates,
+            'frozen_events': self.frozen_events,
+            'errors': self.errors,
+            'frozen': int(self.frozen),
+        }
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module describes a fleet of cameras in a manifest file.
+
+A site with many cameras is described by one manifest (JSON, or YAML if
+PyYAML is installed) instead of copies of the acquisition script:
+
+    {
+        "defaults": {"model": "vivotek", "user": "admin", "passwd": "...",
+                     "retries": 2, "latitude": 53.13, "longitude": 8.13},
+        "cameras": [
+            {"name": "roof", "ip": "192.168.1.10", "port": 443},
+            {"name": "tower", "ip": "192.168.1.11", "model": "mobotix",
+             "textstring": "Tower"}
+        ]
+    }
+
+Each camera entry is merged with the defaults. The keys model, ip, port,
+http, https, user, passwd, name, retries, backoff and state_ttl create the
+driver (see camera.register for adding models), all further keys (latitude,
+longitude, outdir, textstring, ...) are kept as configuration of the camera.
+
+The cameras of a fleet share the SSL contexts, the metrics registry, the
+tracing hooks and one thread pool for requests to all cameras at once:
+
+    site = fleet.load("fleet.json")
+    images = site.map(lambda cam: cam.download_image())
+
+The settings of all cameras are read back with one request per camera
+(read_state), an audit compares them with the expected values.
+
+
+Package requirements:
+    none (python standard library), PyYAML for YAML manifests
+"""
+
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import camera
+
+
+# Manifest keys passed to the camera driver
+DRIVER_KEYS = ("ip", "port", "http", "https", "user", "passwd", "name",
+    "retries", "backoff", "state_ttl")
+
+
+
+def read_manifest(fname):
+    """
+    Reads a manifest file (.json, .yaml or .yml)
+
+    :returns: dictionary with 'defaults' and 'cameras'
+    """
+    with open(fname) as f:
+        if os.path.splitext(fname)[1].lower() in (".yaml", ".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("PyYAML is required for YAML manifests, " \
+                    "install it or use JSON")
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    if isinstance(manifest, list): manifest = {'cameras': manifest}
+
+    return manifest
+
+
+
+def load(fname, workers=None, outdir=None):
+    """
+    Creates a fleet from a manifest file
+
+    :param fname: string, manifest file
+    :param workers: int, optional, threads for requests to all cameras
+    :param outdir: string, optional, cameras without an outdir in the
+        manifest store their images in outdir/<camera name>
+    """
+    manifest = read_manifest(fname)
+    site = fleet(workers=workers)
+    defaults = manifest.get('defaults', {})
+    for entry in manifest.get('cameras', []):
+        cam = site.add_entry(dict(defaults, **entry))
+        if outdir and not site.settings(cam.name, 'outdir'):
+            site.config[cam.name]['outdir'] = outdir + os.sep + cam.name
+
+    return site
+
+
+
+
+
+class fleet():
+    """
+    Collection of camera objects with their configuration
+
+    :param cameras: list, optional, camera objects
+    :param workers: int, optional, threads for requests to all cameras
+        (default one per camera, at most 64)
+    """
+
+    def __init__(self, cameras=(), workers=None):
+        self.cameras = {}
+        self.config = {}
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+        for cam in cameras: self.add(cam)
+
+
+
+    def add(self, cam, **config):
+        """
+        Adds a camera object
+
+        :param cam: camera object (see camera.driver)
+        :param config: further settings of the camera (latitude, ...)
+        """
+        if cam.name in self.cameras:
+            raise ValueError("Camera name '%s' used twice" % cam.name)
+        self.cameras[cam.name] = cam
+        self.config[cam.name] = config
+
+        return cam
+
+
+
+    def add_entry(self, entry):
+        """
+        Adds a camera described by a manifest entry
+
+        :param entry: dictionary with model, driver arguments and settings
+        """
+        entry = dict(entry)
+        model = entry.pop('model', 'vivotek')
+        if not entry.get('ip'):
+            raise ValueError("Manifest entry without ip: %r" % entry)
+        kwargs = dict((k, entry.pop(k)) for k in DRIVER_KEYS if k in entry)
+
+        return self.add(camera.create(model, **kwargs), **entry)
+
+
+
+    def __len__(self):
+        return len(self.cameras)
+
+
+
+    def __iter__(self):
+        return iter(list(self.cameras.values()))
+
+
+
+    def __getitem__(self, name):
+        return self.cameras[name]
+
+
+
+    def settings(self, name, key, default=None):
+        """ Returns a setting of a camera """
+        return self.config[name].get(key, default)
+
+
+
+    def map(self, function, cameras=None):
+        """
+        Calls a function with each camera in the shared thread pool
+
+        :param function: function called with a camera object
+        :param cameras: list, optional, subset of camera objects
+
+        :returns: dictionary camera name -> result, or the exception raised
+            by the function
+        """
+        cameras = list(self) if cameras is None else list(cameras)
+        if not cameras: return {}
+
+        with self.lock:
+            if self.executor is None:
+                workers = self.workers if self.workers else \
+                    min(64, max(1, len(self)))
+                self.executor = ThreadPoolExecutor(max_workers=workers,
+                    thread_name_prefix="fleet")
+        futures = [(cam.name, self.executor.submit(function, cam)) \
+            for cam in cameras]
+
+        results = {}
+        for name, future in futures:
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                results[name] = e
+
+        return results
+
+
+
+    def read_state(self, ttl=None):
+        """
+        Reads the settings of all cameras in parallel (see camera.driver),
+        cameras with a valid mirror are not requested
+
+        :param ttl: float, optional, maximum age of the mirrors in seconds,
+            0 to read all cameras
+
+        :returns: dictionary camera name -> settings (or exception)
+        """
+        return self.map(lambda cam: cam.get_state(ttl))
+
+
+
+    def audit(self, **expected):
+        """
+        Compares the settings of all cameras with expected values
+
+        :param expected: generic setting -> value, e.g. exposure_level=6
+
+        :returns: dictionary camera name -> dictionary setting -> (expected,
+            actual), only cameras with differences (or exceptions)
+        """
+        results = self.map(lambda cam: cam.audit(**expected))
+
+        return dict((k, v) for k, v in results.items() if v)
+
+
+
+    def close(self):
+        """ Stops the thread pool """
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module serves the latest frame of each camera via HTTP from memory.
+
+Clients polling the camera directly multiply the load on its weak CPU, and
+clients polling current.jpg the load on the disk. Instead, the capture loop
+publishes each downloaded frame, and a small HTTP server hands it out to any
+number of clients; the camera serves exactly one client.
+
+Endpoints (camera = camera id):
+
+    /cameras                    JSON, cameras with sequence number and time
+                                of their latest frame
+    /<camera>/latest.jpg        latest frame, ?scale=2, 4 or 8 for a level of
+                                the preview pyramid (DCT scaled, see preview
+                                module, computed once per frame and level)
+    /<camera>/latest.json       metadata of the latest frame
+    /<camera>/wait?after=<seq>  long-poll: answers with the metadata as soon
+                                as a frame newer than seq is published
+                                (timeout=<s>, default 30, 204 on timeout)
+    /<camera>/events            server-sent events: one event "frame" with
+                                the metadata per published frame
+
+The server binds to the local host unless another address is given. The
+images carry an ETag (checksum of the frame and level), requests with a
+matching If-None-Match header are answered with 304 Not Modified.
+
+Example::
+
+    frames = latest_frames()
+    frames.serve(8080)
+    ...
+    frames.publish(cam.name, data, dt=dt, zenith=zenith)
+
+
+Package requirements:
+    PIL (pyramid levels only)
+"""
+
+import io
+import json
+import time
+import threading
+import urllib.parse
+from datetime import datetime
+
+import archive
+
+
+# Pyramid levels served in addition to the full frame
+LEVELS = (2, 4, 8)
+
+
+
+def _json(value):
+    if isinstance(value, datetime): return value.isoformat()
+
+    return str(value)
+
+
+
+
+
+class latest_frames():
+    """
+    Latest frame per camera, published by the capture loop
+
+    :param quality: int, optional, JPEG quality of the pyramid levels
+    """
+
+    def __init__(self, quality=80):
+        self.quality = quality
+        self.frames = {}
+        self.levels = {}
+        self.condition = threading.Condition()
+        self.published = 0
+
+
+
+    def publish(self, camera, data, dt=None, **meta):
+        """
+        Publishes a frame
+
+        :param camera: string, camera id
+        :param data: bytes, encoded image
+        :param dt: datetime, optional, time of the frame (UTC)
+        :param meta: further metadata (zenith, exposure_level, ...)
+
+        :returns: int, sequence number of the frame
+        """
+        with self.condition:
+            last = self.frames.get(camera)
+            seq = last['meta']['seq'] + 1 if last else 1
+            info = dict(meta)
+            info['camera'] = camera
+            info['seq'] = seq
+            info['dt'] = dt if dt else datetime.utcnow()
+            info['size'] = len(data)
+            self.frames[camera] = {'data': data, 'meta': info,
+                'etag': archive.checksum(data)[:20]}
+            self.levels.pop(camera, None)
+            self.published += 1
+            self.condition.notify_all()
+
+        return seq
+
+
+
+    def cameras(self):
+        """ Returns the metadata of the latest frame of each camera """
+        with self.condition:
+            return dict((k, v['meta']) for k, v in self.frames.items())
+
+
+
+    def get(self, camera, scale=1):
+        """
+        Returns the latest frame of a camera
+
+        :param camera: string, camera id
+        :param scale: int, optional, level of the preview pyramid
+
+        :returns: (bytes, etag, metadata) or None
+        """
+        import preview
+
+        with self.condition:
+            frame = self.frames.get(camera)
+        if frame is None: return None
+        etag = '"%s-%d"' % (frame['etag'], scale)
+        if scale == 1: return frame['data'], etag, frame['meta']
+
+        # levels are computed once per frame, outside of the lock
+        key = (frame['meta']['seq'], scale)
+        levels = self.levels.get(camera, {})
+        data = levels.get(key)
+        if data is None:
+            image = preview.open_scaled(io.BytesIO(frame['data']), scale)
+            buf = io.BytesIO()
+            image.save(buf, "JPEG", quality=self.quality)
+            data = buf.getvalue()
+            with self.condition:
+                if self.frames.get(camera) is frame:
+                    self.levels.setdefault(camera, {})[key] = data
+
+        return data, etag, frame['meta']
+
+
+
+    def wait(self, camera, after, timeout=None):
+        """
+        Waits for a frame with a sequence number above after
+
+        :returns: metadata of the latest frame or None after the timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                frame = self.frames.get(camera)
+                if frame is not None and frame['meta']['seq'] > after:
+                    return frame['meta']
+                remaining = None if deadline is None else \
+                    deadline - time.monotonic()
+                if remaining is not None and remaining <= 0: return None
+                self.condition.wait(remaining)
+
+
+
+    def stats(self):
+        """ Returns the number of cameras and published frames """
+        with self.condition:
+            return {'cameras': len(self.frames), 'published': self.published}
+
+
+
+    def serve(self, port=8080, address="127.0.0.1"):
+        """
+        Serves the frames via HTTP in a background thread
+
+        :param port: int, optional, TCP port
+        :param address: string, optional, address to bind, default the local
+            host only, "" for all interfaces
+
+        :returns: the HTTP server object, stop it with shutdown()
+        """
+        import http.server
+        frames = self
+
+        class handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def send_json(self, value, code=200):
+                body = json.dumps(value, default=_json).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                parts = [urllib.parse.unquote(p) for p in \
+                    url.path.strip("/").split("/")]
+                try:
+                    if parts == ["cameras"]:
+                        return self.send_json(frames.cameras())
+                    if len(parts) != 2:
+                        return self.send_error(404)
+                    camera, resource = parts
+                    if resource == "latest.jpg":
+                        return self.image(camera, int(query.get("scale", 1)))
+                    if resource == "latest.json":
+                        frame = frames.get(camera)
+                        if frame is None: return self.send_error(404)
+                        return self.send_json(frame[2])
+                    if resource == "wait":
+                        meta = frames.wait(camera, int(query.get("after", 0)),
+                            float(query.get("timeout", 30)))
+                        if meta is None:
+                            self.send_response(204)
+                            self.send_header("Content-Length", "0")
+                            self.end_headers()
+                            return
+                        return self.send_json(meta)
+                    if resource == "events":
+                        return self.events(camera)
+                    self.send_error(404)
+                except ValueError:
+                    self.send_error(400)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def image(self, camera, scale):
+                if scale != 1 and scale not in LEVELS:
+                    return self.send_error(400, "scale must be 1, 2, 4 or 8")
+                frame = frames.get(camera, scale)
+                if frame is None: return self.send_error(404)
+                data, etag, meta = frame
+                if etag in [t.strip() for t in \
+                        self.headers.get("If-None-Match", "").split(",")]:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("X-Frame-Sequence", str(meta['seq']))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def events(self, camera):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                frame = frames.get(camera)
+                seq = frame[2]['seq'] if frame else 0
+                while True:
+                    meta = frames.wait(camera, seq, timeout=15)
+                    if meta is None:
+                        # keep-alive comment
+                        self.wfile.write(b": keep-alive\n\n")
+                    else:
+                        seq = meta['seq']
+                        self.wfile.write(("event: frame\nid: %d\ndata: %s\n\n" \
+                            % (seq, json.dumps(meta, default=_json))).encode(
+                            "utf-8"))
+                    self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((address, port), handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True,
+            name="frame-http")
+        thread.start()
+
+        return server
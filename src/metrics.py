@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module collects metrics of the image acquisition and exposes them in
+the Prometheus text format.
+
+The camera classes and the acquisition service record into the default
+registry (REGISTRY):
+
+    camera_request_seconds      histogram of request latency per camera and
+                                operation (download, set_exposure_level, ...)
+    camera_requests_total       requests per camera, operation and result
+                                (success, timeout, http_error, url_error)
+    camera_received_bytes_total bytes received per camera
+    camera_frame_bytes          histogram of frame sizes per camera
+    camera_first_byte_seconds   histogram of the time from request to
+                                response header of downloads (capture window)
+    camera_clock_offset_seconds estimated offset of the camera clock
+    camera_retries_total        repeated requests per camera and operation
+    camera_param_changes_total  settings changed outside of the driver
+    acquire_slots_total         served acquisition slots
+    acquire_missed_slots_total  missed acquisition slots
+    acquire_schedule_lag_seconds  histogram of wake-up delay after the slot
+
+Counters of other components (pipeline, frozen frame detector, retention)
+are collected when the metrics are exposed, see add_collector, so they cost
+nothing on the hot path. Recording a value costs a dictionary lookup and a
+short lock.
+
+The metrics can be exposed by a small HTTP server (serve, path /metrics,
+bound to the local host unless another address is given) or written to a
+file for the textfile collector of the node exporter (write_textfile).
+
+
+Package requirements:
+    none (python standard library)
+"""
+
+import os
+import bisect
+import threading
+
+
+# Default histogram buckets (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Buckets of frame sizes (bytes)
+SIZE_BUCKETS = (1e4, 3e4, 1e5, 2e5, 3e5, 5e5, 1e6, 2e6, 5e6)
+
+
+
+def _labels(labels):
+    """ Formats a label dictionary (sorted) """
+    if not labels: return ""
+    items = []
+    for k, v in sorted(labels.items()):
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        items.append('%s="%s"' % (k, v))
+
+    return "{" + ",".join(items) + "}"
+
+
+
+def _value(v):
+    if v == float("inf"): return "+Inf"
+
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+
+
+
+class registry():
+    """
+    Collection of counters, gauges and histograms
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.help = {}
+        self.types = {}
+        self.values = {}
+        self.histograms = {}
+        self.collectors = []
+
+
+
+    def _declare(self, name, kind, help):
+        if name not in self.types:
+            self.types[name] = kind
+            self.help[name] = help
+
+
+
+    def inc(self, name, value=1, help="", **labels):
+        """ Increases a counter """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._declare(name, "counter", help)
+            self.values[key] = self.values.get(key, 0) + value
+
+
+
+    def set(self, name, value, help="", **labels):
+        """ Sets a gauge """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self._declare(name, "gauge", help)
+            self.values[key] = value
+
+
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, help="",
+            **labels):
+        """ Records a value in a histogram """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                self._declare(name, "histogram", help)
+                hist = self.histograms[key] = [tuple(buckets),
+                    [0] * (len(buckets) + 1), 0.]
+            hist[1][bisect.bisect_left(hist[0], value)] += 1
+            hist[2] += value
+
+
+
+    def add_collector(self, prefix, stats, help="", **labels):
+        """
+        Registers a function returning a dictionary of numbers (e.g. the
+        stats method of a pipeline), exported as gauges prefix_<key> when the
+        metrics are exposed
+
+        :param prefix: string, prefix of the metric names
+        :param stats: function without arguments returning a dictionary
+        :param labels: labels of the metrics
+        """
+        with self.lock:
+            self.collectors.append((prefix, stats, help, labels))
+
+
+
+    def get(self, name, **labels):
+        """ Returns the current value of a counter or gauge (or None) """
+        return self.values.get((name, tuple(sorted(labels.items()))))
+
+
+
+    def expose(self):
+        """
+        Returns all metrics in the Prometheus text format
+
+        :returns: string
+        """
+        with self.lock:
+            values = dict(self.values)
+            histograms = dict((k, (h[0], list(h[1]), h[2])) \
+                for k, h in self.histograms.items())
+            types = dict(self.types)
+            helps = dict(self.help)
+            collectors = list(self.collectors)
+
+        for prefix, stats, help, labels in collectors:
+            try:
+                for k, v in stats().items():
+                    if not isinstance(v, (int, float)): continue
+                    name = prefix + "_" + k
+                    types.setdefault(name, "gauge")
+                    helps.setdefault(name, help)
+                    values[(name, tuple(sorted(labels.items())))] = v
+            except Exception as e:
+                print('Metrics collector ', prefix, ' failed -> ', repr(e))
+
+        lines = []
+        for name in sorted(types):
+            if helps.get(name): lines.append("# HELP %s %s" % (name, helps[name]))
+            lines.append("# TYPE %s %s" % (name, types[name]))
+            if types[name] == "histogram":
+                for (n, labels), (buckets, counts, total) in \
+                        sorted(histograms.items()):
+                    if n != name: continue
+                    labels = dict(labels)
+                    cum = 0
+                    for le, c in zip(list(buckets) + [float("inf")], counts):
+                        cum += c
+                        lines.append("%s_bucket%s %d" % (name,
+                            _labels(dict(labels, le=_value(le))), cum))
+                    lines.append("%s_sum%s %s" % (name, _labels(labels),
+                        _value(total)))
+                    lines.append("%s_count%s %d" % (name, _labels(labels), cum))
+            else:
+                for (n, labels), v in sorted(values.items(),
+                        key=lambda x: (x[0][0], x[0][1])):
+                    if n != name: continue
+                    lines.append("%s%s %s" % (name, _labels(dict(labels)),
+                        _value(v)))
+
+        return "\n".join(lines) + "\n"
+
+
+
+    def write_textfile(self, fname):
+        """
+        Writes the metrics atomically to a file (node exporter textfile
+        collector, file name must end with .prom)
+        """
+        tmp = fname + ".%d.tmp" % os.getpid()
+        with open(tmp, "w") as f:
+            f.write(self.expose())
+        os.replace(tmp, fname)
+
+
+
+    def serve(self, port=9110, address="127.0.0.1"):
+        """
+        Serves the metrics via HTTP (path /metrics) in a background thread
+
+        :param port: int, optional, TCP port
+        :param address: string, optional, address to bind, default the local
+            host only, "" for all interfaces
+
+        :returns: the HTTP server object, stop it with shutdown()
+        """
+        import http.server
+        reg = self
+
+        class handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = reg.expose().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                    "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((address, port), handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True,
+            name="metrics-http")
+        thread.start()
+
+        return server
+
+
+
+# Default registry used by the camera classes and the acquisition service
+REGISTRY = registry()
@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module decouples image capture from image processing.
+
+The capture loop should only download the raw JPEG bytes of a frame (see
+camera.download_image) and hand them over to the pipeline. Decoding, drawing
+text, archiving and derived products are done by a pool of worker processes,
+so slow processing steps never delay the next frame.
+
+It consists of
+    - a bounded frame buffer with back-pressure policies (frame_buffer)
+    - a pipeline running processing steps in a process pool (pipeline)
+    - default processing steps (decode, mask, annotate, archive, previews)
+
+Back-pressure policies of the frame buffer, used if the workers are slower
+than the capture:
+
+    BLOCK        capture waits until there is room in the buffer
+    DROP_OLDEST  the oldest waiting frame is discarded
+    SPILL        frames are written to a spill directory and processed later
+
+A processing step is a module level function (it has to be pickled to be sent
+to the worker processes) which receives and returns a frame dictionary with
+the keys
+
+    'data'      bytes, the encoded image as delivered by the camera
+    'dt'        datetime, acquisition time (UTC)
+    'camera'    string, camera id
+    'config'    dictionary, settings of the steps (e.g. outdir, textstring)
+
+and optionally 'capture_time' (datetime, estimated time of exposure) and
+'capture_uncertainty' (seconds), see camera.driver.capture. The acquisition
+time 'dt' is the scheduled slot and names the archive files.
+
+Steps may add further keys, e.g. 'image' (decoded PIL image) or 'filename'.
+
+
+Package requirements:
+    PIL
+"""
+
+import os
+import io
+import json
+import threading
+import collections
+import concurrent.futures
+from datetime import datetime
+
+import tracing
+
+
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+SPILL = "spill"
+
+POLICIES = (BLOCK, DROP_OLDEST, SPILL)
+
+# masks of the mask step per worker process, (source, size) -> PIL image
+_masks = {}
+
+
+
+class frame_buffer():
+    """
+    Thread-safe bounded FIFO buffer of frames between capture and processing.
+
+    :param maxsize: int, maximum number of frames kept in memory (at least 1)
+    :param policy: string, back-pressure policy (block, drop-oldest, spill)
+    :param spill_dir: string, directory for spilled frames (policy spill only)
+    """
+
+    def __init__(self, maxsize=16, policy=BLOCK, spill_dir=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown back-pressure policy %s, use one of %s" \
+                % (policy, POLICIES))
+        if maxsize < 1:
+            raise ValueError("The frame buffer needs a size of at least 1")
+        if policy == SPILL and not spill_dir:
+            raise ValueError("Policy spill needs a spill directory")
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.frames = collections.deque()
+        self.spilled = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.count = 0
+
+        # statistics
+        self.dropped = 0
+        self.nspilled = 0
+
+        if policy == SPILL and not os.path.exists(spill_dir): os.makedirs(spill_dir)
+
+
+
+    def __len__(self):
+        with self.cond:
+            return len(self.frames) + len(self.spilled)
+
+
+
+    def _spill(self, frame):
+        """ Writes the frame data to the spill directory and keeps the rest """
+        self.count += 1
+        fname = self.spill_dir + os.sep + "%012d.jpg" % self.count
+        with open(fname, "wb") as f:
+            f.write(frame['data'])
+        meta = dict(frame)
+        meta['data'] = fname
+        self.spilled.append(meta)
+        self.nspilled += 1
+
+
+
+    def _unspill(self, meta):
+        """ Reads a spilled frame back into memory """
+        frame = dict(meta)
+        with open(meta['data'], "rb") as f:
+            frame['data'] = f.read()
+        os.remove(meta['data'])
+
+        return frame
+
+
+
+    def put(self, frame, timeout=None):
+        """
+        Adds a frame to the buffer, applying the back-pressure policy if full.
+
+        :param frame: dictionary, frame (see module description)
+        :param timeout: float, optional, maximum blocking time (policy block)
+
+        :returns: boolean, False if the frame could not be stored
+        """
+        with self.cond:
+            if self.closed: return False
+
+            if len(self.frames) >= self.maxsize or self.spilled:
+                if self.policy == DROP_OLDEST:
+                    self.frames.popleft()
+                    self.dropped += 1
+                elif self.policy == SPILL:
+                    # keep FIFO order as long as there are spilled frames
+                    self._spill(frame)
+                    self.cond.notify()
+                    return True
+                else:
+                    ok = self.cond.wait_for(lambda: self.closed or \
+                        len(self.frames) < self.maxsize, timeout)
+                    if not ok or self.closed:
+                        self.dropped += 1
+                        return False
+
+            self.frames.append(frame)
+            self.cond.notify()
+
+        return True
+
+
+
+    def get(self, timeout=None):
+        """
+        Removes and returns the oldest frame.
+
+        :param timeout: float, optional, maximum waiting time
+
+        :returns frame: dictionary or None if timed out or buffer closed and
+            empty
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.frames or self.spilled \
+                or self.closed, timeout)
+            if self.frames:
+                frame = self.frames.popleft()
+            elif self.spilled:
+                frame = self._unspill(self.spilled.popleft())
+            else:
+                return None
+            self.cond.notify_all()
+
+        return frame
+
+
+
+    def close(self, discard=False):
+        """
+        No new frames are accepted, waiting frames can still be read
+
+        :param discard: boolean, optional, discard the waiting frames (counted
+            as dropped) instead
+        """
+        with self.cond:
+            self.closed = True
+            if discard:
+                self.dropped += len(self.frames) + len(self.spilled)
+                self.frames.clear()
+                while self.spilled:
+                    fname = self.spilled.popleft()['data']
+                    if os.path.exists(fname): os.remove(fname)
+            self.cond.notify_all()
+
+
+
+
+
+def run_steps(frame, steps):
+    """
+    Runs the processing steps on a frame. This function is executed in the
+    worker processes.
+
+    :param frame: dictionary, frame
+    :param steps: list of step functions
+
+    :returns frame: dictionary without image data ('data', 'image'), to keep
+        the transfer back to the main process small
+    """
+    with tracing.frame(frame['camera'], frame['dt']):
+        for step in steps:
+            with tracing.span("step." + step.__name__):
+                frame = step(frame)
+            if frame is None: return None
+
+    frame.pop('data', None)
+    frame.pop('image', None)
+
+    return frame
+
+
+
+
+
+def decode(frame):
+    """ Processing step: decodes the JPEG bytes into a PIL image ('image') """
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(frame['data']))
+    image.load()
+    frame['image'] = image
+
+    return frame
+
+
+
+def _mask(config, size):
+    """ Returns the mask (PIL image mode "L") of the mask step or None """
+    from PIL import Image, ImageDraw
+
+    source = config.get('mask')
+    if not source: return None
+    key = (json.dumps(source, sort_keys=True), size)
+    if key not in _masks:
+        if isinstance(source, dict):
+            # fisheye geometry, pixels above the horizon
+            fx = size[0] / float(source['size'][0])
+            fy = size[1] / float(source['size'][1])
+            (cx, cy), r = source['center'], source['radius']
+            mask = Image.new("L", size, 0)
+            ImageDraw.Draw(mask).ellipse(((cx - r) * fx, (cy - r) * fy,
+                (cx + r) * fx, (cy + r) * fy), fill=255)
+        else:
+            mask = Image.open(source).convert("L")
+            if mask.size != size: mask = mask.resize(size)
+        _masks[key] = mask
+        while len(_masks) > 8: _masks.pop(next(iter(_masks)))
+
+    return _masks[key]
+
+
+
+def mask(frame):
+    """
+    Processing step: sets the pixels outside the camera mask to black, e.g.
+    obstructions and the area below the horizon.
+
+    Uses config key 'mask', either an image file (pixels to keep are
+    non-zero) or fisheye parameters as dictionary (see sunglare.fisheye,
+    pixels above the horizon are kept). Frames of cameras without mask are
+    not changed. The mask is built once per worker process and image size.
+    """
+    from PIL import Image
+
+    if 'image' not in frame: frame = decode(frame)
+    image = frame['image']
+    m = _mask(frame['config'], image.size)
+    if m is None: return frame
+    with tracing.span("mask"):
+        frame['image'] = Image.composite(image, Image.new(image.mode,
+            image.size), m)
+
+    return frame
+
+
+
+def annotate(frame):
+    """
+    Processing step: draws date, time and location string into the image.
+
+    Uses config key 'textstring'. Uses the decoded image if the step decode
+    was run before, otherwise the image is decoded here. The estimated
+    capture time is drawn with its uncertainty if the frame has one.
+    """
+    import camera
+
+    img = frame['image'] if 'image' in frame else io.BytesIO(frame['data'])
+    dt = frame.get('capture_time', frame['dt'])
+    image, draw = camera.add_text(img, dt=dt,
+        loc=frame['config'].get('textstring', ""),
+        uncertainty=frame.get('capture_uncertainty'))
+    frame['image'] = image
+
+    return frame
+
+
+
+def archive(frame):
+    """
+    Processing step: saves the (annotated) image in the archive directory
+    outdir/YYYYMMDD/YYYYMMDD_HHMMSS.jpg and updates outdir/current.jpg
+
+    Uses config key 'outdir'. Without a decoded image the raw camera bytes
+    are stored.
+    """
+    outdir = frame['config']['outdir']
+    dt = frame['dt']
+    dname = outdir + os.sep + dt.strftime("%Y%m%d")
+    if not os.path.exists(dname): os.makedirs(dname, exist_ok=True)
+    fname = dname + os.sep + dt.strftime("%Y%m%d_%H%M%S.jpg")
+
+    with tracing.span("save"):
+        if 'image' in frame:
+            frame['image'].save(fname,
+                quality=frame['config'].get('quality', 95))
+        else:
+            with open(fname, "wb") as f:
+                f.write(frame['data'])
+    frame['filename'] = fname
+
+    # replace current image atomically, readers never see a partial file
+    with tracing.span("copy"):
+        tmp = outdir + os.sep + ".current.%d.jpg" % os.getpid()
+        with open(fname, "rb") as src, open(tmp, "wb") as dst:
+            dst.write(src.read())
+        os.replace(tmp, outdir + os.sep + "current.jpg")
+
+    return frame
+
+
+
+def previews(frame):
+    """ Processing step: builds the preview pyramid of the archived image """
+    import preview
+
+    preview.make_pyramid(frame['filename'])
+
+    return frame
+
+
+
+DEFAULT_STEPS = (annotate, archive, previews)
+
+
+
+
+
+class pipeline():
+    """
+    Processes captured frames in a pool of worker processes.
+
+    A dispatcher thread takes frames from the frame buffer and submits them
+    to the process pool. The number of frames in flight is limited to twice
+    the number of workers, all further frames wait in the buffer where the
+    back-pressure policy applies.
+
+    :param steps: list of step functions, default (annotate, archive, previews)
+    :param config: dictionary, settings passed to the steps with each frame
+    :param workers: int, optional, number of worker processes, default number
+        of CPUs
+    :param maxsize: int, optional, size of frame buffer
+    :param policy: string, optional, back-pressure policy
+    :param spill_dir: string, optional, spill directory (policy spill)
+    :param callback: function, optional, called with the processed frame (or
+        the exception) in the main process
+    """
+
+    def __init__(self, steps=DEFAULT_STEPS, config=None, workers=None,
+            maxsize=16, policy=BLOCK, spill_dir=None, callback=None):
+
+        self.steps = list(steps)
+        self.config = config if config else {}
+        self.workers = workers if workers else (os.cpu_count() or 1)
+        self.buffer = frame_buffer(maxsize=maxsize, policy=policy,
+            spill_dir=spill_dir)
+        self.callback = callback
+        self.inflight = threading.BoundedSemaphore(2 * self.workers)
+
+        # statistics, guarded by the lock of the buffer (the done callbacks
+        # run in threads of the executor)
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+        self.executor = None
+        self.thread = None
+
+
+
+    def start(self):
+        """ Starts the worker pool and the dispatcher thread """
+        self.executor = concurrent.futures.ProcessPoolExecutor(self.workers)
+        self.thread = threading.Thread(target=self._dispatch, daemon=True,
+            name="pipeline-dispatcher")
+        self.thread.start()
+
+        return self
+
+
+
+    def submit(self, data, dt=None, camera="", timeout=None, config=None,
+            **kwargs):
+        """
+        Hands a captured frame over to the pipeline. Never decodes or
+        processes the frame itself.
+
+        :param data: bytes, encoded image
+        :param dt: datetime, optional, acquisition time (default now, UTC)
+        :param camera: string, optional, camera id
+        :param timeout: float, optional, maximum blocking time (policy block)
+        :param config: dictionary, optional, settings of this frame
+            overriding the pipeline config (e.g. outdir of the camera)
+        :param kwargs: further entries of the frame dictionary
+
+        :returns: boolean, False if the frame was rejected
+        """
+        frame = dict(kwargs)
+        frame['data'] = data
+        frame['dt'] = dt if dt else datetime.utcnow()
+        frame['camera'] = camera
+        frame['config'] = dict(self.config, **config) if config else self.config
+        if not self.buffer.put(frame, timeout=timeout): return False
+        with self.buffer.cond:
+            self.submitted += 1
+
+        return True
+
+
+
+    def _dispatch(self):
+        """ Dispatcher thread: buffer -> process pool """
+        while True:
+            frame = self.buffer.get()
+            if frame is None: break
+            self.inflight.acquire()
+            try:
+                future = self.executor.submit(run_steps, frame, self.steps)
+            except RuntimeError:
+                # the pool was shut down by close(wait=False)
+                self.inflight.release()
+                with self.buffer.cond:
+                    self.cancelled += 1
+                break
+            future.add_done_callback(self._done)
+
+
+
+    def _done(self, future):
+        """ Called in the main process when a frame is finished """
+        self.inflight.release()
+        if future.cancelled():
+            with self.buffer.cond:
+                self.cancelled += 1
+            return
+        try:
+            result = future.result()
+            with self.buffer.cond:
+                self.processed += 1
+        except Exception as e:
+            print('Processing of frame failed -> ', repr(e))
+            result = e
+            with self.buffer.cond:
+                self.failed += 1
+        if self.callback: self.callback(result)
+
+
+
+    def stats(self):
+        """
+        Returns counters of the pipeline
+
+        :returns: dictionary with 'submitted', 'processed', 'failed',
+            'cancelled', 'dropped', 'spilled' and 'waiting' frames
+        """
+        with self.buffer.cond:
+            return {
+                'submitted': self.submitted,
+                'processed': self.processed,
+                'failed': self.failed,
+                'cancelled': self.cancelled,
+                'dropped': self.buffer.dropped,
+                'spilled': self.buffer.nspilled,
+                'waiting': len(self.buffer.frames) + len(self.buffer.spilled),
+            }
+
+
+
+    def close(self, wait=True):
+        """
+        Stops accepting frames. If wait is True, the waiting frames are still
+        processed and close returns when all frames are done. Otherwise the
+        waiting frames are discarded, frames not yet started are cancelled
+        and close returns without waiting for the frames in process.
+        """
+        self.buffer.close(discard=not wait)
+        if wait:
+            if self.thread: self.thread.join()
+            if self.executor: self.executor.shutdown(wait=True)
+        elif self.executor:
+            try:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+            except TypeError:
+                # python < 3.9
+                self.executor.shutdown(wait=False)
+
+
+
+    def __enter__(self):
+        return self.start()
+
+
+
+    def __exit__(self, *args):
+        self.close()
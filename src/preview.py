@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module generates small previews (image pyramids) of sky images.
+
+Quick-look tools and web dashboards only need small versions of the archived
+frames. Decoding a full resolution JPEG just to show a thumbnail is wasteful,
+therefore the JPEG decoder is put into draft mode. In draft mode libjpeg
+scales the image already in the DCT domain by 1/2, 1/4 or 1/8, which is much
+cheaper than a full decode followed by a resize.
+
+It consists of methods in order to
+    - open a JPEG image downscaled in the DCT domain (open_scaled)
+    - build a pyramid of previews next to an archive image (make_pyramid)
+    - load a preview level, with fallback to the original (load_preview)
+
+The previews are stored next to the archive image with a suffix giving the
+scale factor, e.g.
+
+    20160812_120000.jpg      original
+    20160812_120000_p2.jpg   1/2 of the original size
+    20160812_120000_p4.jpg   1/4
+    20160812_120000_p8.jpg   1/8
+
+
+Package requirements:
+    PIL
+"""
+
+import os
+
+
+# Scale factors supported by the JPEG DCT scaling
+SCALES = (2, 4, 8)
+
+# Suffix of pyramid files
+SUFFIX = "_p"
+
+
+
+def preview_filename(filename, scale):
+    """
+    Returns the filename of a pyramid level of an archive image
+
+    Parameters
+    -----------
+    :param filename: string, path of the archive image
+    :param scale: int, scale factor (2, 4 or 8)
+
+    :returns: string, path of the preview image
+    """
+    base, ext = os.path.splitext(filename)
+
+    return base + SUFFIX + str(scale) + ext
+
+
+
+def is_preview(filename):
+    """
+    Checks if a filename belongs to a pyramid level and not to an original
+    image.
+
+    :param filename: string, path or basename of image
+
+    :returns: boolean
+    """
+    base = os.path.splitext(os.path.basename(filename))[0]
+    for scale in SCALES:
+        if base.endswith(SUFFIX + str(scale)): return True
+
+    return False
+
+
+
+def open_scaled(img, scale=1):
+    """
+    Opens a JPEG image and lets the decoder downscale it in the DCT domain.
+
+    Parameters
+    -----------
+    :param img: string or file object, image to open
+    :param scale: int, optional, scale factor 1, 2, 4 or 8 (default 1)
+
+    :returns image: PIL image object (not loaded yet)
+
+    .. note::
+
+        For other formats than JPEG the draft request is ignored by PIL and the
+        image is returned in full resolution.
+    """
+    from PIL import Image
+
+    image = Image.open(img)
+    if scale > 1:
+        lx, ly = image.size
+        mode = image.mode if image.mode in ("RGB", "L") else "RGB"
+        image.draft(mode, (lx // scale, ly // scale))
+
+    return image
+
+
+
+def make_pyramid(img, scales=SCALES, quality=80, outname=None):
+    """
+    Builds a multi-level preview pyramid of an image.
+
+    The image is decoded only once with DCT scaling to the largest requested
+    level. The smaller levels are derived from this level by box-filter
+    reduction, which is cheap on the already small image.
+
+    Parameters
+    -----------
+    :param img: string or file object, JPEG image
+    :param scales: tuple of int, optional, scale factors, default (2, 4, 8)
+    :param quality: int, optional, JPEG quality of previews (default 80)
+    :param outname: string, optional, name of the archive image the previews
+        belong to. Required if img is a file object, default is img
+
+    :returns files: dictionary scale -> filename of the written previews
+    """
+    from PIL import Image
+
+    if outname is None: outname = img
+    scales = sorted(scales)
+    files = {}
+    if not scales: return files
+
+    image = Image.open(img)
+    lx = image.size[0]
+    mode = image.mode if image.mode in ("RGB", "L") else "RGB"
+    image.draft(mode, (lx // scales[0], image.size[1] // scales[0]))
+    image.load()
+    if image.mode not in ("RGB", "L"): image = image.convert("RGB")
+
+    # the decoder may choose a smaller reduction than requested, e.g. for
+    # non-JPEG input, so the reached scale is taken from the decoded size
+    current = max(1, int(round(lx / float(image.size[0]))))
+
+    for scale in scales:
+        factor = scale // current
+        if factor > 1:
+            image = image.reduce(factor)
+            current = scale
+        fname = preview_filename(outname, scale)
+        image.save(fname, quality=quality)
+        files[scale] = fname
+
+    return files
+
+
+
+def load_preview(filename, scale):
+    """
+    Loads a preview level of an archive image. If the pyramid file does not
+    exist the original is opened with DCT scaling instead.
+
+    Parameters
+    -----------
+    :param filename: string, path of the archive image
+    :param scale: int, scale factor (1, 2, 4 or 8)
+
+    :returns image: PIL image object
+    """
+    from PIL import Image
+
+    if scale > 1:
+        fname = preview_filename(filename, scale)
+        if os.path.exists(fname): return Image.open(fname)
+
+    return open_scaled(filename, scale)
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module builds daily summary products from the stream of frames.
+
+Keograms, daily mosaics and time-lapse videos used to be built by external
+scripts decoding every frame of the YYYYMMDD directories again. The product
+builder instead takes the frames one by one, either during the capture or in
+a single pass over the archive (see build), and decodes them only once in a
+DCT-scaled size (see preview module). The memory is constant, independent of
+the number of frames:
+
+    keogram     one column per acquisition slot of the day, the north-south
+                slice through the zenith of each frame (from the fisheye
+                geometry, see sunglare module, otherwise the center column);
+                the image of the day is allocated once (height x slots of a
+                day)
+    mosaic      a grid of thumbnails, the first frame of every mosaic_step
+                seconds (e.g. 48 tiles every 30 minutes)
+    timelapse   every timelapse_every-th frame is written as numbered JPEG,
+                encoded to a video by ffmpeg (if installed) at the end of the
+                day
+
+The size of the products is fixed by the full resolution of the camera
+(size or geometry) divided by scale. Frames of a lower resolution (see
+adaptive module) are decoded with a smaller DCT scale and resized to it.
+
+The products of a day are written when the first frame of the next day
+arrives or by finish:
+
+    outdir/YYYYMMDD_keogram.jpg
+    outdir/YYYYMMDD_mosaic.jpg
+    outdir/YYYYMMDD_timelapse/00000.jpg, ...  (YYYYMMDD_timelapse.mp4)
+
+During the capture, product_thread runs the builder in a background thread
+with its own queue, so decoding, writing and encoding the video never delay
+the acquisition.
+
+Example::
+
+    python products.py archive_dir outdir [start [end]]
+
+
+Package requirements:
+    PIL, numpy, ffmpeg (optional, time-lapse video)
+"""
+
+import io
+import os
+import sys
+import queue
+import shutil
+import threading
+import subprocess
+from datetime import datetime
+import numpy as np
+
+
+
+class product_builder():
+    """
+    Incremental builder of the daily products of one camera
+
+    :param outdir: string, output directory of the products
+    :param scale: int, optional, DCT downscale factor of the frames (1, 2, 4
+        or 8)
+    :param interval: float, optional, acquisition interval in seconds (width
+        of the keogram columns)
+    :param mosaic_step: float, optional, seconds between mosaic tiles
+    :param mosaic_columns: int, optional, tiles per mosaic row
+    :param timelapse_every: int, optional, every n-th frame is a time-lapse
+        frame, 0 to disable
+    :param video: boolean, optional, encode the time-lapse frames with ffmpeg
+    :param prefix: string, optional, prefix of the product files (camera id)
+    :param quality: int, optional, JPEG quality of the products
+    :param size: tuple, optional, (width, height) of the full resolution
+        frames, default the size of the geometry or of the first frame at
+        scale
+    :param geometry: sunglare.fisheye or its parameters (dict), optional,
+        for the north-south slice of the keogram
+    """
+
+    def __init__(self, outdir, scale=8, interval=10, mosaic_step=1800,
+            mosaic_columns=8, timelapse_every=6, video=True, prefix="",
+            quality=90, size=None, geometry=None):
+        if isinstance(geometry, dict):
+            import sunglare
+            geometry = sunglare.fisheye(**geometry)
+        if size is None and geometry is not None: size = geometry.size
+
+        self.outdir = outdir
+        self.scale = scale
+        self.interval = float(interval)
+        self.mosaic_step = mosaic_step
+        self.mosaic_columns = mosaic_columns
+        self.timelapse_every = timelapse_every
+        self.video = video
+        self.prefix = prefix
+        self.quality = quality
+        self.geometry = geometry
+        self.full_size = tuple(size) if size else None
+
+        # size of the products, fixed for all days
+        self.size = (size[0] // scale, size[1] // scale) if size else None
+        self.slice = None
+        self.day = None
+        self.keogram = None
+        self.filled = None
+        self.mosaic = None
+        self.tiles = None
+        self.count = 0
+        self.timelapse = 0
+
+        # statistics
+        self.frames = 0
+        self.days = 0
+
+        os.makedirs(outdir, exist_ok=True)
+
+
+
+    def _fname(self, day, product):
+        return os.path.join(self.outdir, self.prefix + day + "_" + product)
+
+
+
+    def _keogram_slice(self):
+        """ Returns the pixel coordinates (rows, columns) of the north-south
+        slice through the zenith """
+        w, h = self.size
+        if self.geometry is None:
+            return np.arange(h), np.full(h, w // 2)
+
+        # from the northern horizon through the zenith to the southern one
+        angle = np.linspace(-90., 90., h)
+        x, y = self.geometry.project(np.abs(angle),
+            np.where(angle < 0, 0., 180.), self.size)
+        rows = np.clip(np.round(y).astype(int), 0, h - 1)
+        columns = np.clip(np.round(x).astype(int), 0, w - 1)
+
+        return rows, columns
+
+
+
+    def _start_day(self, day):
+        """ Allocates the products of a new day """
+        self.day = day
+        w, h = self.size
+        if self.slice is None: self.slice = self._keogram_slice()
+        slots = int(np.ceil(86400. / self.interval))
+        self.keogram = np.zeros((h, slots, 3), dtype=np.uint8)
+        self.filled = np.zeros(slots, dtype=bool)
+        ntiles = int(np.ceil(86400. / self.mosaic_step))
+        rows = int(np.ceil(ntiles / float(self.mosaic_columns)))
+        self.mosaic = np.zeros((rows * h, self.mosaic_columns * w, 3),
+            dtype=np.uint8)
+        self.tiles = np.zeros(ntiles, dtype=bool)
+        self.count = 0
+        self.timelapse = 0
+        if self.timelapse_every:
+            os.makedirs(self._fname(day, "timelapse"), exist_ok=True)
+
+
+
+    def _scale(self, size):
+        """ Returns the DCT scale of a frame of a size, the largest one still
+        covering the product size """
+        if self.size is None: return self.scale
+        scale = 1
+        while scale < 8 and size[0] // (2 * scale) >= self.size[0]: scale *= 2
+
+        return scale
+
+
+
+    def _decode(self, image):
+        """ Returns an RGB PIL image of bytes, a file name, array or image """
+        from PIL import Image
+
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        elif not isinstance(image, Image.Image):
+            if isinstance(image, (bytes, bytearray, memoryview)):
+                image = io.BytesIO(image)
+            image = Image.open(image)
+            scale = self._scale(image.size)
+            if scale > 1:
+                # DCT scaling, see preview.open_scaled
+                mode = image.mode if image.mode in ("RGB", "L") else "RGB"
+                image.draft(mode, (image.size[0] // scale,
+                    image.size[1] // scale))
+
+        return image.convert("RGB") if image.mode != "RGB" else image
+
+
+
+    def add(self, dt, image):
+        """
+        Adds a frame to the products of its day
+
+        :param dt: datetime, time of the frame (UTC)
+        :param image: bytes (encoded, decoded DCT-scaled), file name, PIL
+            image or array (already scaled, e.g. from reader.archive_reader)
+        """
+        from PIL import Image
+
+        image = self._decode(image)
+        if self.size is None: self.size = image.size
+        day = dt.strftime("%Y%m%d")
+        if day != self.day:
+            if self.day is not None: self.finish()
+            self._start_day(day)
+        if image.size != self.size:
+            # frames of another resolution (see adaptive module)
+            image = image.resize(self.size, Image.BILINEAR)
+        pixels = np.asarray(image)
+        w, h = self.size
+        seconds = dt.hour * 3600 + dt.minute * 60 + dt.second + \
+            dt.microsecond * 1e-6
+
+        # keogram: north-south slice through the zenith
+        slot = min(int(seconds / self.interval), len(self.filled) - 1)
+        self.keogram[:, slot] = pixels[self.slice]
+        self.filled[slot] = True
+
+        # mosaic: first frame of each tile period
+        tile = int(seconds / self.mosaic_step)
+        if not self.tiles[tile]:
+            r, c = divmod(tile, self.mosaic_columns)
+            self.mosaic[r * h:(r + 1) * h, c * w:(c + 1) * w] = pixels
+            self.tiles[tile] = True
+
+        # time-lapse frames
+        if self.timelapse_every and self.count % self.timelapse_every == 0:
+            image.save(os.path.join(self._fname(day, "timelapse"),
+                "%05d.jpg" % self.timelapse), quality=self.quality)
+            self.timelapse += 1
+
+        self.count += 1
+        self.frames += 1
+
+
+
+    def finish(self):
+        """
+        Writes the products of the current day
+
+        :returns: dictionary product -> file name
+        """
+        from PIL import Image
+
+        if self.day is None: return {}
+        day = self.day
+        written = {}
+
+        # keogram without the empty slots before the first and after the
+        # last frame of the day
+        used = np.nonzero(self.filled)[0]
+        if len(used):
+            fname = self._fname(day, "keogram.jpg")
+            Image.fromarray(self.keogram[:, used[0]:used[-1] + 1]).save(fname,
+                quality=self.quality)
+            written['keogram'] = fname
+
+        if self.tiles.any():
+            fname = self._fname(day, "mosaic.jpg")
+            Image.fromarray(self.mosaic).save(fname, quality=self.quality)
+            written['mosaic'] = fname
+
+        if self.timelapse:
+            written['timelapse'] = self._fname(day, "timelapse")
+            if self.video:
+                video = encode_video(written['timelapse'],
+                    self._fname(day, "timelapse.mp4"))
+                if video: written['video'] = video
+
+        self.day = None
+        self.keogram = self.mosaic = None
+        self.days += 1
+
+        return written
+
+
+
+    def stats(self):
+        """ Returns the number of frames and finished days """
+        return {'frames': self.frames, 'days': self.days}
+
+
+
+
+
+class product_thread():
+    """
+    Runs a product builder in a background thread with its own queue, so the
+    capture only enqueues the encoded frames
+
+    :param builder: product_builder
+    :param maxsize: int, optional, maximum number of queued frames, further
+        frames are dropped (e.g. while the video of a day is encoded)
+    """
+
+    def __init__(self, builder, maxsize=256):
+        self.builder = builder
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self._run, daemon=True,
+            name="products")
+        self.thread.start()
+
+
+
+    def add(self, dt, image):
+        """ Queues a frame, see product_builder.add """
+        try:
+            self.queue.put_nowait((dt, image))
+        except queue.Full:
+            self.dropped += 1
+
+
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            try:
+                self.builder.add(*item)
+            except Exception as e:
+                self.failed += 1
+                print('Products of frame ', item[0], ' failed -> ', repr(e))
+        try:
+            self.builder.finish()
+        except Exception as e:
+            print('Products of day ', self.builder.day, ' failed -> ', repr(e))
+
+
+
+    def close(self):
+        """ Builds the queued frames and writes the products of the current
+        day """
+        self.queue.put(None)
+        self.thread.join()
+
+
+
+    def stats(self):
+        """ Returns the statistics of the builder, the queued, dropped and
+        failed frames """
+        stats = self.builder.stats()
+        stats.update({'queued': self.queue.qsize(), 'dropped': self.dropped,
+            'failed': self.failed})
+
+        return stats
+
+
+
+
+
+def encode_video(framedir, fname, fps=25):
+    """
+    Encodes numbered JPEG frames (00000.jpg, ...) to an H.264 video with
+    ffmpeg
+
+    :returns: string, file name of the video or None if ffmpeg is missing or
+        failed
+    """
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        print('ffmpeg not found, time-lapse frames kept in ', framedir)
+        return None
+    cmd = [ffmpeg, "-y", "-loglevel", "error", "-framerate", str(fps),
+        "-i", os.path.join(framedir, "%05d.jpg"), "-c:v", "libx264",
+        "-pix_fmt", "yuv420p", "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", fname]
+    if subprocess.call(cmd) != 0:
+        print('ffmpeg failed for ', framedir)
+        return None
+
+    return fname
+
+
+
+def build(source, outdir, camera=None, start=None, end=None, scale=8,
+        workers=4, **kwargs):
+    """
+    Builds the products of archived frames in a single pass. The frames are
+    decoded DCT-scaled in parallel with a bounded read-ahead (see
+    reader.archive_reader).
+
+    :param source: archive source, see reader.archive_reader
+    :param outdir: string, output directory
+    :param camera, start, end: selection of the frames (see
+        reader.archive_reader.locate)
+    :param scale: int, optional, DCT downscale factor
+    :param workers: int, optional, number of decoding threads
+    :param kwargs: further parameters of product_builder
+
+    :returns: product_builder, with the statistics of the run
+    """
+    import reader
+
+    builder = product_builder(outdir, scale=scale,
+        prefix=camera + "_" if camera else "", **kwargs)
+    rd = reader.archive_reader(source, workers=workers, scale=scale,
+        mode="RGB")
+    for dt, img, sd in rd.frames(camera, start, end):
+        builder.add(dt, img)
+    builder.finish()
+
+    return builder
+
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) not in (3, 4, 5):
+        print("Usage: python products.py source outdir [start [end]] " \
+            "(times YYYYMMDD)")
+        sys.exit(1)
+
+    start = datetime.strptime(sys.argv[3], "%Y%m%d") if len(sys.argv) > 3 \
+        else None
+    end = datetime.strptime(sys.argv[4], "%Y%m%d") if len(sys.argv) > 4 \
+        else None
+    builder = build(sys.argv[1], sys.argv[2], start=start, end=end)
+    print(builder.stats())
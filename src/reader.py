@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module reads archived frames in bulk for reprocessing.
+
+Retraining cloud detection or rerunning a calibration iterates over months of
+archived frames, which is bound by reading and decoding the JPEG images. The
+archive reader prefetches the files and decodes them in a pool of threads
+(libjpeg releases the GIL) or processes, while the frames are still returned
+in chronological order. At most readahead frames are decoded in advance, so
+memory stays bounded independent of the length of the time range.
+
+The frames can be downscaled already while decoding (DCT scaling, see preview
+module), which makes the decode several times faster.
+
+Sources of frames:
+    - an archive index (archive.archive_index or path of the database)
+    - an archive directory outdir/YYYYMMDD/YYYYMMDD_HHMMSS.jpg
+    - a container archive (container.pack_archive)
+
+Example::
+
+    rd = archive_reader("archive.db", lat=53.13, lon=8.13, scale=4)
+    for dt, img, sd in rd.frames("roof", datetime(2016,6,1), datetime(2016,9,1)):
+        print(dt, img.shape, sd['zenith'])
+
+
+Package requirements:
+    PIL, numpy
+"""
+
+import os
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+
+import archive
+import container
+
+
+# Number of frames for which the solar position is computed at once
+SOLAR_BLOCK = 1024
+
+# Open container readers of this process, file name -> [reader, number of
+# threads reading from it, retired], see read_bytes
+_readers = collections.OrderedDict()
+_readers_lock = threading.Lock()
+_max_readers = 4
+
+
+
+def _retire(entry):
+    """ Closes a container reader removed from the cache once it is no
+    longer read from, called with _readers_lock held """
+    entry[2] = True
+    if entry[1] == 0: entry[0].close()
+
+
+
+def read_bytes(locator):
+    """
+    Reads the encoded image of a file path or a container locator. Container
+    readers are kept open, so consecutive frames of a day are read from the
+    same memory map. Only the lookup of the reader holds the lock, threads
+    copy frames of the same container in parallel.
+
+    :param locator: string, path or "file.pack#number"
+
+    :returns: bytes
+    """
+    if "#" not in locator:
+        with open(locator, "rb") as f:
+            return f.read()
+
+    fname, number = locator.rsplit("#", 1)
+    number = int(number)
+    with _readers_lock:
+        entry = _readers.pop(fname, None)
+        if entry is not None and number >= len(entry[0]):
+            # frames appended since the reader was opened, other threads
+            # may still read from the old memory map
+            _retire(entry)
+            entry = None
+        if entry is None: entry = [container.pack_reader(fname), 0, False]
+        entry[1] += 1
+        _readers[fname] = entry
+        while len(_readers) > _max_readers:
+            _retire(_readers.popitem(last=False)[1])
+
+    try:
+        data = bytes(entry[0].get(number))
+    finally:
+        with _readers_lock:
+            entry[1] -= 1
+            if entry[2] and entry[1] == 0: entry[0].close()
+
+    return data
+
+
+
+def load_frame(locator, scale=1, mode=None):
+    """
+    Reads and decodes a frame, function executed in the worker pool
+
+    :param locator: string, path or container locator
+    :param scale: int, optional, downscale factor 1, 2, 4 or 8 (DCT scaling)
+    :param mode: string, optional, PIL mode to convert to, e.g. "L"
+
+    :returns: numpy array (rows, columns[, channels]), uint8
+    """
+    import io
+    import preview
+
+    image = preview.open_scaled(io.BytesIO(read_bytes(locator)), scale)
+    if mode and image.mode != mode: image = image.convert(mode)
+
+    return np.asarray(image)
+
+
+
+
+
+class archive_reader():
+    """
+    Iterator over archived frames with parallel prefetching and decoding.
+
+    Parameters
+    -----------
+    :param source: archive source, archive_index object or path of an index
+        database (.db), archive directory or container.pack_archive
+    :param lat: float, optional, latitude of the camera (degrees), required
+        for the solar data
+    :param lon: float, optional, longitude of the camera (degrees)
+    :param workers: int, optional, number of threads or processes (default 4)
+    :param readahead: int, optional, maximum number of frames decoded in
+        advance (default 2 * workers)
+    :param scale: int, optional, downscale factor while decoding (1, 2, 4, 8)
+    :param mode: string, optional, PIL mode of the arrays, e.g. "L" for gray
+    :param processes: boolean, optional, use processes instead of threads
+    """
+
+    def __init__(self, source, lat=None, lon=None, workers=4, readahead=None,
+            scale=1, mode=None, processes=False):
+
+        if isinstance(source, str) and source.endswith(".db"):
+            source = archive.archive_index(source)
+        self.source = source
+        self.lat = lat
+        self.lon = lon
+        self.workers = workers
+        self.readahead = readahead if readahead else 2 * workers
+        self.scale = scale
+        self.mode = mode
+        self.processes = processes
+
+
+
+    def locate(self, camera=None, start=None, end=None, **predicates):
+        """
+        Returns the frames of the source in a time range
+
+        :param camera: string, optional, camera id (index and containers,
+            ValueError for an archive directory), default all cameras
+        :param start: datetime, optional, first time (inclusive)
+        :param end: datetime, optional, last time (exclusive)
+        :param predicates: conditions on index columns (see
+            archive_index.query), only for an index as source
+
+        :returns: list of (datetime, locator)
+        """
+        if isinstance(self.source, archive.archive_index):
+            return [(rec['time'], rec['path']) for rec in \
+                self.source.query(camera, start, end, **predicates)]
+
+        if predicates:
+            raise ValueError("Predicates need an archive index as source")
+
+        if isinstance(self.source, container.pack_archive):
+            cameras = [camera] if camera else self.source.cameras()
+            frames = []
+            for cam in cameras:
+                frames += self._locate_packs(cam, start, end)
+            # chronological order over all cameras
+            if len(cameras) > 1: frames.sort(key=lambda f: f[0])
+            return frames
+
+        if camera:
+            raise ValueError("An archive directory holds the frames of one " \
+                "camera, locate them without camera")
+
+        return list(archive.scan_directory(self.source, start, end))
+
+
+
+    def _locate_packs(self, camera, start, end):
+        """ Returns the frames of a camera in a container archive """
+        frames = []
+        for day in self.source.days(camera):
+            if start and day < start.strftime("%Y%m%d"): continue
+            if end and day > end.strftime("%Y%m%d"): break
+            fname = self.source.root + os.sep + camera + os.sep + day + ".pack"
+            with container.pack_reader(fname) as reader:
+                times = reader.sorted_times
+                i0 = 0 if start is None else int(np.searchsorted(times,
+                    archive.to_timestamp(start)))
+                i1 = len(times) if end is None else int(np.searchsorted(
+                    times, archive.to_timestamp(end)))
+                for i in reader.order[i0:i1]:
+                    frames.append((archive.from_timestamp( \
+                        reader.index['time'][i]), fname + "#" + str(i)))
+
+        return frames
+
+
+
+    def _solar(self, times):
+        """ Returns the solar data of each frame as list of dictionaries """
+        if self.lat is None or self.lon is None: return [None] * len(times)
+
+        import camera
+        sd = camera.solar_data(times, self.lat, self.lon)
+        keys = [k for k, v in sd.items() if np.ndim(v) == 1]
+
+        return [dict((k, float(sd[k][i])) for k in keys) \
+            for i in range(len(times))]
+
+
+
+    def frames(self, camera=None, start=None, end=None, **predicates):
+        """
+        Generator over the decoded frames in chronological order. For the
+        parameters see locate.
+
+        :yields: (datetime, numpy array, solar data dictionary or None)
+        """
+        frames = self.locate(camera, start, end, **predicates)
+        if not frames: return
+
+        if self.processes:
+            pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+
+        pending = collections.deque()
+        solar = []
+        n = 0
+        try:
+            for i in range(len(frames)):
+                # keep the read-ahead window filled
+                while n < len(frames) and n - i < self.readahead:
+                    pending.append(pool.submit(load_frame, frames[n][1],
+                        self.scale, self.mode))
+                    n += 1
+                if i % SOLAR_BLOCK == 0:
+                    solar = self._solar([dt for dt, loc in \
+                        frames[i:i + SOLAR_BLOCK]])
+                img = pending.popleft().result()
+                yield frames[i][0], img, solar[i % SOLAR_BLOCK]
+        finally:
+            for future in pending: future.cancel()
+            pool.shutdown(wait=True)
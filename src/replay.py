@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module replays archived frames through the processing pipeline.
+
+When the annotation, masking or derived products change, historic data has
+to be reprocessed. Instead of scripts reimplementing the acquisition, the
+replay source presents archived frames through the interface of a live
+camera (download_image, capture, addText, settings), so the same code and
+the same processing pipeline run on months of data:
+
+    src = replay("archive.db", camera="roof", start=datetime(2016,6,1))
+    stats = src.feed(pipe)
+
+Each call of download_image or capture returns the next archived frame.
+Timing:
+    speed None      as fast as possible (backfill), the pipeline blocks the
+                    replay when the workers are busy
+    speed 1         simulated real time, frames are served at their original
+                    time distances
+    speed n         n times faster than real time
+
+The sources are those of the archive reader (index, archive directory
+outdir/YYYYMMDD/YYYYMMDD_HHMMSS.jpg or container archive). Archived frames
+carry the text of the acquisition already, a pipeline with the step
+pipeline.annotate is therefore refused unless the source holds raw camera
+frames (raw). The throughput in frames per second is reported by feed and
+run:
+
+    python replay.py [--packs] [--camera roof] [--raw] source outdir \
+        [start [end]]
+
+
+Package requirements:
+    PIL, numpy
+"""
+
+import time
+from datetime import datetime
+
+import camera
+import reader
+import container
+import tracing
+import pipeline
+
+
+
+class replay(camera.driver):
+    """
+    Camera replaying archived frames
+
+    :param source: archive source, see reader.archive_reader
+    :param camera: string, optional, camera id of the frames (index and
+        container archives)
+    :param start: datetime, optional, first time (inclusive)
+    :param end: datetime, optional, last time (exclusive)
+    :param speed: float, optional, replay speed relative to real time, None
+        for as fast as possible
+    :param name: string, optional, camera id of the replayed frames, default
+        camera or "replay"
+    :param raw: boolean, optional, the source holds raw camera frames
+        without the annotation of the acquisition
+    :param predicates: conditions on index columns (see archive_index.query)
+    """
+
+    model = "replay"
+
+    def __init__(self, source, camera=None, start=None, end=None, speed=None,
+            name=None, raw=False, **predicates):
+        super().__init__(ip="replay", name=name if name else \
+            (camera if camera else "replay"))
+        self.raw = raw
+        self.frames = reader.archive_reader(source).locate(camera, start, end,
+            **predicates)
+        self.image_url = "replay"
+        self.speed = speed
+        self.position = 0
+        self.origin = None
+        self.lag = 0.
+        self.started = None
+
+
+
+    def __len__(self):
+        return len(self.frames)
+
+
+
+    def remaining(self):
+        """ Returns the number of frames not yet replayed """
+        return len(self.frames) - self.position
+
+
+
+    def next_time(self):
+        """ Returns the time (UTC) of the next frame or None at the end """
+        if self.position >= len(self.frames): return None
+
+        return self.frames[self.position][0]
+
+
+
+    def _wait(self, dt):
+        """ Waits until the frame is due (simulated timing) """
+        now = time.monotonic()
+        if self.origin is None: self.origin = (now, dt)
+        if not self.speed: return
+        due = self.origin[0] + (dt - self.origin[1]).total_seconds() / \
+            self.speed
+        if due > now:
+            time.sleep(due - now)
+            self.lag = 0.
+        else:
+            self.lag = now - due
+
+
+
+    def capture(self, timeout=5, resolution=None, quality=None):
+        """Returns the next archived frame like a camera download
+
+        :param timeout, resolution, quality: ignored
+
+        :returns data, info: bytes, the encoded image, and a dictionary with
+            the keys of camera.driver.capture ('capture_time' is the archived
+            time) and 'locator'
+
+        :raises EOFError: if all frames were replayed
+        """
+        if self.position >= len(self.frames):
+            raise EOFError("All %d frames replayed" % len(self.frames))
+        dt, locator = self.frames[self.position]
+        self.position += 1
+        if self.started is None: self.started = time.monotonic()
+
+        self._wait(dt)
+        send = time.monotonic()
+        with tracing.span("replay.read", camera=self.name):
+            data = reader.read_bytes(locator)
+        complete = time.monotonic()
+
+        info = {'send': send, 'first_byte': send, 'complete': complete,
+            'capture_time': dt, 'capture_uncertainty': None,
+            'clock_offset': None, 'clock_uncertainty': None,
+            'locator': locator}
+
+        return data, info
+
+
+
+    def set_params(self, operation, force=False, **values):
+        """ Records settings in the state mirror, there is no camera """
+        self.state.update(values)
+
+        return True
+
+
+
+    def read_params(self, settings=None):
+        """ Returns the recorded settings """
+        return dict(self.state)
+
+
+
+    def feed(self, pipe, **kwargs):
+        """
+        Submits all remaining frames to a processing pipeline. Use the policy
+        block for the pipeline, otherwise frames are dropped when the
+        workers are busy.
+
+        :param pipe: pipeline.pipeline object (started)
+        :param kwargs: further entries of the frame dictionaries
+
+        :returns: dictionary, see stats
+
+        :raises ValueError: if the pipeline would annotate annotated frames
+        """
+        if not self.raw and pipeline.annotate in pipe.steps:
+            raise ValueError("The archived frames are annotated already, " \
+                "remove the step annotate or replay raw frames (raw=True)")
+        while self.position < len(self.frames):
+            dt = self.next_time()
+            data, info = self.capture()
+            pipe.submit(data, dt=dt, camera=self.name,
+                capture_time=info['capture_time'], **kwargs)
+
+        return self.stats()
+
+
+
+    def stats(self):
+        """
+        Returns the progress of the replay
+
+        :returns: dictionary with 'frames' (replayed), 'remaining', 'seconds'
+            since the first frame, 'fps' and 'lag' (seconds behind the
+            simulated timing)
+        """
+        elapsed = time.monotonic() - self.started if self.started else 0.
+
+        return {'frames': self.position, 'remaining': self.remaining(),
+            'seconds': elapsed,
+            'fps': self.position / elapsed if elapsed > 0 else 0.,
+            'lag': self.lag}
+
+
+
+
+
+def run(source, steps, config, camera=None, start=None, end=None,
+        speed=None, workers=None, raw=False, **predicates):
+    """
+    Reprocesses archived frames with a processing pipeline
+
+    :param source: archive source, see reader.archive_reader
+    :param steps: list of processing steps (see pipeline module)
+    :param config: dictionary, settings of the steps (outdir, ...)
+    :param camera, start, end, speed, raw, predicates: see replay
+    :param workers: int, optional, number of worker processes
+
+    :returns: dictionary with the counters of the pipeline and 'seconds'
+        and 'fps' of the whole run (including processing)
+    """
+    src = replay(source, camera=camera, start=start, end=end, speed=speed,
+        raw=raw, **predicates)
+    tic = time.monotonic()
+    pipe = pipeline.pipeline(steps=steps, config=config, workers=workers,
+        policy=pipeline.BLOCK).start()
+    try:
+        src.feed(pipe)
+    finally:
+        pipe.close()
+    elapsed = time.monotonic() - tic
+
+    stats = pipe.stats()
+    stats['seconds'] = elapsed
+    stats['fps'] = stats['processed'] / elapsed if elapsed > 0 else 0.
+
+    return stats
+
+
+
+if __name__ == "__main__":
+    import argparse
+
+    def parse(s):
+        return datetime.strptime(s, "%Y%m%d_%H%M%S" if "_" in s else "%Y%m%d")
+
+    parser = argparse.ArgumentParser(description="Reprocesses archived " \
+        "frames (times YYYYMMDD or YYYYMMDD_HHMMSS)")
+    parser.add_argument("source", help="archive index (.db), archive " \
+        "directory or container directory (--packs)")
+    parser.add_argument("outdir", help="output archive directory")
+    parser.add_argument("start", nargs="?", type=parse)
+    parser.add_argument("end", nargs="?", type=parse)
+    parser.add_argument("--packs", action="store_true",
+        help="source is a container archive (see container module)")
+    parser.add_argument("--camera", default=None,
+        help="camera id (index and container archives)")
+    parser.add_argument("--raw", action="store_true",
+        help="the frames are raw camera images, annotate them")
+    args = parser.parse_args()
+
+    source = container.pack_archive(args.source) if args.packs else args.source
+    steps = [pipeline.annotate, pipeline.archive] if args.raw else \
+        [pipeline.archive]
+    stats = run(source, steps, {'outdir': args.outdir}, camera=args.camera,
+        start=args.start, end=args.end, raw=args.raw)
+    print("%d frames processed (%d failed) in %.1f s: %.1f frames/s" % (
+        stats['processed'], stats['failed'], stats['seconds'], stats['fps']))
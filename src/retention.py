@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module reduces the size of old parts of the image archive (retention
+tiers) by an incremental background compaction.
+
+Keeping every full resolution frame forever fills the disks within months.
+A retention policy is a list of tiers, each applying to days older than a
+given age:
+
+    - scale: downscale factor relative to the original image (DCT scaling)
+    - quality: JPEG quality of the re-encoded images
+    - keep_every: keep only every n-th frame (e.g. 6 -> one per minute for a
+      10 s interval)
+    - night_keep_every: thinning for night frames (solar zenith angle above
+      night_zenith), night frames are usually thinned first
+
+The default policy keeps full resolution for 30 days, then half size with
+quality 75 and every 6th night frame, and after one year only every 6th
+frame at all.
+
+The compaction processes whole days of the directory layout
+outdir/YYYYMMDD/YYYYMMDD_HHMMSS.jpg, oldest first. The state of each day is
+stored in a file .retention in the day directory, so a day is touched only
+once per tier. Every re-encoded frame is recorded in the journal
+.retention.journal of the day before the new image replaces the old one, so
+an interrupted run continues with the next call without re-encoding the
+frames it already processed.
+Reads and writes are limited to a maximum I/O bandwidth, so compaction does
+not compete with the live capture.
+
+Thinning is based on the time of day: a frame is kept if its slot number
+(seconds of the day / base_interval) is a multiple of keep_every. It is thus
+independent of frames already removed by earlier tiers.
+
+Deleted and re-encoded frames are updated in the archive index (if given);
+previews of deleted and re-encoded frames are removed as well (see
+preview.load_preview for the fallback). Container archives (see
+container module) are not compacted.
+
+Run as a script to compact an archive once:
+
+    python retention.py outdir [latitude longitude]
+
+
+Package requirements:
+    PIL, numpy
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import threading
+from datetime import datetime, timedelta
+
+import archive
+import preview
+
+
+# Name of the state file in each day directory
+STATE = ".retention"
+
+# Name of the journal of re-encoded frames of an unfinished day
+JOURNAL = ".retention.journal"
+
+
+
+class tier():
+    """
+    Retention tier
+
+    :param age: int, minimum age in days
+    :param scale: int, optional, downscale factor relative to the original
+        (1, 2, 4, 8)
+    :param quality: int, optional, JPEG quality, None keeps the encoding
+    :param keep_every: int, optional, keep every n-th frame
+    :param night_keep_every: int, optional, keep every n-th night frame,
+        default keep_every
+    """
+
+    def __init__(self, age, scale=1, quality=None, keep_every=1,
+            night_keep_every=None):
+        self.age = age
+        self.scale = scale
+        self.quality = quality
+        self.keep_every = keep_every
+        self.night_keep_every = night_keep_every if night_keep_every \
+            else keep_every
+
+
+
+    def __repr__(self):
+        return "tier(age=%d, scale=%d, quality=%s, keep_every=%d, " \
+            "night_keep_every=%d)" % (self.age, self.scale, self.quality,
+            self.keep_every, self.night_keep_every)
+
+
+
+DEFAULT_POLICY = [
+    tier(30, scale=2, quality=75, night_keep_every=6),
+    tier(365, scale=2, quality=75, keep_every=6),
+]
+
+
+
+
+
+class rate_limiter():
+    """
+    Token bucket limiting the I/O bandwidth
+
+    :param rate: float, bytes per second, None for no limit
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate if rate else 0
+        self.last = time.monotonic()
+
+
+
+    def consume(self, nbytes):
+        """ Waits until nbytes may be read or written """
+        if not self.rate: return
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= nbytes
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+            self.last = time.monotonic()
+            self.tokens = 0
+
+
+
+
+
+class compactor():
+    """
+    Applies a retention policy to an archive directory
+
+    Parameters
+    -----------
+    :param outdir: string, archive directory
+    :param policy: list of tier objects, optional, default DEFAULT_POLICY
+    :param index: string or archive.archive_index, optional, archive index,
+        used for the solar zenith angle and updated
+    :param camera: string, optional, camera id of the archive in the index
+        (required if several cameras share the index)
+    :param lat: float, optional, latitude (degrees), for the solar zenith angle
+        if no index is given
+    :param lon: float, optional, longitude (degrees)
+    :param night_zenith: float, optional, solar zenith angle above which a
+        frame is a night frame (default 96, civil twilight)
+    :param bandwidth: float, optional, maximum I/O in bytes per second
+        (default 5 MB/s), None for no limit
+    :param base_interval: float, optional, acquisition interval in seconds
+        used for thinning (default 10)
+    """
+
+    def __init__(self, outdir, policy=DEFAULT_POLICY, index=None, camera=None,
+            lat=None, lon=None, night_zenith=96, bandwidth=5e6,
+            base_interval=10):
+
+        self.outdir = outdir
+        self.policy = sorted(policy, key=lambda t: t.age)
+        self.index = index
+        self.camera = camera
+        self.lat = lat
+        self.lon = lon
+        self.night_zenith = night_zenith
+        self.limiter = rate_limiter(bandwidth)
+        self.base_interval = base_interval
+        self.thread = None
+        self.stopped = threading.Event()
+
+        # statistics
+        self.deleted = 0
+        self.recompressed = 0
+        self.bytes_freed = 0
+
+
+
+    def _index(self):
+        """ Opens the index in the calling thread (SQLite connections can not
+        be shared between threads) """
+        if isinstance(self.index, str): return archive.archive_index(self.index)
+
+        return self.index
+
+
+
+    def _state(self, dname):
+        """ Returns the state of a day directory """
+        fname = dname + os.sep + STATE
+        if not os.path.exists(fname): return {'tier': -1, 'scale': 1,
+            'quality': None}
+        with open(fname) as f:
+            return json.load(f)
+
+
+
+    def _journal(self, dname):
+        """ Returns the frames re-encoded by an unfinished run of a day:
+        file name -> (scale, quality) """
+        fname = dname + os.sep + JOURNAL
+        done = {}
+        if not os.path.exists(fname): return done
+        with open(fname) as f:
+            for line in f:
+                parts = line.split()
+                # an incomplete last line was not followed by a replace
+                if len(parts) != 3 or not line.endswith("\n"): continue
+                done[parts[0]] = (int(parts[1]),
+                    None if parts[2] == "-" else int(parts[2]))
+
+        return done
+
+
+
+    def _recover(self, dname, journal):
+        """ Completes or discards re-encodes interrupted before the new image
+        replaced the old one """
+        for name in os.listdir(dname):
+            if not name.endswith(".tmp"): continue
+            if name[:-4] in journal:
+                os.replace(dname + os.sep + name, dname + os.sep + name[:-4])
+            else:
+                os.remove(dname + os.sep + name)
+
+
+
+    def plan(self, now=None):
+        """
+        Returns the days which have to be compacted, oldest first
+
+        :param now: datetime, optional, current time (UTC)
+
+        :returns: list of (day string YYYYMMDD, tier number)
+        """
+        if now is None: now = datetime.utcnow()
+        days = sorted(d for d in os.listdir(self.outdir) \
+            if len(d) == 8 and d.isdigit())
+        todo = []
+        for day in days:
+            age = (now - datetime.strptime(day, "%Y%m%d")).days
+            target = -1
+            for i, t in enumerate(self.policy):
+                if age >= t.age: target = i
+            if target < 0: break
+            state = self._state(self.outdir + os.sep + day)
+            if state['tier'] < target: todo.append((day, target))
+
+        return todo
+
+
+
+    def _night(self, times, idx):
+        """ Returns a night flag for each time """
+        zenith = None
+        if idx is not None:
+            records = idx.query(self.camera, start=times[0],
+                end=times[-1] + timedelta(seconds=1))
+            by_time = dict((rec['time'], rec['zenith']) for rec in records)
+            zenith = [by_time.get(dt) for dt in times]
+            if any(z is None for z in zenith): zenith = None
+        if zenith is None:
+            if self.lat is None or self.lon is None: return [False] * len(times)
+            import camera
+            zenith = camera.solar_data(times, self.lat, self.lon)['zenith']
+
+        return [z > self.night_zenith for z in zenith]
+
+
+
+    def _remove_previews(self, path):
+        for scale in preview.SCALES:
+            pname = preview.preview_filename(path, scale)
+            if os.path.exists(pname): os.remove(pname)
+
+
+
+    def _compact_frames(self, frames, t, state, journal, dname, idx):
+        """ Applies a tier to the frames of a day until stopped """
+        night = self._night([dt for dt, path in frames], idx)
+        deleted = recompressed = 0
+
+        for (dt, path), is_night in zip(frames, night):
+            if self.stopped.is_set(): break
+            every = t.night_keep_every if is_night else t.keep_every
+            seconds = dt.hour * 3600 + dt.minute * 60 + dt.second
+            slot = int(round(seconds / float(self.base_interval)))
+
+            if every > 1 and slot % every:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self._remove_previews(path)
+                if idx is not None: idx.remove(path)
+                self.bytes_freed += size
+                deleted += 1
+                continue
+
+            # frames re-encoded by an interrupted run are at their journal
+            # scale and quality already
+            name = os.path.basename(path)
+            scale, quality = journal.get(name, (state['scale'],
+                state['quality']))
+            factor = max(1, t.scale // scale)
+            requality = t.quality is not None and (quality is None or \
+                t.quality < quality)
+            if factor == 1 and not requality: continue
+
+            with open(path, "rb") as f:
+                data = f.read()
+            self.limiter.consume(len(data))
+            image = preview.open_scaled(io.BytesIO(data), factor)
+            buf = io.BytesIO()
+            image.save(buf, format="JPEG",
+                quality=t.quality if t.quality else 95)
+            new = buf.getvalue()
+            self.limiter.consume(len(new))
+            with open(path + ".tmp", "wb") as f:
+                f.write(new)
+
+            # journal and index first, an interruption before the replace is
+            # completed by _recover
+            if requality: quality = t.quality
+            with open(dname + os.sep + JOURNAL, "a") as f:
+                f.write("%s %d %s\n" % (name, scale * factor,
+                    "-" if quality is None else quality))
+                f.flush()
+                os.fsync(f.fileno())
+            if idx is not None:
+                idx.update_many([{'path': path, 'size': len(new),
+                    'checksum': archive.checksum(new)}])
+            os.replace(path + ".tmp", path)
+            self._remove_previews(path)
+            self.bytes_freed += len(data) - len(new)
+            recompressed += 1
+
+        return deleted, recompressed
+
+
+
+    def compact_day(self, day, target):
+        """
+        Applies a tier to all frames of a day
+
+        :param day: string, YYYYMMDD
+        :param target: int, number of the tier in the policy
+
+        :returns: (int, int), number of deleted and re-encoded frames
+        """
+        t = self.policy[target]
+        dname = self.outdir + os.sep + day
+        state = self._state(dname)
+        journal = self._journal(dname)
+        self._recover(dname, journal)
+        frames = [(archive.parse_filename(f), dname + os.sep + f) \
+            for f in sorted(os.listdir(dname)) if archive.parse_filename(f)]
+        if not frames: return 0, 0
+
+        idx = self._index()
+        try:
+            deleted, recompressed = self._compact_frames(frames, t, state,
+                journal, dname, idx)
+        finally:
+            if idx is not None and idx is not self.index: idx.close()
+        self.deleted += deleted
+        self.recompressed += recompressed
+        if self.stopped.is_set(): return deleted, recompressed
+
+        quality = state['quality']
+        if t.quality is not None and (quality is None or t.quality < quality):
+            quality = t.quality
+        with open(dname + os.sep + STATE + ".tmp", "w") as f:
+            json.dump({'tier': target, 'scale': max(state['scale'], t.scale),
+                'quality': quality}, f)
+        os.replace(dname + os.sep + STATE + ".tmp", dname + os.sep + STATE)
+        if os.path.exists(dname + os.sep + JOURNAL):
+            os.remove(dname + os.sep + JOURNAL)
+
+        return deleted, recompressed
+
+
+
+    def run_once(self, now=None, max_days=None):
+        """
+        Compacts all days which are due
+
+        :param now: datetime, optional, current time (UTC)
+        :param max_days: int, optional, maximum number of days processed
+
+        :returns: int, number of processed days
+        """
+        todo = self.plan(now)
+        if max_days is not None: todo = todo[:max_days]
+        for day, target in todo:
+            if self.stopped.is_set(): break
+            self.compact_day(day, target)
+
+        return len(todo)
+
+
+
+    def start(self, period=3600):
+        """
+        Runs the compaction in a background thread
+
+        :param period: float, optional, seconds between two runs
+        """
+        self.stopped.clear()
+
+        def loop():
+            while not self.stopped.is_set():
+                try:
+                    self.run_once()
+                except Exception as e:
+                    print('Compaction failed -> ', repr(e))
+                self.stopped.wait(period)
+
+        self.thread = threading.Thread(target=loop, daemon=True,
+            name="retention")
+        self.thread.start()
+
+        return self
+
+
+
+    def stop(self):
+        """ Stops the background thread after the current frame """
+        self.stopped.set()
+        if self.thread: self.thread.join()
+
+
+
+    def stats(self):
+        """
+        Returns the counters of the compaction
+
+        :returns: dictionary with 'deleted', 'recompressed' and 'bytes_freed'
+        """
+        return {
+            'deleted': self.deleted,
+            'recompressed': self.recompressed,
+            'bytes_freed': self.bytes_freed,
+        }
+
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) not in (2, 4):
+        print("Usage: python retention.py outdir [latitude longitude]")
+        sys.exit(1)
+    lat = float(sys.argv[2]) if len(sys.argv) == 4 else None
+    lon = float(sys.argv[3]) if len(sys.argv) == 4 else None
+    comp = compactor(sys.argv[1], lat=lat, lon=lon)
+    print(comp.run_once(), "days compacted", comp.stats())
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module provides a shared memory ring buffer of the latest decoded frames.
+
+Local consumers (forecasting, quick-look web interface, quality checks) used
+to read current.jpg from disk, racing against the writer and decoding the
+same JPEG again in every process. Instead, the acquisition writes each
+decoded frame of a camera into a ring of N slots in shared memory. Readers
+attach to the ring by camera name and get NumPy views of the latest frames
+without disk I/O, copies or decoding.
+
+Layout of the shared memory block "skycam_<camera>":
+
+    header      magic, number of slots, maximum frame shape (height, width,
+                channels) and the sequence number of the last written frame
+    metadata    one record per slot: sequence number, time (slot, unix
+                time), capture time, exposure level, solar zenith and
+                azimuth angle, height and width of the frame
+    frames      one uint8 array of the maximum frame shape per slot, smaller
+                frames use the upper left part
+
+Writers of several processes (the pipeline workers) are serialized by a lock
+file (flock). The sequence number of a slot is 0 while it is written, so a
+reader can check with valid whether a view is still the frame it got;
+a view stays valid for about N - 1 acquisition intervals.
+
+Example (reader)::
+
+    rb = frame_ring("roof")
+    meta, img = rb.latest()
+    print(meta['seq'], meta['zenith'], img.shape)
+
+The ring is created by the acquisition (owner) and written by the pipeline
+step ring_step. "python ring.py <camera>" prints the metadata of the ring.
+
+
+Package requirements:
+    numpy, PIL (ring_step), python >= 3.8 (multiprocessing.shared_memory)
+"""
+
+import io
+import os
+import re
+import sys
+import time
+import fcntl
+import numpy as np
+from multiprocessing import shared_memory
+
+
+MAGIC = 0x534b5952
+
+# Header and slot metadata of the shared memory block
+HEADER = np.dtype([("magic", "<u4"), ("slots", "<u4"), ("height", "<u4"),
+    ("width", "<u4"), ("channels", "<u4"), ("pad", "<u4"), ("seq", "<u8")])
+META = np.dtype([("seq", "<u8"), ("time", "<f8"), ("capture_time", "<f8"),
+    ("exposure_level", "<f8"), ("zenith", "<f8"), ("azimuth", "<f8"),
+    ("height", "<u4"), ("width", "<u4")])
+
+# Alignment of the frame arrays (bytes)
+ALIGN = 64
+
+# Rings attached by this process (pipeline workers)
+_rings = {}
+
+
+
+def ring_name(camera):
+    """ Returns the name of the shared memory block of a camera """
+    return "skycam_" + re.sub(r"[^A-Za-z0-9_]", "_", camera)
+
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+
+def _attach(name):
+    """ Attaches an existing shared memory block without taking ownership """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # python < 3.13: the resource tracker would remove the block when
+        # this process exits, the attachment is therefore not registered
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+
+
+
+class frame_ring():
+    """
+    Ring buffer of decoded frames of one camera in shared memory
+
+    :param camera: string, camera id
+    :param shape: tuple, optional, maximum frame shape (height, width,
+        channels), only for creating
+    :param slots: int, optional, number of frames, only for creating
+    :param create: boolean, optional, create the ring (owner, removes it on
+        close) instead of attaching to an existing one
+    """
+
+    def __init__(self, camera, shape=None, slots=8, create=False):
+        self.camera = camera
+        self.name = ring_name(camera)
+        self.owner = create
+
+        if create:
+            if shape is None: raise ValueError("Shape required to create a ring")
+            if len(shape) == 2: shape = tuple(shape) + (1,)
+            size = self._offsets(slots, shape)[2]
+            try:
+                # remove a block left over by a crashed process
+                old = _attach(self.name)
+                old.close()
+                old.unlink()
+            except FileNotFoundError:
+                pass
+            self.shm = shared_memory.SharedMemory(name=self.name, create=True,
+                size=size)
+            self._map(slots, shape)
+            self.header['slots'] = slots
+            self.header['height'], self.header['width'], \
+                self.header['channels'] = shape
+            self.header['seq'] = 0
+            self.meta[:] = 0
+            self.header['magic'] = MAGIC
+        else:
+            self.shm = _attach(self.name)
+            header = np.ndarray((), dtype=HEADER, buffer=self.shm.buf)
+            if header['magic'] != MAGIC:
+                raise ValueError("Shared memory " + self.name + \
+                    " is not a frame ring")
+            shape = (int(header['height']), int(header['width']),
+                int(header['channels']))
+            self._map(int(header['slots']), shape)
+            del header
+
+        self.lockname = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") \
+            else "/tmp", self.name + ".lock")
+        self.lockfile = None
+
+
+
+    def _offsets(self, slots, shape):
+        meta = _align(HEADER.itemsize)
+        frames = _align(meta + slots * META.itemsize)
+        size = frames + slots * _align(int(np.prod(shape)))
+
+        return meta, frames, size
+
+
+
+    def _map(self, slots, shape):
+        self.slots = slots
+        self.shape = tuple(shape)
+        meta, frames, size = self._offsets(slots, shape)
+        buf = self.shm.buf
+        self.header = np.ndarray((), dtype=HEADER, buffer=buf)
+        self.meta = np.ndarray((slots,), dtype=META, buffer=buf, offset=meta)
+        stride = _align(int(np.prod(shape)))
+        self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8,
+            buffer=buf, offset=frames,
+            strides=(stride,) + tuple(np.empty(shape, np.uint8).strides))
+
+
+
+    def _lock(self):
+        if self.lockfile is None: self.lockfile = open(self.lockname, "a")
+        fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+
+
+
+    def _unlock(self):
+        fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+
+
+
+    def write(self, image, dt=None, capture_time=None, exposure_level=None,
+            zenith=None, azimuth=None):
+        """
+        Writes a frame into the next slot
+
+        :param image: array (height, width[, channels]) or PIL image, at
+            most the maximum shape of the ring
+        :param dt: datetime, optional, time of the frame (UTC)
+        :param capture_time: datetime, optional, estimated time of exposure
+        :param exposure_level, zenith, azimuth: float, optional, metadata
+
+        :returns: int, sequence number of the frame
+        """
+        import archive
+
+        array = np.asarray(image, dtype=np.uint8)
+        if array.ndim == 2: array = array[:, :, None]
+        h, w, c = array.shape
+        if h > self.shape[0] or w > self.shape[1] or c != self.shape[2]:
+            raise ValueError("Frame of shape %s does not fit into ring of " \
+                "shape %s" % (array.shape, self.shape))
+
+        nan = float("nan")
+        values = {
+            'time': archive.to_timestamp(dt) if dt else time.time(),
+            'capture_time': archive.to_timestamp(capture_time) \
+                if capture_time else nan,
+            'exposure_level': nan if exposure_level is None else exposure_level,
+            'zenith': nan if zenith is None else zenith,
+            'azimuth': nan if azimuth is None else azimuth,
+            'height': h,
+            'width': w,
+        }
+
+        self._lock()
+        try:
+            seq = int(self.header['seq']) + 1
+            i = seq % self.slots
+            # sequence 0 marks the slot as being written
+            self.meta['seq'][i] = 0
+            self.frames[i, :h, :w] = array
+            for k, v in values.items(): self.meta[k][i] = v
+            self.meta['seq'][i] = seq
+            self.header['seq'] = seq
+        finally:
+            self._unlock()
+
+        return seq
+
+
+
+    def sequence(self):
+        """ Returns the sequence number of the last written frame """
+        return int(self.header['seq'])
+
+
+
+    def _frame(self, i):
+        slot = self.meta[i]
+        meta = dict((k, slot[k].item()) for k in META.names)
+        view = self.frames[i, :meta['height'], :meta['width']]
+        if self.shape[2] == 1: view = view[:, :, 0]
+
+        return meta, view
+
+
+
+    def latest(self, n=1):
+        """
+        Returns the latest frames as zero-copy views
+
+        :param n: int, optional, number of frames (at most slots - 1)
+
+        :returns: (metadata dictionary, array) for n=1 (None if the ring is
+            empty), otherwise list of them, newest first
+        """
+        n = min(n, self.slots - 1)
+        seq = self.sequence()
+        frames = []
+        for s in range(seq, max(seq - n, 0), -1):
+            meta, view = self._frame(s % self.slots)
+            if meta['seq'] != s: continue
+            frames.append((meta, view))
+
+        if n == 1: return frames[0] if frames else None
+
+        return frames
+
+
+
+    def valid(self, meta):
+        """
+        Returns whether the view of a frame returned by latest still holds
+        this frame (was not overwritten)
+        """
+        return int(self.meta[meta['seq'] % self.slots]['seq']) == meta['seq']
+
+
+
+    def wait(self, seq, timeout=None, poll=0.02):
+        """
+        Waits for a frame newer than seq
+
+        :returns: int, the new sequence number, or None after the timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.sequence() <= seq:
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(poll)
+
+        return self.sequence()
+
+
+
+    def close(self):
+        """ Detaches from the ring, the owner also removes it """
+        self.header = self.meta = self.frames = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # views are still in use, the memory is released with them
+            pass
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+        if self.lockfile is not None: self.lockfile.close()
+        if self.owner and os.path.exists(self.lockname):
+            os.remove(self.lockname)
+
+
+
+    def __enter__(self):
+        return self
+
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+
+
+def ring_step(frame):
+    """
+    Processing step (see pipeline module): writes the decoded frame into the
+    ring of its camera, which has to be created by the acquisition before.
+
+    Uses config key 'ring_scale' (optional, DCT downscale factor 1, 2, 4 or
+    8, see preview.open_scaled). At full scale the decoded image is kept in
+    frame['image'] for the following steps, so the frame is decoded only
+    once. Metadata is taken from the frame keys 'capture_time', 'exposure'
+    and 'features'.
+
+    Frames larger than the ring are downscaled to fit. Failures are printed
+    and the frame is passed on, so the ring never costs the archive a frame.
+    """
+    try:
+        _write_ring(frame)
+    except Exception as e:
+        print('Ring of ', frame['camera'], ' not written at ', frame['dt'],
+            ' -> ', repr(e))
+
+    return frame
+
+
+
+def _write_ring(frame):
+    import preview
+
+    scale = frame['config'].get('ring_scale', 1)
+    if scale == 1:
+        if 'image' not in frame:
+            frame['image'] = preview.open_scaled(io.BytesIO(frame['data']))
+            frame['image'].load()
+        image = frame['image']
+    else:
+        image = preview.open_scaled(io.BytesIO(frame['data']), scale)
+        image.load()
+
+    camera = frame['camera']
+    if camera not in _rings: _rings[camera] = frame_ring(camera)
+    rb = _rings[camera]
+    if rb.shape[2] == 1 and image.mode != "L": image = image.convert("L")
+    if rb.shape[2] == 3 and image.mode != "RGB": image = image.convert("RGB")
+    w, h = image.size
+    if h > rb.shape[0] or w > rb.shape[1]:
+        f = min(rb.shape[0] / float(h), rb.shape[1] / float(w))
+        image = image.resize((min(rb.shape[1], int(w * f)),
+            min(rb.shape[0], int(h * f))))
+
+    values = dict(frame.get('features', {}))
+    values.update(frame.get('exposure', {}))
+    rb.write(image, dt=frame['dt'], capture_time=frame.get('capture_time'),
+        exposure_level=values.get('exposure_level'),
+        zenith=values.get('zenith'), azimuth=values.get('azimuth'))
+
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 2:
+        print("Usage: python ring.py camera")
+        sys.exit(1)
+    with frame_ring(sys.argv[1]) as rb:
+        print("%s: %d slots of %s, sequence %d" % (rb.name, rb.slots,
+            rb.shape, rb.sequence()))
+        for meta, view in rb.latest(rb.slots - 1):
+            print(meta)
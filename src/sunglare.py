@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module measures the saturation and glare around the sun in each frame.
+
+The sun region is where the images fail: the disk saturates and the blooming
+spreads along the columns and into the circumsolar sky. Instead of a visual
+check, the expected position of the sun is computed from the solar angles
+(camera.solar_data) and the fisheye geometry of the camera, and the pixels
+around it are binned into rings of angular distance to the sun:
+
+    sun_saturated_area      solid angle of the saturated pixels (any
+                            channel >= saturation) within the outermost
+                            ring, in square degrees
+    sun_bloom_radius        outer edge (degrees) of the rings from the sun on
+                            in which at least bloom of the pixels are
+                            saturated, 0 if the disk itself is not saturated
+    circumsolar_brightness  mean brightness (0-1) of the rings between
+                            CIRCUMSOLAR degrees
+    sun_profile             mean brightness (0-1) of each ring, JSON list
+    glare_flag              1 if the blooming extends beyond glare_radius
+                            degrees, a data quality flag and an input for the
+                            exposure control
+
+All metrics are NULL when the sun is below the horizon. The rings are
+computed for a batch of frames at once (glare_metrics), either in the
+pipeline (glare_step, batch of one frame) or in a pass over the archive
+(analyze), which updates the index.
+
+The geometry is that of an equidistant fisheye (the angular distance from the
+zenith is proportional to the distance from the image center). Each pixel is
+back-projected to its direction on the sky once per image size, the rings
+use the great-circle distance of these directions to the sun.
+
+Example::
+
+    geometry = fisheye(center=(768, 768), radius=740, size=(1536, 1536))
+    m = glare_metrics(images, zenith, azimuth, geometry)
+    print(m['bloom_radius'], m['glare'])
+
+    python sunglare.py archive.db latitude longitude geometry.json [camera]
+
+
+Package requirements:
+    numpy, PIL (glare_step)
+"""
+
+import io
+import sys
+import json
+import concurrent.futures
+import numpy as np
+
+
+# Edges of the rings around the sun (degrees of angular distance)
+RINGS = (0., 1., 2., 3., 5., 7.5, 10., 15., 20., 30., 45.)
+
+# Rings of the circumsolar brightness (degrees)
+CIRCUMSOLAR = (5., 15.)
+
+# Index columns written by glare_step and analyze
+COLUMNS = ("sun_saturated_area", "sun_bloom_radius", "circumsolar_brightness",
+    "sun_profile", "glare_flag")
+
+# Pixel directions of geometries and image sizes, see fisheye.grid
+_grids = {}
+
+
+
+class fisheye():
+    """
+    Geometry of an upward looking equidistant fisheye camera
+
+    :param center: tuple, (x, y) pixel of the zenith in the full resolution
+        image
+    :param radius: float, distance from the zenith to the horizon in pixels
+        of the full resolution image
+    :param size: tuple, (width, height) of the full resolution image, scaled
+        frames (previews, adaptive requests) are mapped by their width
+    :param north: float, optional, direction of north in the image, degrees
+        clockwise from up
+    :param flip: boolean, optional, east is left of north (view from below,
+        the image is not mirrored)
+    """
+
+    def __init__(self, center, radius, size, north=0., flip=True):
+        self.center = tuple(float(c) for c in center)
+        self.radius = float(radius)
+        self.size = tuple(int(s) for s in size)
+        self.north = float(north)
+        self.flip = flip
+
+
+
+    def _factor(self, size):
+        return 1. if size is None else size[0] / float(self.size[0])
+
+
+
+    def degrees_per_pixel(self, size=None):
+        """ Returns the angular size of a pixel at the zenith """
+        return 90. / (self.radius * self._factor(size))
+
+
+
+    def project(self, zenith, azimuth, size=None):
+        """
+        Returns the image position of directions of the sky
+
+        :param zenith, azimuth: float or array, angles in degrees (azimuth
+            clockwise from north)
+        :param size: tuple, optional, (width, height) of the image, default
+            the full resolution
+
+        :returns: (x, y), arrays of pixel coordinates
+        """
+        f = self._factor(size)
+        r = np.asarray(zenith, dtype=float) / 90. * self.radius * f
+        azimuth = np.asarray(azimuth, dtype=float)
+        angle = np.radians(self.north + (-azimuth if self.flip else azimuth))
+
+        return self.center[0] * f + r * np.sin(angle), \
+            self.center[1] * f - r * np.cos(angle)
+
+
+
+    def back_project(self, x, y, size=None):
+        """
+        Returns the directions of the sky of image positions, the inverse of
+        project
+
+        :param x, y: float or array, pixel coordinates
+        :param size: tuple, optional, (width, height) of the image
+
+        :returns: (zenith, azimuth), arrays in degrees
+        """
+        f = self._factor(size)
+        dx = np.asarray(x, dtype=float) - self.center[0] * f
+        dy = np.asarray(y, dtype=float) - self.center[1] * f
+        zenith = np.hypot(dx, dy) / (self.radius * f) * 90.
+        angle = np.degrees(np.arctan2(dx, -dy))
+        azimuth = (self.north - angle) if self.flip else (angle - self.north)
+
+        return zenith, np.mod(azimuth, 360.)
+
+
+
+    def grid(self, size=None):
+        """
+        Returns the unit vectors (east, north, up) of the directions of all
+        pixels, array (height, width, 3), and the solid angle of each pixel
+        in square degrees, array (height, width); computed once per geometry
+        and image size
+        """
+        w, h = size if size is not None else self.size
+        key = (self.center, self.radius, self.size, self.north, self.flip,
+            (w, h))
+        if key not in _grids:
+            y, x = np.mgrid[0:h, 0:w]
+            zenith, azimuth = self.back_project(x, y, (w, h))
+            vectors = direction(zenith, azimuth).astype(np.float32)
+            # equidistant projection: sin(z) / z times the area at the zenith
+            z = np.radians(zenith)
+            area = self.degrees_per_pixel((w, h)) ** 2 * \
+                np.where(z > 0, np.sin(z) / np.where(z > 0, z, 1.), 1.)
+            _grids[key] = vectors, area
+            while len(_grids) > 8: _grids.pop(next(iter(_grids)))
+
+        return _grids[key]
+
+
+
+    def mask(self, size=None):
+        """ Returns a boolean array (height, width) of the pixels above the
+        horizon """
+        f = self._factor(size)
+        w, h = size if size is not None else self.size
+        y, x = np.ogrid[0:h, 0:w]
+
+        return (x - self.center[0] * f) ** 2 + (y - self.center[1] * f) ** 2 \
+            <= (self.radius * f) ** 2
+
+
+
+def direction(zenith, azimuth):
+    """ Returns unit vectors (east, north, up) of directions in degrees,
+    array (..., 3) """
+    z = np.radians(zenith)
+    a = np.radians(azimuth)
+
+    return np.stack([np.sin(z) * np.sin(a), np.sin(z) * np.cos(a), np.cos(z)],
+        axis=-1)
+
+
+
+def _geometry(geometry):
+    """ Returns a fisheye object of a fisheye or its parameters (dict) """
+    return geometry if isinstance(geometry, fisheye) else fisheye(**geometry)
+
+
+
+def glare_metrics(images, zenith, azimuth, geometry, rings=RINGS,
+        saturation=250, bloom=0.5, circumsolar=CIRCUMSOLAR, glare_radius=5.):
+    """
+    Computes the sun region metrics of a batch of frames of the same size
+
+    :param images: array (frames, height, width[, channels]), uint8
+    :param zenith, azimuth: arrays (frames), solar angles in degrees
+    :param geometry: fisheye object or its parameters (dict)
+    :param rings: list, optional, ring edges in degrees from the sun
+    :param saturation: int, optional, pixel value of saturated pixels
+    :param bloom: float, optional, saturated fraction of a ring of the
+        blooming region
+    :param circumsolar: tuple, optional, inner and outer degrees of the
+        circumsolar brightness
+    :param glare_radius: float, optional, bloom radius (degrees) from which
+        on a frame is flagged
+
+    :returns: dictionary of arrays (frames): 'sun_x', 'sun_y' (pixels of the
+        images), 'saturated_area', 'bloom_radius', 'circumsolar_brightness',
+        'glare' (boolean) and arrays (frames, rings) 'profile' and
+        'saturated_fraction'; NaN (glare False) if the sun is below the
+        horizon
+    """
+    geometry = _geometry(geometry)
+    images = np.asarray(images)
+    if images.ndim == 3: images = images[:, :, :, None]
+    n, h, w = images.shape[:3]
+    zenith = np.asarray(zenith, dtype=float).reshape(n)
+    azimuth = np.asarray(azimuth, dtype=float).reshape(n)
+    edges = np.asarray(rings, dtype=float)
+    k = len(edges) - 1
+
+    # luminance and saturation of any channel
+    if images.shape[3] == 1:
+        luminance = images[:, :, :, 0].astype(np.float32)
+        saturated = images[:, :, :, 0] >= saturation
+    else:
+        luminance = images.mean(axis=3, dtype=np.float32)
+        saturated = images.max(axis=3) >= saturation
+
+    # ring of each pixel: great-circle distance to the sun of its frame
+    visible = zenith < 90.
+    x, y = geometry.project(np.where(visible, zenith, 0.), azimuth, (w, h))
+    vectors, pixel_area = geometry.grid((w, h))
+    sun = direction(np.where(visible, zenith, 0.), azimuth).astype(np.float32)
+    cosine = np.einsum("hwk,nk->nhw", vectors, sun)
+    distance = np.degrees(np.arccos(np.clip(cosine, -1., 1.)))
+    ring = np.searchsorted(edges, distance, side="right") - 1
+    valid = (ring >= 0) & (ring < k) & geometry.mask((w, h))[None] & \
+        visible[:, None, None]
+
+    # per frame and ring sums in one pass
+    idx = (np.arange(n)[:, None, None] * k + ring)[valid]
+    count = np.bincount(idx, minlength=n * k).reshape(n, k).astype(float)
+    total = np.bincount(idx, weights=luminance[valid],
+        minlength=n * k).reshape(n, k)
+    nsat = np.bincount(idx, weights=saturated[valid],
+        minlength=n * k).reshape(n, k)
+    area = np.bincount(idx, weights=(saturated * pixel_area[None])[valid],
+        minlength=n * k).reshape(n, k).sum(axis=1)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        profile = total / count / 255.
+        fraction = nsat / count
+        inner = (edges[:-1] >= circumsolar[0]) & (edges[1:] <= circumsolar[1])
+        brightness = total[:, inner].sum(axis=1) / \
+            count[:, inner].sum(axis=1) / 255.
+
+    # blooming: consecutive saturated rings from the sun on
+    blooming = np.cumprod(np.nan_to_num(fraction) >= bloom, axis=1).sum(axis=1)
+    radius = edges[blooming]
+
+    nan = np.nan
+    metrics = {
+        'sun_x': np.where(visible, x, nan),
+        'sun_y': np.where(visible, y, nan),
+        'saturated_area': np.where(visible, area, nan),
+        'bloom_radius': np.where(visible, radius, nan),
+        'circumsolar_brightness': np.where(visible, brightness, nan),
+        'profile': np.where(visible[:, None], profile, nan),
+        'saturated_fraction': np.where(visible[:, None], fraction, nan),
+        'glare': visible & (radius >= glare_radius),
+    }
+
+    return metrics
+
+
+
+def to_columns(metrics, i):
+    """
+    Returns the index columns of frame i of glare_metrics (None for
+    undefined values)
+    """
+    def value(v):
+        v = float(v)
+        return None if np.isnan(v) else v
+
+    if np.isnan(metrics['sun_x'][i]): return dict((c, None) for c in COLUMNS)
+
+    profile = [None if np.isnan(v) else round(float(v), 4) \
+        for v in metrics['profile'][i]]
+
+    return {
+        'sun_saturated_area': value(metrics['saturated_area'][i]),
+        'sun_bloom_radius': value(metrics['bloom_radius'][i]),
+        'circumsolar_brightness': value(metrics['circumsolar_brightness'][i]),
+        'sun_profile': json.dumps(profile),
+        'glare_flag': int(metrics['glare'][i]),
+    }
+
+
+
+def glare_step(frame):
+    """
+    Processing step (see pipeline module): adds the sun region metrics to
+    frame['index'] and frame['features']. Has to run before archive.index_step.
+
+    Uses config keys 'geometry' (fisheye parameters as dictionary, the step
+    does nothing without), 'glare_scale' (optional, DCT downscale factor,
+    default 4) and 'latitude', 'longitude' (if the frame features have no
+    zenith and azimuth).
+    """
+    import preview
+
+    config = frame['config']
+    if not config.get('geometry'): return frame
+    geometry = _geometry(config['geometry'])
+
+    values = frame.get('features', {})
+    if values.get('zenith') is not None:
+        zenith, azimuth = values['zenith'], values['azimuth']
+    else:
+        import camera
+        sd = camera.solar_data([frame['dt']], config['latitude'],
+            config['longitude'])
+        zenith, azimuth = sd['zenith'][0], sd['azimuth'][0]
+
+    if zenith >= 90.:
+        columns = dict((c, None) for c in COLUMNS)
+    else:
+        scale = config.get('glare_scale', 4)
+        if scale == 1 and 'image' in frame:
+            image = frame['image']
+        else:
+            image = preview.open_scaled(io.BytesIO(frame['data']), scale)
+        if image.mode not in ("L", "RGB"): image = image.convert("RGB")
+        metrics = glare_metrics(np.asarray(image)[None], [zenith], [azimuth],
+            geometry)
+        columns = to_columns(metrics, 0)
+
+    frame.setdefault('index', {}).update(columns)
+    if 'features' in frame:
+        for c in COLUMNS:
+            if c != 'sun_profile': frame['features'][c] = columns[c]
+
+    return frame
+
+
+
+def analyze(source, lat, lon, geometry, camera=None, start=None, end=None,
+        scale=4, batch=32, workers=4, **kwargs):
+    """
+    Computes the sun region metrics of archived daytime frames in batches and
+    writes them to the index. Frames which can not be read are skipped and
+    counted.
+
+    :param source: archive.archive_index or path of the database
+    :param lat, lon: float, location of the camera (degrees)
+    :param geometry: fisheye object or its parameters (dict)
+    :param camera, start, end: selection of the frames (see
+        archive_index.query)
+    :param scale: int, optional, DCT downscale factor of the frames
+    :param batch: int, optional, frames per batch
+    :param workers: int, optional, number of decoding threads
+    :param kwargs: further parameters of glare_metrics
+
+    :returns: dictionary with 'frames', 'flagged' and 'failed'
+    """
+    import archive
+    import reader
+    import camera as cam
+
+    def load(locator):
+        try:
+            return reader.load_frame(locator, scale, "RGB")
+        except Exception as e:
+            print('Frame ', locator, ' could not be read -> ', repr(e))
+            return None
+
+    idx = archive.archive_index(source) if isinstance(source, str) else source
+    # frames with the sun above the horizon (by the index), the paths of the
+    # metrics are taken from this single query
+    frames = reader.archive_reader(idx).locate(camera, start, end,
+        max_zenith=90)
+    stats = {'frames': 0, 'flagged': 0, 'failed': 0}
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        parts = [frames[i:i + batch] for i in range(0, len(frames), batch)]
+        # the next batch is decoded while the metrics of a batch are computed
+        pending = [pool.submit(load, loc) for dt, loc in parts[0]] \
+            if parts else []
+        for n, part in enumerate(parts):
+            images = [future.result() for future in pending]
+            pending = [pool.submit(load, loc) for dt, loc in parts[n + 1]] \
+                if n + 1 < len(parts) else []
+            sd = cam.solar_data([dt for dt, loc in part], lat, lon)
+
+            # frames of one size (see adaptive module) are computed together
+            groups = {}
+            for i, img in enumerate(images):
+                if img is None:
+                    stats['failed'] += 1
+                else:
+                    groups.setdefault(img.shape, []).append(i)
+            records = []
+            for members in groups.values():
+                metrics = glare_metrics(np.stack([images[i] for i in members]),
+                    np.asarray(sd['zenith'])[members],
+                    np.asarray(sd['azimuth'])[members], geometry, **kwargs)
+                for k, i in enumerate(members):
+                    columns = to_columns(metrics, k)
+                    columns['path'] = part[i][1]
+                    records.append(columns)
+                stats['flagged'] += int(metrics['glare'].sum())
+            idx.update_many(records)
+            stats['frames'] += len(records)
+
+    return stats
+
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) not in (5, 6):
+        print("Usage: python sunglare.py index.db latitude longitude " \
+            "geometry.json [camera]")
+        sys.exit(1)
+
+    with open(sys.argv[4]) as f:
+        geometry = json.load(f)
+    print(analyze(sys.argv[1], float(sys.argv[2]), float(sys.argv[3]),
+        geometry, camera=sys.argv[5] if len(sys.argv) > 5 else None))
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module provides tracing hooks for the stages of the acquisition.
+
+When a site falls behind, it has to be found out where the time goes: in
+the connection (TCP/TLS setup until the response header), the transfer of
+the image, decoding, loading the font, drawing, saving, copying or indexing.
+Each of these stages is wrapped in a span:
+
+    with tracing.span("save"):
+        image.save(fname)
+
+A span measures its duration and passes a record to all registered hooks.
+The record is a dictionary with
+
+    'stage'     name of the stage
+    'camera'    camera id
+    'dt'        frame timestamp (datetime, UTC) or None
+    'start'     start time (unix time)
+    'duration'  duration in seconds
+    'pid'       process id
+
+plus further attributes given to the span. Camera id and frame timestamp are
+taken from the enclosing frame context (see frame), which the acquisition
+loop and the processing pipeline open for every frame.
+
+Without registered hooks a span costs only an attribute lookup. A hook is a
+function receiving the record; the included profiler is a hook writing the
+records of a sample of the frames as JSON lines to a file. The processing
+steps of the pipeline are spans "step.<name>" enclosing the spans of their
+stages. The per-stage breakdown of such a file is printed by
+
+    python tracing.py profile.jsonl
+
+Hooks are inherited by the worker processes of the pipeline if they are
+added before the pipeline is started.
+
+
+Package requirements:
+    none (python standard library)
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import threading
+import contextvars
+
+
+# Registered hooks
+_hooks = []
+
+# Camera id and frame timestamp of the current frame
+_frame = contextvars.ContextVar("frame", default=("", None))
+
+
+
+def add_hook(hook):
+    """
+    Registers a hook, a function called with the record of each finished span
+    """
+    _hooks.append(hook)
+
+
+
+def remove_hook(hook):
+    """ Removes a hook """
+    if hook in _hooks: _hooks.remove(hook)
+
+
+
+
+
+class frame():
+    """
+    Context of a frame, spans inside get its camera id and timestamp
+
+    :param camera: string, camera id
+    :param dt: datetime, frame timestamp (UTC)
+    """
+
+    def __init__(self, camera="", dt=None):
+        self.value = (camera, dt)
+        self.token = None
+
+
+
+    def __enter__(self):
+        self.token = _frame.set(self.value)
+        return self
+
+
+
+    def __exit__(self, *args):
+        _frame.reset(self.token)
+
+
+
+
+
+class span():
+    """
+    Measures the duration of a stage and reports it to the hooks
+
+    :param stage: string, name of the stage
+    :param camera: string, optional, camera id, default from frame context
+    :param attrs: further attributes of the record
+    """
+
+    __slots__ = ("stage", "camera", "attrs", "start", "wall")
+
+    def __init__(self, stage, camera=None, **attrs):
+        self.stage = stage
+        self.camera = camera
+        self.attrs = attrs
+        self.start = None
+
+
+
+    def __enter__(self):
+        if _hooks:
+            self.wall = time.time()
+            self.start = time.perf_counter()
+        return self
+
+
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.start is None: return
+        duration = time.perf_counter() - self.start
+        camera, dt = _frame.get()
+        record = dict(self.attrs)
+        record['stage'] = self.stage
+        record['camera'] = self.camera if self.camera is not None else camera
+        record['dt'] = dt
+        record['start'] = self.wall
+        record['duration'] = duration
+        record['pid'] = os.getpid()
+        if exc_type is not None: record['error'] = exc_type.__name__
+        for hook in list(_hooks):
+            try:
+                hook(record)
+            except Exception as e:
+                print('Tracing hook failed -> ', repr(e))
+
+
+
+
+
+class profiler():
+    """
+    Hook writing the spans of a sample of frames to a file (JSON lines).
+
+    The sampling decision is made per frame from camera id and timestamp, so
+    all stages of a sampled frame are recorded, also in worker processes.
+
+    :param fname: string, output file, records are appended
+    :param sample: float, optional, fraction of frames to record (0-1)
+    """
+
+    def __init__(self, fname, sample=1.0):
+        self.fname = fname
+        self.sample = sample
+        self.lock = threading.Lock()
+
+
+
+    def sampled(self, camera, dt):
+        """ Returns whether the frame belongs to the sample """
+        if self.sample >= 1: return True
+        key = ("%s %s" % (camera, dt)).encode("utf-8")
+
+        return zlib.crc32(key) / 4294967296. < self.sample
+
+
+
+    def __call__(self, record):
+        if not self.sampled(record['camera'], record['dt']): return
+        rec = dict(record)
+        if rec['dt'] is not None: rec['dt'] = rec['dt'].isoformat()
+        line = json.dumps(rec, default=str) + "\n"
+        # a single write in append mode, lines of processes do not mix
+        with self.lock:
+            fd = os.open(self.fname, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                0o644)
+            try:
+                os.write(fd, line.encode("utf-8"))
+            finally:
+                os.close(fd)
+
+
+
+    def start(self):
+        """ Registers the profiler as hook """
+        add_hook(self)
+        return self
+
+
+
+    def stop(self):
+        """ Removes the profiler from the hooks """
+        remove_hook(self)
+
+
+
+
+
+def summarize(fname):
+    """
+    Computes the per-stage timing breakdown of a profile file
+
+    :param fname: string, file written by profiler
+
+    :returns: dictionary stage -> dictionary with 'count', 'total', 'mean',
+        'p50', 'p95' and 'max' (seconds)
+    """
+    durations = {}
+    with open(fname) as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            durations.setdefault(rec['stage'], []).append(rec['duration'])
+
+    summary = {}
+    for stage, values in durations.items():
+        values.sort()
+        n = len(values)
+        summary[stage] = {
+            'count': n,
+            'total': sum(values),
+            'mean': sum(values) / n,
+            'p50': values[int(0.5 * (n - 1))],
+            'p95': values[int(0.95 * (n - 1))],
+            'max': values[-1],
+        }
+
+    return summary
+
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) != 2:
+        print("Usage: python tracing.py profile.jsonl")
+        sys.exit(1)
+    summary = summarize(sys.argv[1])
+    print("%-20s %8s %10s %10s %10s %10s" % ("stage", "count", "mean ms",
+        "p50 ms", "p95 ms", "max ms"))
+    for stage, s in sorted(summary.items(), key=lambda x: -x[1]['total']):
+        print("%-20s %8d %10.2f %10.2f %10.2f %10.2f" % (stage, s['count'],
+            s['mean'] * 1e3, s['p50'] * 1e3, s['p95'] * 1e3, s['max'] * 1e3))
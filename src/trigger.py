@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+This module decides whether a frame has to be captured (change trigger).
+
+At night and under uniform overcast consecutive frames are nearly identical,
+nevertheless all 8640 frames of a day (10 s interval) are downloaded,
+annotated and archived. In conditional capture mode, a cheap probe frame in
+low resolution and quality is requested first (a few kB) and its features
+are compared with those of the probe of the last stored frame:
+
+    - perceptual hash (see fingerprint.phash), changes of the structure of
+      the sky (clouds)
+    - mean brightness, changes of the illumination which the hash ignores
+
+The full frame is only downloaded and archived if the hash distance or the
+brightness change exceeds its threshold, or if the last stored frame is
+older than max_age seconds (the archive still gets a frame at least every
+max_age seconds). The probe becomes the reference of the following frames
+only when the caller confirms with accept that the full frame was stored; a
+failed download or a discarded frame keeps the previous reference. With a
+processing pipeline, accept is called with the slot time when the frame was
+archived (e.g. in the pipeline callback), the frames of later slots may have
+been checked in the meantime.
+
+Per day, the trigger counts the slots, captured and skipped frames, the
+bytes of the probes and the full frames and estimates the saved bytes
+(skipped frames times the mean size of the full frames of the day, less the
+probe bytes), see daily. The summary of a day is printed when the next day
+starts, only the counters of the current day are kept.
+
+Example::
+
+    trig = change_trigger()
+    probe, info = cam.capture(resolution=trig.resolution,
+        quality=trig.quality)
+    decision = trig.check(probe, dt)
+    if decision['capture']:
+        data = cam.download_image()
+        store(data)
+        trig.accept(dt)
+    trig.record(dt, probe, data if decision['capture'] else None)
+
+The probe is requested with the resolution and quality options of the camera
+model (camera.driver.image_params); models without these options deliver the
+full frame as probe, which saves storage but no bandwidth.
+
+
+Package requirements:
+    PIL, numpy
+"""
+
+import io
+import threading
+import collections
+import numpy as np
+
+import fingerprint
+
+
+# Maximum number of capture decisions waiting for accept
+MAX_PENDING = 256
+
+
+
+def probe_features(data):
+    """
+    Computes the features of a probe frame
+
+    :param data: bytes, encoded image
+
+    :returns: (int, float), perceptual hash and mean brightness (0-1)
+    """
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(data))
+    img.draft("L", (img.size[0] // 8, img.size[1] // 8))
+    img = img.convert("L")
+
+    return fingerprint.phash(img), float(np.asarray(img).mean()) / 255.
+
+
+
+
+
+class change_trigger():
+    """
+    Change trigger of the conditional capture
+
+    :param threshold: int, optional, minimum Hamming distance of the hashes
+        for a change
+    :param brightness: float, optional, minimum change of the mean
+        brightness (fraction of the full range) for a change
+    :param max_age: float, optional, maximum age of the last stored frame in
+        seconds
+    :param resolution: string, optional, resolution of the probe request
+    :param quality: optional, JPEG quality of the probe request
+    """
+
+    def __init__(self, threshold=6, brightness=0.05, max_age=600.,
+            resolution="256x256", quality=1):
+        self.threshold = threshold
+        self.brightness = brightness
+        self.max_age = max_age
+        self.resolution = resolution
+        self.quality = quality
+
+        # features and time of the probe of the last stored frame, features
+        # of the capture decisions waiting for accept (slot time -> features)
+        self.reference = None
+        self.reference_time = None
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        # day (YYYYMMDD) -> counters
+        self.days = {}
+
+
+
+    def check(self, probe, dt):
+        """
+        Decides whether the full frame has to be captured. If so, the probe
+        becomes the reference of the following frames after accept.
+
+        :param probe: bytes, encoded probe frame
+        :param dt: datetime, time of the slot (UTC)
+
+        :returns: dictionary with 'capture' (boolean), 'reason' ("first",
+            "change", "brightness", "max_age" or None), 'distance' and
+            'brightness_change' (None for the first frame)
+        """
+        features = probe_features(probe)
+        decision = {'capture': False, 'reason': None, 'distance': None,
+            'brightness_change': None}
+        with self.lock:
+            self._decide(features, dt, decision)
+
+        return decision
+
+
+
+    def _decide(self, features, dt, decision):
+        if self.reference is None:
+            decision['reason'] = "first"
+        else:
+            decision['distance'] = fingerprint.distance(features[0],
+                self.reference[0])
+            decision['brightness_change'] = abs(features[1] - self.reference[1])
+            age = (dt - self.reference_time).total_seconds()
+            if decision['distance'] >= self.threshold:
+                decision['reason'] = "change"
+            elif decision['brightness_change'] >= self.brightness:
+                decision['reason'] = "brightness"
+            elif age >= self.max_age:
+                decision['reason'] = "max_age"
+
+        if decision['reason'] is not None:
+            decision['capture'] = True
+            self.pending[dt] = features
+            # frames which were never stored
+            while len(self.pending) > MAX_PENDING: self.pending.popitem(False)
+
+
+
+    def accept(self, dt=None):
+        """
+        Confirms that the full frame of a capture decision was stored, its
+        probe becomes the reference of the following frames unless a later
+        frame was accepted before
+
+        :param dt: datetime, optional, time of the slot, default the last
+            capture decision
+        """
+        with self.lock:
+            if not self.pending: return
+            if dt is None: dt = next(reversed(self.pending))
+            if dt not in self.pending: return
+            features = self.pending.pop(dt)
+            if self.reference_time is not None and dt <= self.reference_time:
+                return
+            self.reference, self.reference_time = features, dt
+            # decisions of earlier slots can no longer become the reference
+            for t in [t for t in self.pending if t < dt]: del self.pending[t]
+
+
+
+    def record(self, dt, probe, data=None):
+        """
+        Counts a slot for the daily report
+
+        :param dt: datetime, time of the slot (UTC)
+        :param probe: bytes, the probe frame (or its size)
+        :param data: bytes, optional, the full frame if it was captured (or
+            its size)
+        """
+        day = dt.strftime("%Y%m%d")
+        if day not in self.days:
+            # report the previous day when a new day starts
+            if self.days:
+                last = max(self.days)
+                print('Conditional capture ', last, ': ', self.daily(last))
+                self.days.clear()
+            self.days[day] = {'slots': 0, 'captured': 0, 'skipped': 0,
+                'probe_bytes': 0, 'frame_bytes': 0}
+        counts = self.days[day]
+        counts['slots'] += 1
+        counts['probe_bytes'] += probe if isinstance(probe, int) else len(probe)
+        if data is None:
+            counts['skipped'] += 1
+        else:
+            counts['captured'] += 1
+            counts['frame_bytes'] += data if isinstance(data, int) else len(data)
+
+
+
+    def daily(self, day=None):
+        """
+        Returns the counters and savings of a day
+
+        :param day: string, optional, YYYYMMDD, default the current day
+
+        :returns: dictionary with 'slots', 'captured', 'skipped',
+            'probe_bytes', 'frame_bytes', 'saved_bytes' (estimated download
+            and storage savings) and 'saved_fraction'
+        """
+        if day is None: day = max(self.days) if self.days else None
+        if day not in self.days: return {}
+        stats = dict(self.days[day])
+
+        mean = stats['frame_bytes'] / float(stats['captured']) \
+            if stats['captured'] else 0.
+        saved = stats['skipped'] * mean - stats['probe_bytes']
+        stats['saved_bytes'] = saved
+        total = stats['slots'] * mean
+        stats['saved_fraction'] = saved / total if total > 0 else 0.
+
+        return stats
+
+
+
+    def stats(self):
+        """ Returns the counters of the current day (metrics collector) """
+        return self.daily()
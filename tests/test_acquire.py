@@ -0,0 +1,60 @@
+import time
+import threading
+
+import acquire
+import archive
+
+
+def test_next_slot():
+    sched = acquire.scheduler(10, offset=2.)
+    assert sched.next_slot(1000.) == 1002.
+    assert sched.next_slot(1002.) == 1012.
+    assert sched.next_slot(1011.9) == 1012.
+
+
+
+def test_slots_are_aligned():
+    sched = acquire.scheduler(0.05)
+    slots = []
+    for dt in sched:
+        slots.append(archive.to_timestamp(dt))
+        if len(slots) == 5: break
+    steps = [b - a for a, b in zip(slots, slots[1:])]
+    assert all(abs(s - 0.05) < 1e-6 for s in steps)
+    assert all(abs(t / 0.05 - round(t / 0.05)) < 1e-3 for t in slots)
+    assert sched.stats()['slots'] == 5 and sched.stats()['missed'] == 0
+    assert 0 <= sched.lag < 0.05
+
+
+
+def test_missed_slots():
+    sched = acquire.scheduler(0.05)
+    sched.wait()
+    time.sleep(0.16)
+    sched.wait()
+    assert sched.missed >= 2
+
+
+
+def test_stop_interrupts_wait():
+    sched = acquire.scheduler(60)
+    threading.Timer(0.05, sched.stopped.set).start()
+    t = time.monotonic()
+    assert sched.wait() is None
+    assert time.monotonic() - t < 5
+    assert list(sched) == []
+
+
+
+def test_service():
+    calls, stopped = [], []
+    def task(dt):
+        calls.append(dt)
+        if len(calls) == 2: raise RuntimeError("camera not reachable")
+        if len(calls) == 4: srv.stop()
+
+    srv = acquire.service(0.02, task, signals=False)
+    srv.add_stop_callback(lambda: stopped.append(True))
+    srv.run()
+    assert len(calls) == 4 and stopped == [True]
+    assert srv.stats()['errors'] == 1 and srv.stats()['slots'] == 4
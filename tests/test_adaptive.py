@@ -0,0 +1,81 @@
+import os
+
+import pytest
+from PIL import Image
+
+import adaptive
+import camera
+
+
+FONT = '/usr/share/fonts/liberation/LiberationSans-Bold.ttf'
+
+
+def timing(seconds, latency=0.5):
+    return {'send': 0., 'first_byte': latency, 'complete': latency + seconds}
+
+
+
+def test_night_and_variability():
+    policy = adaptive.request_policy(10, variable=4.)
+    assert policy.choose(40.)['level'] == 0
+    assert policy.choose(100.) == {'level': 3, 'resolution': "512x512",
+        'quality': 2}
+
+    # calm sky: second level, variable sky: best level
+    for i in range(5): policy.record(0, 300000, distance=1)
+    assert policy.choose(40.)['level'] == 1
+    for i in range(30): policy.record(0, 300000, distance=10)
+    assert policy.choose(40.)['level'] == 0
+
+
+
+def test_bandwidth_budget():
+    policy = adaptive.request_policy(10, budget=0.5)
+    # 300 kB in 1 s after a latency of 0.5 s: 300 kB/s
+    for i in range(5): policy.record(0, 300000, timing(1.), distance=10)
+    assert policy.bandwidth() == 300000
+    assert policy.choose(40.)['level'] == 0
+
+    # slow link, 20 kB/s: the budget of 10 kB/s allows 100 kB per frame
+    for i in range(30): policy.record(0, 300000, timing(15.), distance=10)
+    assert policy.bandwidth() == 20000
+    assert policy.expected_size(1) == 150000
+    assert policy.choose(40.)['level'] == 2
+    stats = policy.stats()
+    assert stats['utilization'] == 1.5 and stats['level_0'] == 35
+
+
+
+def test_latency_does_not_count():
+    policy = adaptive.request_policy(10)
+    policy.record(0, 100000, timing(0.1, latency=5.))
+    policy.record(0, 100000, {'first_byte': 1., 'complete': 1.})
+    assert abs(policy.bandwidth() - 1e6) < 1
+    assert len(policy.downloads) == 1
+
+
+
+def test_image_request():
+    cam = camera.create("vivotek", ip="10.0.0.1")
+    assert cam.image_request() == cam.image_url
+    assert cam.image_request("512x512", 2) == cam.image_url + \
+        "?resolution=512x512&quality=2"
+    mob = camera.create("mobotix", ip="10.0.0.1")
+    assert mob.image_request("512x512", 2) == mob.image_url
+
+
+
+def test_text_layout_scales():
+    if not os.path.exists(FONT): pytest.skip("font not installed")
+    full = Image.new("RGB", (camera.TEXT_WIDTH, camera.TEXT_WIDTH))
+    small = Image.new("RGB", (camera.TEXT_WIDTH // 4, camera.TEXT_WIDTH // 4))
+    for img in (full, small):
+        camera.add_text(img, dt=camera.datetime(2016, 6, 1, 12), loc="Roof")
+
+    def box(img):
+        return img.convert("L").point(lambda v: 255 if v else 0).getbbox()
+    b_full, b_small = box(full), box(small)
+    assert b_full is not None and b_small is not None
+    # the drawn text covers the same fraction of the image
+    for a, b in zip(b_full, b_small):
+        assert abs(a / 4. - b) <= 0.05 * small.size[0]
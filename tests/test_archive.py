@@ -0,0 +1,95 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import archive
+
+
+T0 = datetime(2016, 6, 1, 12)
+
+
+
+def make_index(tmp_path):
+    idx = archive.archive_index(str(tmp_path / "archive.db"))
+    idx.add_many([{'time': T0 + timedelta(seconds=10 * i), 'camera': camera,
+        'path': "%s/%d.jpg" % (camera, i), 'zenith': 30. + i, 'size': 100 * i}
+        for i in range(10) for camera in ("roof", "tower")])
+
+    return idx
+
+
+
+def test_timestamps():
+    dt = datetime(2016, 6, 1, 12, 0, 0, 250000)
+    assert archive.to_timestamp(dt) == 1464782400.25
+    assert archive.from_timestamp(archive.to_timestamp(dt)) == dt
+
+
+
+def test_query(tmp_path):
+    idx = make_index(tmp_path)
+    assert idx.count() == 20
+    assert idx.count("roof") == 10 and idx.count(["roof", "tower"]) == 20
+
+    recs = idx.query("roof", T0 + timedelta(seconds=20),
+        T0 + timedelta(seconds=60))
+    assert [r['path'] for r in recs] == ["roof/%d.jpg" % i for i in range(2, 6)]
+    assert recs[0]['time'] == T0 + timedelta(seconds=20)
+
+    assert idx.paths("tower", max_zenith=32.) == ["tower/0.jpg",
+        "tower/1.jpg", "tower/2.jpg"]
+    assert idx.count(min_zenith=38., max_size=800) == 2
+    assert idx.count("roof", where=("size > ?", 500)) == 4
+    with pytest.raises(ValueError):
+        idx.query(below_zenith=80)
+
+
+
+def test_update_and_replace(tmp_path):
+    idx = make_index(tmp_path)
+    idx.update_many([{'path': "roof/3.jpg", 'glare_flag': 1, 'zenith': 5.},
+        {'path': "unknown.jpg", 'glare_flag': 1}])
+    rec = idx.query(min_glare_flag=1)
+    assert len(rec) == 1 and rec[0]['zenith'] == 5.
+    with pytest.raises(ValueError):
+        idx.update_many([{'path': "roof/3.jpg", 'nothing': 1}])
+
+    # the path is unique, adding it again replaces the record
+    idx.add(T0, "roof", "roof/3.jpg", size=1)
+    assert idx.count() == 20 and "roof/3.jpg" in idx.paths(max_size=1)
+    idx.remove("roof/3.jpg")
+    assert idx.count("roof") == 9
+
+
+
+def test_old_database_gets_new_columns(tmp_path):
+    fname = str(tmp_path / "old.db")
+    db = sqlite3.connect(fname)
+    db.execute("CREATE TABLE frames (id INTEGER PRIMARY KEY, time REAL NOT " \
+        "NULL, camera TEXT NOT NULL, path TEXT NOT NULL UNIQUE)")
+    db.commit()
+    db.close()
+    with archive.archive_index(fname) as idx:
+        idx.add(T0, "roof", "a.jpg", phash="00ff", glare_flag=0)
+        assert idx.query()[0]['phash'] == "00ff"
+
+
+
+def test_build_from_directory(tmp_path):
+    outdir = tmp_path / "archive"
+    for i in range(3):
+        dt = T0 + timedelta(days=i)
+        day = outdir / dt.strftime("%Y%m%d")
+        day.mkdir(parents=True)
+        (day / dt.strftime("%Y%m%d_%H%M%S.jpg")).write_bytes(b"x" * (i + 1))
+        (day / dt.strftime("%Y%m%d_%H%M%S_p2.jpg")).write_bytes(b"preview")
+    assert [dt for dt, p in archive.scan_directory(str(outdir),
+        start=T0 + timedelta(days=1))] == [T0 + timedelta(days=1),
+        T0 + timedelta(days=2)]
+
+    with archive.archive_index(str(tmp_path / "a.db")) as idx:
+        assert idx.build(str(outdir), camera="roof") == 3
+        recs = idx.query("roof")
+        assert [r['size'] for r in recs] == [1, 2, 3]
+        assert recs[0]['checksum'] == archive.checksum(b"x")
@@ -0,0 +1,96 @@
+import urllib.parse
+
+import pytest
+
+import camera
+
+
+class fake_camera():
+    """ Answers the requests of a driver like a Vivotek camera """
+
+    def __init__(self, **params):
+        self.params = dict(params)
+        self.requests = []
+
+    def __call__(self, cam, url, operation, timeout=None, timing=None):
+        url = url if isinstance(url, str) else url.full_url
+        self.requests.append(operation)
+        path, query = url.split("?", 1)
+        if path.endswith("setparam.cgi"):
+            self.params.update(urllib.parse.parse_qsl(query))
+            return b"OK"
+        return "\n".join("%s='%s'" % (k, self.params.get(k, "")) \
+            for k in query.split("&")).encode()
+
+
+
+@pytest.fixture
+def cam(monkeypatch):
+    fake = fake_camera(videoin_c0_exposurelevel=6, videoin_c0_maxgain=100,
+        ircutcontrol_mode="day")
+    monkeypatch.setattr(camera, "_request", fake)
+    cam = camera.create("vivotek", ip="127.0.0.1", name="roof")
+    cam.fake = fake
+
+    return cam
+
+
+
+def test_registry():
+    assert camera.get_driver("vivotek") is camera.vivotek
+    assert camera.create("mobotix", ip="10.0.0.1", port=443).name == \
+        "10.0.0.1:443"
+    with pytest.raises(ValueError):
+        camera.create("unknown", ip="10.0.0.1")
+
+
+
+def test_parse_params(cam):
+    assert cam.parse_params("a='6'\nb=day\nc='-3'\nnoise") == {'a': 6,
+        'b': "day", 'c': -3}
+
+
+
+def test_mirror_skips_unchanged_settings(cam):
+    state = cam.get_state()
+    assert state['exposure_level'] == 6 and state['ircut_mode'] == "day"
+    assert cam.fake.requests == ["read_params"]
+
+    # the mirror is valid, no requests for unchanged settings
+    assert cam.get_state() == state
+    assert cam.set_exposure_level(6)
+    assert cam.fake.requests == ["read_params"]
+
+    assert cam.changed(exposure_level=8, maxgain=100) == {'exposure_level': 8}
+    assert cam.set_params("test", exposure_level=8, maxgain=100)
+    assert cam.fake.requests[-1] == "test"
+    assert cam.fake.params['videoin_c0_exposurelevel'] == "8"
+    # the unchanged gain was not sent (it would be the string "100")
+    assert cam.fake.params['videoin_c0_maxgain'] == 100
+    assert cam.state['exposure_level'] == 8
+
+    # forced or expired: all settings are sent
+    n = len(cam.fake.requests)
+    cam.set_params("test", force=True, exposure_level=8)
+    cam.state_ttl = -1
+    assert cam.changed(exposure_level=8) == {'exposure_level': 8}
+    assert len(cam.fake.requests) == n + 1
+
+
+
+def test_audit_and_external_changes(cam):
+    cam.get_state()
+    cam.fake.params['videoin_c0_exposurelevel'] = 3
+    assert cam.audit(exposure_level=6, ircut_mode="day") == \
+        {'exposure_level': (6, 3)}
+    assert cam.state['exposure_level'] == 3
+    assert cam.get_state(ttl=0)['exposure_level'] == 3
+
+
+
+def test_unsupported_settings(cam):
+    n = len(cam.fake.requests)
+    assert not cam.set_params("test", shutter=5)
+    assert not camera.create("mobotix", ip="10.0.0.1").set_exposure_level(6)
+    assert camera.create("mobotix", ip="10.0.0.1").read_params() is None
+    assert len(cam.fake.requests) == n
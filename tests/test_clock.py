@@ -0,0 +1,51 @@
+import email.utils
+
+import camera
+
+
+def date(t):
+    """ HTTP Date header of a camera clock at unix time t (full seconds) """
+    return email.utils.formatdate(int(t), usegmt=True)
+
+
+
+def test_offset_converges():
+    offset = 3.4
+    clock = camera.clock_estimator()
+    assert clock.offset() == (None, None)
+    t = 1465000000.
+    for i in range(20):
+        send = t + i * 10.37
+        first_byte = send + 0.02
+        clock.add(date(send + 0.01 + offset), send, first_byte)
+    estimate, uncertainty = clock.offset()
+    assert uncertainty <= 0.05
+    assert abs(estimate - offset) <= uncertainty
+
+
+
+def test_single_response_bounds():
+    clock = camera.clock_estimator()
+    clock.add(date(1465000010.), 1465000000.2, 1465000000.3)
+    lower, upper = clock.bounds()
+    assert abs(lower - 9.7) < 1e-6 and abs(upper - 10.8) < 1e-6
+
+
+
+def test_clock_set_discards_old_responses():
+    clock = camera.clock_estimator()
+    t = 1465000000.
+    for i in range(10):
+        clock.add(date(t + i * 10.3 + 5.), t + i * 10.3, t + i * 10.3 + 0.02)
+    # the camera clock is set back by 5 s
+    for i in range(10, 20):
+        clock.add(date(t + i * 10.3), t + i * 10.3, t + i * 10.3 + 0.02)
+    estimate, uncertainty = clock.offset()
+    assert abs(estimate) <= uncertainty + 1e-9
+
+
+
+def test_invalid_date_is_ignored():
+    clock = camera.clock_estimator()
+    clock.add("no date", 0., 0.1)
+    assert clock.bounds() is None
@@ -0,0 +1,102 @@
+import os
+from datetime import datetime, timedelta
+
+import container
+
+
+T0 = datetime(2016, 6, 1, 12)
+
+
+
+def frames(n):
+    return [(T0 + timedelta(seconds=10 * i), b"frame %d" % i * (i + 1)) \
+        for i in range(n)]
+
+
+
+def test_append_and_read(tmp_path):
+    fname = container.container_name(str(tmp_path), "roof", T0)
+    with container.pack_writer(fname) as w:
+        numbers = [w.append(dt, data) for dt, data in frames(3)]
+    assert numbers == [0, 1, 2]
+
+    with container.pack_reader(fname) as r:
+        assert len(r) == 3
+        assert [(dt, bytes(data)) for dt, data in r.frames()] == frames(3)
+        assert r.find(T0 + timedelta(seconds=10)) == 1
+        assert r.find(T0 + timedelta(seconds=5)) is None
+    assert container.read(fname + "#2") == frames(3)[2][1]
+
+
+
+def test_out_of_order_frames_are_sorted(tmp_path):
+    fname = container.container_name(str(tmp_path), "roof", T0)
+    with container.pack_writer(fname) as w:
+        for dt, data in reversed(frames(3)): w.append(dt, data)
+    with container.pack_reader(fname) as r:
+        assert [bytes(d) for dt, d in r.frames(start=T0 + \
+            timedelta(seconds=10))] == [f[1] for f in frames(3)[1:]]
+
+
+
+def test_truncated_pack_is_ignored(tmp_path):
+    # a crash after the index record but before the image reached the disk
+    fname = container.container_name(str(tmp_path), "roof", T0)
+    with container.pack_writer(fname) as w:
+        for dt, data in frames(3): w.append(dt, data)
+    size = os.path.getsize(fname)
+    with open(fname, "r+b") as f:
+        f.truncate(size - 3)
+
+    with container.pack_reader(fname) as r:
+        assert len(r) == 2
+        assert [bytes(d) for dt, d in r.frames()] == \
+            [f[1] for f in frames(2)]
+
+
+
+def test_partial_index_record_is_dropped(tmp_path):
+    # a crash while writing the index record
+    fname = container.container_name(str(tmp_path), "roof", T0)
+    with container.pack_writer(fname) as w:
+        for dt, data in frames(2): w.append(dt, data)
+    with open(fname[:-5] + ".idx", "ab") as f:
+        f.write(b"\x01\x02\x03")
+
+    with container.pack_reader(fname) as r:
+        assert len(r) == 2
+
+    # the next writer removes the partial record and continues
+    dt, data = frames(3)[2]
+    with container.pack_writer(fname) as w:
+        assert w.append(dt, data) == 2
+    with container.pack_reader(fname) as r:
+        assert [bytes(d) for dt, d in r.frames()] == [f[1] for f in frames(3)]
+
+
+
+def test_refresh_sees_new_frames(tmp_path):
+    fname = container.container_name(str(tmp_path), "roof", T0)
+    w = container.pack_writer(fname)
+    w.append(*frames(1)[0])
+    r = container.pack_reader(fname)
+    assert len(r) == 1
+    w.append(*frames(2)[1])
+    assert len(r) == 1
+    r.refresh()
+    assert bytes(r.get(1)) == frames(2)[1][1]
+    r.close()
+    w.close()
+
+
+
+def test_archive_export(tmp_path):
+    packs = container.pack_archive(str(tmp_path / "packs"))
+    locators = [packs.append(dt, "roof", data) for dt, data in frames(2)]
+    packs.close()
+    assert container.read(locators[1]) == frames(2)[1][1]
+    assert packs.cameras() == ["roof"] and packs.days("roof") == ["20160601"]
+
+    assert packs.export("roof", str(tmp_path / "out")) == 2
+    assert sorted(os.listdir(str(tmp_path / "out" / "20160601"))) == \
+        ["20160601_120000.jpg", "20160601_120010.jpg"]
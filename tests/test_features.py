@@ -0,0 +1,98 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import features
+
+
+T0 = datetime(2016, 6, 1, 12)
+
+
+
+def times(n, start=T0, step=10):
+    return [start + timedelta(seconds=step * i) for i in range(n)]
+
+
+
+def chunk_files(root):
+    return sorted(f for d, _, files in os.walk(root) for f in files \
+        if f.endswith(".npz"))
+
+
+
+def test_chunking(tmp_path):
+    store = features.feature_store(str(tmp_path), chunk_size=4,
+        flush_interval=None)
+    for i, t in enumerate(times(10)):
+        store.append_record("roof", t, {'zenith': float(i)})
+    assert len(chunk_files(str(tmp_path))) == 2
+    store.flush()
+    assert len(chunk_files(str(tmp_path))) == 3
+
+    data = store.read("roof")
+    assert data['zenith'].tolist() == list(range(10))
+    assert np.all(np.diff(data['time']) == 10)
+
+
+
+def test_days_are_partitioned(tmp_path):
+    store = features.feature_store(str(tmp_path))
+    store.append("roof", [T0, T0 + timedelta(days=1)], {'size': [1, 2]})
+    store.flush()
+    assert sorted(os.listdir(str(tmp_path / "roof"))) == ["20160601",
+        "20160602"]
+
+
+
+def test_age_based_flush(tmp_path):
+    store = features.feature_store(str(tmp_path), flush_interval=0.05)
+    store.append_record("roof", T0, {'size': 1})
+    assert chunk_files(str(tmp_path)) == []
+    time.sleep(0.1)
+    # a record of another camera writes the old buffer
+    store.append_record("tower", T0, {'size': 2})
+    assert len(chunk_files(str(tmp_path))) == 1
+    assert store.read("roof")['size'].tolist() == [1]
+
+
+
+def test_range_read(tmp_path):
+    store = features.feature_store(str(tmp_path), chunk_size=5)
+    for i in range(4):
+        store.append("roof", times(5, T0 + timedelta(seconds=50 * i)),
+            {'zenith': np.arange(5.) + 5 * i, 'level': np.arange(5)})
+    start, end = T0 + timedelta(seconds=35), T0 + timedelta(seconds=120)
+    assert len(store.chunks("roof", start, end)) == 3
+    data = store.read("roof", start, end, columns=['zenith'])
+    assert sorted(data) == ['time', 'zenith']
+    assert data['zenith'].tolist() == list(range(4, 12))
+    assert store.read("tower", start, end)['time'].size == 0
+
+
+
+def test_missing_columns(tmp_path):
+    store = features.feature_store(str(tmp_path), chunk_size=2)
+    store.append("roof", times(2), {'zenith': [1., 2.]})
+    store.append("roof", times(2, T0 + timedelta(seconds=20)),
+        {'zenith': [3., 4.], 'flag': ["x", "y"]})
+    store.append_record("roof", T0 + timedelta(seconds=40), {'zenith': None,
+        'flag': "z"})
+    store.append_record("roof", T0 + timedelta(seconds=50), {'zenith': 6.})
+    store.flush()
+
+    data = store.read("roof")
+    assert data['flag'].tolist() == ["", "", "x", "y", "z", ""]
+    assert np.isnan(data['zenith'][4])
+    assert store.read("roof", columns=['unknown'])['unknown'].shape == (6,)
+
+
+
+def test_objects_are_rejected(tmp_path):
+    store = features.feature_store(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.append_record("roof", T0, {'profile': {'a': 1}})
+    with pytest.raises(ValueError):
+        store.append_record("roof", T0, {'x': object()})
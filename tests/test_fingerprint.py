@@ -0,0 +1,74 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+import fingerprint
+
+
+def jpeg(seed, size=256, quality=90):
+    rs = np.random.RandomState(seed)
+    # smooth random pattern, survives JPEG and downscaling
+    img = np.kron(rs.randint(0, 256, (8, 8)), np.ones((size // 8, size // 8)))
+    buf = io.BytesIO()
+    Image.fromarray(img.astype(np.uint8)).convert("RGB").save(buf, "JPEG",
+        quality=quality)
+
+    return buf.getvalue()
+
+
+
+def test_phash_distance():
+    a, b = jpeg(0), jpeg(1)
+    assert fingerprint.distance(fingerprint.phash(a), fingerprint.phash(a)) \
+        == 0
+    # re-encoding changes the bytes but hardly the hash
+    similar = fingerprint.distance(fingerprint.phash(a),
+        fingerprint.phash(jpeg(0, quality=60)))
+    different = fingerprint.distance(fingerprint.phash(a),
+        fingerprint.phash(b))
+    assert similar <= 2 < different
+    assert fingerprint.distance(0, 0xff) == 8
+
+
+
+def test_duplicates():
+    det = fingerprint.frozen_detector(threshold=2)
+    first = det.check(jpeg(0))
+    assert first['duplicate'] == fingerprint.UNIQUE and \
+        first['distance'] is None
+    assert det.check(jpeg(0))['duplicate'] == fingerprint.DUPLICATE
+    assert det.check(jpeg(0, quality=60))['duplicate'] == \
+        fingerprint.NEAR_DUPLICATE
+    assert det.check(jpeg(1))['duplicate'] == fingerprint.UNIQUE
+    stats = det.stats()
+    assert stats['frames'] == 4 and stats['duplicates'] == 1
+    assert stats['near_duplicates'] == 1
+
+
+
+def test_frozen_run():
+    det = fingerprint.frozen_detector(frozen_after=3)
+    det.check(jpeg(0))
+    results = [det.check(jpeg(0)) for i in range(4)]
+    assert [r['frozen'] for r in results] == [False, False, True, True]
+    assert results[-1]['repeats'] == 4
+    assert det.stats()['frozen_events'] == 1 and det.stats()['frozen'] == 1
+
+    # a new frame ends the frozen state
+    assert not det.check(jpeg(1))['frozen']
+    assert det.stats()['frozen'] == 0
+
+
+
+def test_corrupt_frame_is_passed_on():
+    det = fingerprint.frozen_detector()
+    det.check(jpeg(0))
+    truncated = jpeg(1)[:200]
+    result = det.check(truncated)
+    assert result['phash'] is None and result['distance'] is None
+    assert result['duplicate'] == fingerprint.UNIQUE
+    assert det.stats()['errors'] == 1
+    # the same corrupt bytes again are still a byte duplicate
+    assert det.check(truncated)['duplicate'] == fingerprint.DUPLICATE
+    assert det.check(jpeg(0))['distance'] is None
@@ -0,0 +1,41 @@
+import os
+import json
+
+import pytest
+
+import fleet
+
+
+def manifest(tmp_path, cameras, defaults=None):
+    fname = str(tmp_path / "fleet.json")
+    with open(fname, "w") as f:
+        json.dump({'defaults': defaults or {}, 'cameras': cameras}, f)
+
+    return fname
+
+
+
+def test_single_camera_gets_outdir(tmp_path):
+    fname = manifest(tmp_path, [{'name': "roof", 'ip': "192.168.1.10"}])
+    site = fleet.load(fname, outdir="images")
+    assert len(site) == 1
+    assert site.settings("roof", 'outdir') == "images" + os.sep + "roof"
+
+
+
+def test_manifest_outdir_is_kept(tmp_path):
+    fname = manifest(tmp_path, [
+        {'name': "roof", 'ip': "192.168.1.10", 'outdir': "/data/roof"},
+        {'name': "tower", 'ip': "192.168.1.11", 'model': "mobotix"}],
+        defaults={'latitude': 53.13})
+    site = fleet.load(fname, outdir="images")
+    assert site.settings("roof", 'outdir') == "/data/roof"
+    assert site.settings("tower", 'outdir') == "images" + os.sep + "tower"
+    assert site.settings("tower", 'latitude') == 53.13
+    assert site["tower"].model == "mobotix"
+
+
+
+def test_entry_without_ip(tmp_path):
+    with pytest.raises(ValueError):
+        fleet.load(manifest(tmp_path, [{'name': "roof"}]))
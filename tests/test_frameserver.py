@@ -0,0 +1,113 @@
+import io
+import json
+import threading
+import http.client
+from datetime import datetime
+
+import pytest
+from PIL import Image
+
+import frameserver
+
+
+T0 = datetime(2016, 6, 1, 12)
+
+
+
+def jpeg(level):
+    buf = io.BytesIO()
+    Image.new("RGB", (64, 32), (level, level, level)).save(buf, "JPEG")
+
+    return buf.getvalue()
+
+
+
+@pytest.fixture
+def server():
+    frames = frameserver.latest_frames()
+    server = frames.serve(0)
+    server.frames = frames
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+
+def request(server, path, headers=None):
+    conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+    conn.request("GET", path, headers=headers or {})
+    response = conn.getresponse()
+    body = response.read()
+    conn.close()
+
+    return response, body
+
+
+
+def test_publish_and_levels():
+    frames = frameserver.latest_frames()
+    assert frames.get("roof") is None
+    assert frames.publish("roof", jpeg(10), dt=T0, zenith=40.) == 1
+    assert frames.publish("roof", jpeg(20), dt=T0) == 2
+    data, etag, meta = frames.get("roof")
+    assert data == jpeg(20) and meta['seq'] == 2 and meta['size'] == len(data)
+
+    small, small_etag, meta = frames.get("roof", 4)
+    assert Image.open(io.BytesIO(small)).size == (16, 8)
+    assert small_etag != etag
+    # computed once per frame and level
+    assert frames.get("roof", 4)[0] is small
+    assert frames.stats() == {'cameras': 1, 'published': 2}
+
+
+
+def test_etag(server):
+    assert server.server_address[0] == "127.0.0.1"
+    server.frames.publish("roof", jpeg(10), dt=T0)
+    response, body = request(server, "/roof/latest.jpg")
+    assert response.status == 200 and body == jpeg(10)
+    assert response.getheader("X-Frame-Sequence") == "1"
+    etag = response.getheader("ETag")
+
+    response, body = request(server, "/roof/latest.jpg",
+        {'If-None-Match': etag})
+    assert response.status == 304 and body == b""
+
+    server.frames.publish("roof", jpeg(20), dt=T0)
+    response, body = request(server, "/roof/latest.jpg",
+        {'If-None-Match': etag})
+    assert response.status == 200 and body == jpeg(20)
+
+    assert request(server, "/roof/latest.jpg?scale=3")[0].status == 400
+    assert request(server, "/tower/latest.jpg")[0].status == 404
+    response, body = request(server, "/cameras")
+    assert json.loads(body)['roof']['seq'] == 2
+
+
+
+def test_long_poll(server):
+    server.frames.publish("roof", jpeg(10), dt=T0)
+    response, body = request(server, "/roof/wait?after=1&timeout=0.1")
+    assert response.status == 204
+
+    threading.Timer(0.1, server.frames.publish, ("roof", jpeg(20)),
+        {'dt': T0, 'zenith': 40.}).start()
+    response, body = request(server, "/roof/wait?after=1&timeout=10")
+    meta = json.loads(body)
+    assert response.status == 200 and meta['seq'] == 2
+    assert meta['zenith'] == 40. and meta['dt'] == T0.isoformat()
+
+
+
+def test_events(server):
+    server.frames.publish("roof", jpeg(10), dt=T0)
+    conn = http.client.HTTPConnection(*server.server_address, timeout=10)
+    conn.request("GET", "/roof/events")
+    response = conn.getresponse()
+    assert response.getheader("Content-Type") == "text/event-stream"
+
+    threading.Timer(0.1, server.frames.publish, ("roof", jpeg(20))).start()
+    lines = [response.fp.readline() for i in range(3)]
+    conn.close()
+    assert lines[0] == b"event: frame\n" and lines[1] == b"id: 2\n"
+    assert json.loads(lines[2][len(b"data: "):])['seq'] == 2
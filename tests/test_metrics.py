@@ -0,0 +1,76 @@
+import os
+import urllib.request
+
+import metrics
+
+
+def test_counters_and_gauges():
+    reg = metrics.registry()
+    reg.inc("requests_total", help="Requests", camera="roof")
+    reg.inc("requests_total", 2, camera="roof")
+    reg.inc("requests_total", camera="tower")
+    reg.set("offset_seconds", -0.25, camera="roof")
+    assert reg.get("requests_total", camera="roof") == 3
+    assert reg.get("requests_total", camera="east") is None
+
+    text = reg.expose()
+    assert "# HELP requests_total Requests\n# TYPE requests_total counter\n" \
+        in text
+    assert 'requests_total{camera="roof"} 3\n' in text
+    assert 'requests_total{camera="tower"} 1\n' in text
+    assert 'offset_seconds{camera="roof"} -0.25\n' in text
+
+
+
+def test_histogram():
+    reg = metrics.registry()
+    for v in (0.003, 0.02, 0.02, 20.):
+        reg.observe("latency_seconds", v, op="download")
+    lines = reg.expose().splitlines()
+    assert "# TYPE latency_seconds histogram" in lines
+    assert 'latency_seconds_bucket{le="0.005",op="download"} 1' in lines
+    assert 'latency_seconds_bucket{le="0.025",op="download"} 3' in lines
+    assert 'latency_seconds_bucket{le="10",op="download"} 3' in lines
+    assert 'latency_seconds_bucket{le="+Inf",op="download"} 4' in lines
+    assert 'latency_seconds_count{op="download"} 4' in lines
+    assert 'latency_seconds_sum{op="download"} 20.043' in lines
+
+
+
+def test_label_escaping():
+    reg = metrics.registry()
+    reg.set("x", 1, text='a "b"\\c\nd')
+    assert 'x{text="a \\"b\\"\\\\c\\nd"} 1' in reg.expose()
+
+
+
+def test_collectors():
+    reg = metrics.registry()
+    reg.add_collector("pipeline", lambda: {'processed': 5, 'state': "x"},
+        help="Pipeline", camera="roof")
+    reg.add_collector("broken", lambda: 1 / 0)
+    text = reg.expose()
+    assert 'pipeline_processed{camera="roof"} 5' in text
+    assert "pipeline_state" not in text and "broken" not in text
+
+
+
+def test_textfile_and_http(tmp_path):
+    reg = metrics.registry()
+    reg.inc("frames_total")
+    fname = str(tmp_path / "skycam.prom")
+    reg.write_textfile(fname)
+    with open(fname) as f:
+        assert f.read() == reg.expose()
+    assert os.listdir(str(tmp_path)) == ["skycam.prom"]
+
+    server = reg.serve(0)
+    try:
+        host, port = server.server_address
+        assert host == "127.0.0.1"
+        with urllib.request.urlopen("http://127.0.0.1:%d/metrics" % port) \
+                as response:
+            assert b"frames_total 1" in response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,142 @@
+import io
+import os
+import time
+import threading
+from datetime import datetime
+
+import pytest
+import numpy as np
+from PIL import Image
+
+import pipeline
+
+
+def frame(i):
+    return {'data': b"%d" % i, 'dt': datetime(2016, 6, 1), 'camera': "c",
+        'config': {}}
+
+
+
+def jpeg():
+    buf = io.BytesIO()
+    Image.fromarray(np.zeros((16, 16, 3), np.uint8)).save(buf, "JPEG")
+
+    return buf.getvalue()
+
+
+
+def slow(frame):
+    time.sleep(0.5)
+
+    return frame
+
+
+
+def test_maxsize_must_be_positive():
+    for policy in pipeline.POLICIES:
+        with pytest.raises(ValueError):
+            pipeline.frame_buffer(0, policy, spill_dir="spill")
+
+
+
+def test_drop_oldest():
+    buf = pipeline.frame_buffer(2, pipeline.DROP_OLDEST)
+    for i in range(5): assert buf.put(frame(i))
+    assert buf.dropped == 3
+    assert [buf.get(0)['data'] for i in range(2)] == [b"3", b"4"]
+    assert buf.get(0) is None
+
+
+
+def test_block_times_out():
+    buf = pipeline.frame_buffer(1, pipeline.BLOCK)
+    assert buf.put(frame(0))
+    assert not buf.put(frame(1), timeout=0.05)
+    assert buf.dropped == 1
+
+    # a reader makes room for a blocked writer
+    threading.Timer(0.05, buf.get).start()
+    assert buf.put(frame(2), timeout=5)
+    assert buf.get(0)['data'] == b"2"
+
+
+
+def test_spill_keeps_order(tmp_path):
+    buf = pipeline.frame_buffer(2, pipeline.SPILL, spill_dir=str(tmp_path))
+    for i in range(5): assert buf.put(frame(i))
+    assert buf.nspilled == 3 and len(os.listdir(str(tmp_path))) == 3
+    assert [buf.get(0)['data'] for i in range(5)] == \
+        [b"%d" % i for i in range(5)]
+    assert os.listdir(str(tmp_path)) == []
+
+
+
+def test_close_discard(tmp_path):
+    buf = pipeline.frame_buffer(1, pipeline.SPILL, spill_dir=str(tmp_path))
+    for i in range(3): buf.put(frame(i))
+    buf.close(discard=True)
+    assert buf.dropped == 3 and len(buf) == 0
+    assert os.listdir(str(tmp_path)) == []
+    assert not buf.put(frame(3))
+    assert buf.get(0) is None
+
+
+
+def test_pipeline_counts():
+    results = []
+    pipe = pipeline.pipeline(steps=[pipeline.decode], workers=2,
+        callback=results.append).start()
+    for i in range(4): assert pipe.submit(jpeg(), camera="c")
+    assert pipe.submit(b"not a jpeg", camera="c")
+    pipe.close()
+    assert not pipe.submit(jpeg())
+
+    stats = pipe.stats()
+    assert stats['submitted'] == 5
+    assert stats['processed'] == 4 and stats['failed'] == 1
+    assert len(results) == 5
+    assert all('data' not in r for r in results if isinstance(r, dict))
+
+
+
+def test_close_without_wait_does_not_block():
+    pipe = pipeline.pipeline(steps=[slow], workers=1, maxsize=32).start()
+    for i in range(20): pipe.submit(b"", camera="c")
+    t = time.monotonic()
+    pipe.close(wait=False)
+    assert time.monotonic() - t < 0.4
+    time.sleep(1.5)
+    stats = pipe.stats()
+    assert stats['waiting'] == 0
+    assert stats['processed'] + stats['cancelled'] + stats['dropped'] == 20
+
+
+
+def test_mask_geometry():
+    f = frame(0)
+    f['data'] = jpeg()
+    f['image'] = Image.new("RGB", (64, 32), (255, 255, 255))
+    f['config'] = {'mask': {'center': (64, 32), 'radius': 30,
+        'size': (128, 64)}}
+    img = np.asarray(pipeline.mask(f)['image'])
+    assert img[16, 32].tolist() == [255, 255, 255]
+    assert img[0, 0].tolist() == [0, 0, 0] and img[31, 63].tolist() == [0, 0, 0]
+
+
+
+def test_mask_file(tmp_path):
+    fname = str(tmp_path / "mask.png")
+    m = np.zeros((8, 8), np.uint8)
+    m[:, :4] = 255
+    Image.fromarray(m).save(fname)
+    f = frame(0)
+    f['image'] = Image.new("RGB", (16, 16), (200, 100, 50))
+    f['config'] = {'mask': fname}
+    img = np.asarray(pipeline.mask(f)['image'])
+    assert (img[:, :7] == (200, 100, 50)).all()
+    assert (img[:, 9:] == 0).all()
+
+    # without mask the frame is unchanged, the image decoded
+    f = frame(0)
+    f['data'] = jpeg()
+    assert pipeline.mask(f)['image'].size == (16, 16)
@@ -0,0 +1,64 @@
+import io
+import sys
+import subprocess
+
+import numpy as np
+from PIL import Image
+
+import preview
+
+
+def jpeg(fname, size=(512, 256)):
+    rs = np.random.RandomState(0)
+    img = rs.randint(0, 256, (size[1] // 16, size[0] // 16, 3)).astype(np.uint8)
+    Image.fromarray(img).resize(size).save(fname, quality=90)
+
+    return fname
+
+
+
+def test_filenames():
+    assert preview.preview_filename("a/20160812_120000.jpg", 4) == \
+        "a/20160812_120000_p4.jpg"
+    assert preview.is_preview("20160812_120000_p8.jpg")
+    assert not preview.is_preview("20160812_120000.jpg")
+
+
+
+def test_open_scaled(tmp_path):
+    fname = jpeg(str(tmp_path / "a.jpg"))
+    for scale in (1, 2, 4, 8):
+        image = preview.open_scaled(fname, scale)
+        image.load()
+        assert image.size == (512 // scale, 256 // scale)
+
+
+
+def test_pyramid(tmp_path):
+    fname = jpeg(str(tmp_path / "20160812_120000.jpg"))
+    files = preview.make_pyramid(fname)
+    assert sorted(files) == [2, 4, 8]
+    for scale, name in files.items():
+        assert name == preview.preview_filename(fname, scale)
+        assert Image.open(name).size == (512 // scale, 256 // scale)
+
+    # pyramid of a file object next to a given archive name
+    with open(fname, "rb") as f:
+        files = preview.make_pyramid(io.BytesIO(f.read()), scales=(4,),
+            outname=str(tmp_path / "b.jpg"))
+    assert files == {4: str(tmp_path / "b_p4.jpg")}
+
+    # existing levels are loaded, missing ones decoded from the original
+    assert preview.load_preview(fname, 4).filename == \
+        preview.preview_filename(fname, 4)
+    other = jpeg(str(tmp_path / "c.jpg"))
+    image = preview.load_preview(other, 2)
+    assert image.filename == other and image.size == (256, 128)
+
+
+
+def test_no_eager_pil_import():
+    code = "import sys, preview; print('PIL' in sys.modules)"
+    out = subprocess.check_output([sys.executable, "-c", code],
+        cwd=preview.__file__.rsplit("preview.py", 1)[0])
+    assert out.strip() == b"False"
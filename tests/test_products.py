@@ -0,0 +1,107 @@
+import io
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+from PIL import Image
+
+import pipeline
+import products
+
+
+T0 = datetime(2016, 6, 1, 12)
+
+
+
+def jpeg(color, size=(128, 128)):
+    buf = io.BytesIO()
+    Image.new("RGB", size, color).save(buf, "JPEG", quality=95)
+
+    return buf.getvalue()
+
+
+
+def test_keogram_and_mosaic(tmp_path):
+    builder = products.product_builder(str(tmp_path), scale=8, interval=10,
+        mosaic_step=20, mosaic_columns=2, timelapse_every=2, video=False,
+        prefix="roof_", size=(128, 128))
+    for i in range(4):
+        builder.add(T0 + timedelta(seconds=10 * i), jpeg((60 * i, 0, 0)))
+    # one column per slot, in the order of time
+    slot = 12 * 360
+    assert builder.filled.sum() == 4 and builder.filled[slot:slot + 4].all()
+    column = builder.keogram[8, slot:slot + 4, 0].astype(int)
+    assert np.all(np.abs(column - [0, 60, 120, 180]) < 8)
+    mosaic = builder.mosaic.astype(int)
+
+    written = builder.finish()
+    assert sorted(written) == ['keogram', 'mosaic', 'timelapse']
+    assert written['keogram'] == str(tmp_path / "roof_20160601_keogram.jpg")
+    assert Image.open(written['keogram']).size == (4, 16)
+
+    # the first frame of every 20 s is a tile, 2 tiles per row
+    assert mosaic.shape[1] == 32
+    assert Image.open(written['mosaic']).size == (32, mosaic.shape[0])
+    r, c = divmod(int((12 * 3600) / 20), 2)
+    assert abs(mosaic[r * 16 + 8, c * 16 + 8, 0]) < 12
+    assert abs(mosaic[r * 16 + 8, (c + 1) * 16 + 8, 0] - 120) < 12
+    assert sorted(os.listdir(written['timelapse'])) == ["00000.jpg",
+        "00001.jpg"]
+
+
+
+def test_keogram_slice_from_geometry(tmp_path):
+    # north to the right of the image
+    geometry = {'center': (64, 64), 'radius': 64, 'size': (128, 128),
+        'north': 90.}
+    builder = products.product_builder(str(tmp_path), scale=8,
+        geometry=geometry, video=False, timelapse_every=0)
+    pixels = np.zeros((128, 128, 3), np.uint8)
+    pixels[60:68, :, 0] = 255
+    builder.add(T0, pixels[::8, ::8])
+    keogram = builder.keogram[:, builder.filled.argmax()]
+    # the horizontal line through the zenith is the north-south slice
+    assert (keogram[:, 0] == 255).all()
+
+
+
+def test_days_and_resolutions(tmp_path):
+    builder = products.product_builder(str(tmp_path), scale=8, video=False,
+        timelapse_every=0, size=(256, 256))
+    assert builder.size == (32, 32)
+    builder.add(T0, jpeg((200, 0, 0), (256, 256)))
+    # a frame of lower resolution is resized to the product size
+    builder.add(T0 + timedelta(seconds=10), jpeg((0, 200, 0), (64, 64)))
+    builder.add(T0 + timedelta(days=1), jpeg((0, 0, 200), (256, 256)))
+    assert builder.stats() == {'frames': 3, 'days': 1}
+    assert os.path.exists(str(tmp_path / "20160601_keogram.jpg"))
+    assert not os.path.exists(str(tmp_path / "20160602_keogram.jpg"))
+    builder.finish()
+    assert Image.open(str(tmp_path / "20160602_keogram.jpg")).size == (1, 32)
+
+
+
+def test_product_thread(tmp_path):
+    thread = products.product_thread(products.product_builder(str(tmp_path),
+        video=False, timelapse_every=0, size=(128, 128)), maxsize=100)
+    for i in range(5):
+        thread.add(T0 + timedelta(seconds=10 * i), jpeg((50, 50, 50)))
+    thread.add(T0, b"not a jpeg")
+    thread.close()
+    stats = thread.stats()
+    assert stats['frames'] == 5 and stats['failed'] == 1
+    assert stats['days'] == 1 and stats['dropped'] == 0
+    assert os.path.exists(str(tmp_path / "20160601_mosaic.jpg"))
+
+
+
+def test_build_from_archive(tmp_path):
+    src = str(tmp_path / "archive")
+    for i in range(3):
+        pipeline.archive({'data': jpeg((100, 100, 100)), 'camera': "roof",
+            'dt': T0 + timedelta(seconds=10 * i), 'config': {'outdir': src}})
+    builder = products.build(src, str(tmp_path / "out"), video=False,
+        timelapse_every=0, workers=2)
+    assert builder.stats() == {'frames': 3, 'days': 1}
+    keogram = Image.open(str(tmp_path / "out" / "20160601_keogram.jpg"))
+    assert keogram.size == (3, 16)
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+
+import container
+import reader
+
+
+T0 = datetime(2016, 6, 1, 12)
+
+
+
+def make_packs(root):
+    packs = container.pack_archive(root)
+    for i in range(4):
+        for camera in ("east", "west"):
+            packs.append(T0 + timedelta(seconds=10 * i + (camera == "west")),
+                camera, ("%s %d" % (camera, i)).encode())
+    packs.close()
+
+    return packs
+
+
+
+def test_locate_packs_of_all_cameras(tmp_path):
+    packs = make_packs(str(tmp_path))
+    rd = reader.archive_reader(packs)
+
+    frames = rd.locate()
+    assert len(frames) == 8
+    assert [dt for dt, loc in frames] == sorted(dt for dt, loc in frames)
+    assert [reader.read_bytes(loc) for dt, loc in frames[:2]] == \
+        [b"east 0", b"west 0"]
+
+    west = rd.locate("west", start=T0 + timedelta(seconds=15))
+    assert [reader.read_bytes(loc) for dt, loc in west] == \
+        [b"west 2", b"west 3"]
+
+
+
+def test_read_bytes_parallel(tmp_path):
+    import concurrent.futures
+
+    packs = make_packs(str(tmp_path))
+    frames = reader.archive_reader(packs).locate()
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        data = list(pool.map(reader.read_bytes, [loc for dt, loc in frames] \
+            * 20))
+    assert data[:8] == [reader.read_bytes(loc) for dt, loc in frames]
+    assert all(entry[1] == 0 for entry in reader._readers.values())
+
+
+
+def test_read_bytes_sees_appended_frames(tmp_path):
+    packs = make_packs(str(tmp_path))
+    loc = reader.archive_reader(packs).locate("east")[0][1]
+    assert reader.read_bytes(loc) == b"east 0"
+
+    # the cached reader does not know frame 4 yet
+    packs.append(T0 + timedelta(seconds=40), "east", b"east 4")
+    packs.close()
+    old = reader._readers[loc.rsplit("#", 1)[0]]
+    assert reader.read_bytes(loc[:-1] + "4") == b"east 4"
+    assert old[2] and old[0].map is None
+
+
+
+def test_directory_has_no_camera(tmp_path):
+    import pytest
+
+    dname = tmp_path / T0.strftime("%Y%m%d")
+    dname.mkdir()
+    (dname / T0.strftime("%Y%m%d_%H%M%S.jpg")).write_bytes(b"frame")
+    rd = reader.archive_reader(str(tmp_path))
+    assert len(rd.locate()) == 1
+    with pytest.raises(ValueError):
+        rd.locate("roof")
@@ -0,0 +1,87 @@
+import io
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import container
+import pipeline
+import replay
+
+
+T0 = datetime(2016, 6, 1, 12)
+
+
+
+def jpeg(level):
+    buf = io.BytesIO()
+    Image.fromarray(np.full((16, 16, 3), level, np.uint8)).save(buf, "JPEG")
+
+    return buf.getvalue()
+
+
+
+def archived(outdir):
+    return sorted(f for d, _, files in os.walk(outdir) for f in files \
+        if f != "current.jpg")
+
+
+
+def test_replay_directory(tmp_path):
+    src = str(tmp_path / "src")
+    frames = [{'data': jpeg(10 * i), 'dt': T0 + timedelta(seconds=10 * i),
+        'camera': "roof", 'config': {'outdir': src}} for i in range(5)]
+    for frame in frames: pipeline.archive(frame)
+
+    outdir = str(tmp_path / "out")
+    stats = replay.run(src, [pipeline.archive], {'outdir': outdir},
+        start=T0 + timedelta(seconds=10), workers=2)
+    assert stats['processed'] == 4 and stats['failed'] == 0
+    assert stats['dropped'] == 0
+    assert archived(outdir) == archived(src)[1:]
+    with open(os.path.join(outdir, "20160601", "20160601_120040.jpg"),
+            "rb") as f:
+        assert f.read() == frames[4]['data']
+
+
+
+def test_replay_packs(tmp_path):
+    packs = container.pack_archive(str(tmp_path / "packs"))
+    for i in range(3):
+        packs.append(T0 + timedelta(seconds=10 * i), "roof", jpeg(10 * i))
+    packs.close()
+
+    outdir = str(tmp_path / "out")
+    src = replay.replay(packs, camera="roof")
+    assert len(src) == 3
+    pipe = pipeline.pipeline(steps=[pipeline.archive],
+        config={'outdir': outdir}, workers=1, maxsize=1,
+        policy=pipeline.BLOCK).start()
+    stats = src.feed(pipe)
+    pipe.close()
+    assert stats['frames'] == 3 and stats['remaining'] == 0
+    assert pipe.stats()['processed'] == 3
+    assert archived(outdir) == ["20160601_120000.jpg", "20160601_120010.jpg",
+        "20160601_120020.jpg"]
+    with pytest.raises(EOFError):
+        src.capture()
+
+
+
+def test_annotate_is_refused(tmp_path):
+    packs = container.pack_archive(str(tmp_path / "packs"))
+    packs.append(T0, "roof", jpeg(0))
+    packs.close()
+
+    pipe = pipeline.pipeline(steps=[pipeline.annotate, pipeline.archive])
+    with pytest.raises(ValueError):
+        replay.replay(packs).feed(pipe)
+    assert pipe.stats()['submitted'] == 0
+
+    # raw frames are annotated
+    outdir = str(tmp_path / "out")
+    stats = replay.run(packs, [pipeline.annotate, pipeline.archive],
+        {'outdir': outdir}, raw=True, workers=1)
+    assert stats['processed'] == 1
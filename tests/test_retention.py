@@ -0,0 +1,114 @@
+import os
+import json
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+import archive
+import retention
+
+
+DAY = "20160601"
+NOW = datetime(2016, 8, 1)
+
+
+
+def make_day(tmp_path, n=6, size=64):
+    dname = tmp_path / DAY
+    dname.mkdir()
+    idx = archive.archive_index(str(tmp_path / "archive.db"))
+    for i in range(n):
+        fname = str(dname / ("%s_%02d0000.jpg" % (DAY, i)))
+        img = np.random.RandomState(i).randint(0, 255, (size, size, 3))
+        Image.fromarray(img.astype(np.uint8)).save(fname, quality=90)
+        idx.add_file(fname, camera="roof")
+        idx.add_file(fname.replace(DAY + os.sep, DAY + os.sep + "x"),
+            dt=datetime(2016, 6, 1, i), camera="other", size=1, checksum="")
+    idx.close()
+
+    return str(dname)
+
+
+
+def widths(dname):
+    return sorted(Image.open(os.path.join(dname, f)).size[0] \
+        for f in os.listdir(dname) if archive.parse_filename(f))
+
+
+
+def test_compact_day(tmp_path):
+    dname = make_day(tmp_path)
+    comp = retention.compactor(str(tmp_path), policy=[retention.tier(30,
+        scale=2, quality=75)], index=str(tmp_path / "archive.db"),
+        camera="roof", bandwidth=None)
+    assert comp.plan(NOW) == [(DAY, 0)]
+    assert comp.run_once(NOW) == 1
+    assert widths(dname) == [32] * 6
+    assert comp.plan(NOW) == []
+    with open(os.path.join(dname, retention.STATE)) as f:
+        assert json.load(f) == {'tier': 0, 'scale': 2, 'quality': 75}
+    assert not os.path.exists(os.path.join(dname, retention.JOURNAL))
+
+    # index updated with update_many, the other camera untouched
+    idx = archive.archive_index(str(tmp_path / "archive.db"))
+    for rec in idx.query("roof"):
+        with open(rec['path'], "rb") as f:
+            assert rec['checksum'] == archive.checksum(f.read())
+    assert all(rec['size'] == 1 for rec in idx.query("other"))
+
+
+
+def test_interrupted_run_continues(tmp_path):
+    dname = make_day(tmp_path)
+    comp = retention.compactor(str(tmp_path), policy=[retention.tier(30,
+        scale=2, quality=75)], index=str(tmp_path / "archive.db"),
+        camera="roof", bandwidth=None)
+
+    # stop after the third re-encoded frame
+    consume = comp.limiter.consume
+    calls = []
+    def stop_after(nbytes):
+        calls.append(nbytes)
+        if len(calls) == 6: comp.stopped.set()
+        consume(nbytes)
+    comp.limiter.consume = stop_after
+
+    assert comp.compact_day(DAY, 0) == (0, 3)
+    assert widths(dname) == [32] * 3 + [64] * 3
+    assert comp.plan(NOW) == [(DAY, 0)]
+
+    comp.stopped.clear()
+    assert comp.compact_day(DAY, 0) == (0, 3)
+    assert widths(dname) == [32] * 6
+
+
+
+def test_interrupted_replace_is_completed(tmp_path):
+    dname = make_day(tmp_path, n=2)
+    path = os.path.join(dname, DAY + "_000000.jpg")
+    small = Image.open(path).reduce(2)
+    small.save(path + ".tmp", format="JPEG")
+    with open(os.path.join(dname, retention.JOURNAL), "w") as f:
+        f.write(DAY + "_000000.jpg 2 75\n")
+    with open(os.path.join(dname, "stray.jpg.tmp"), "w") as f:
+        f.write("x")
+
+    comp = retention.compactor(str(tmp_path), policy=[retention.tier(30,
+        scale=2, quality=75)], bandwidth=None)
+    assert comp.compact_day(DAY, 0) == (0, 1)
+    assert widths(dname) == [32, 32]
+    assert not [f for f in os.listdir(dname) if f.endswith(".tmp")]
+
+
+
+def test_thinning_removes_previews(tmp_path):
+    dname = make_day(tmp_path, n=4)
+    import preview
+    path = os.path.join(dname, DAY + "_010000.jpg")
+    preview.make_pyramid(path)
+    comp = retention.compactor(str(tmp_path), policy=[retention.tier(30,
+        keep_every=720)], base_interval=10, bandwidth=None)
+    assert comp.compact_day(DAY, 0) == (2, 0)
+    assert sorted(os.listdir(dname)) == [retention.STATE, DAY + "_000000.jpg",
+        DAY + "_020000.jpg"]
@@ -0,0 +1,88 @@
+import io
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import ring
+
+
+T0 = datetime(2016, 6, 1, 12)
+
+
+
+@pytest.fixture
+def name():
+    name = "test_%d" % os.getpid()
+    yield name
+    ring._rings.pop(name, None)
+
+
+
+def test_wraparound(name):
+    with ring.frame_ring(name, shape=(4, 6, 3), slots=4, create=True) as rb:
+        assert rb.latest() is None
+        for i in range(6):
+            rb.write(np.full((4, 6, 3), i, np.uint8),
+                dt=T0 + timedelta(seconds=10 * i), zenith=30. + i)
+        assert rb.sequence() == 6
+
+        frames = rb.latest(10)
+        assert [meta['seq'] for meta, view in frames] == [6, 5, 4]
+        assert [int(view[0, 0, 0]) for meta, view in frames] == [5, 4, 3]
+        oldest = frames[-1][0]
+        assert oldest['zenith'] == 33.
+        assert rb.valid(oldest)
+
+        # the spare slot is written first, then the slot of the oldest one
+        rb.write(np.zeros((4, 6, 3), np.uint8))
+        assert rb.valid(oldest)
+        rb.write(np.zeros((2, 3, 3), np.uint8))
+        assert not rb.valid(oldest)
+        meta, view = rb.latest()
+        assert meta['seq'] == 8 and view.shape == (2, 3, 3)
+        del frames, view
+
+
+
+def test_attach(name):
+    with pytest.raises(FileNotFoundError):
+        ring.frame_ring(name)
+    with ring.frame_ring(name, shape=(4, 4), slots=3, create=True) as rb:
+        reader = ring.frame_ring(name)
+        assert reader.shape == (4, 4, 1) and reader.slots == 3
+        assert reader.wait(0, timeout=0.05) is None
+
+        rb.write(np.eye(4, dtype=np.uint8) * 9, dt=T0, exposure_level=6)
+        assert reader.wait(0, timeout=1) == 1
+        meta, view = reader.latest()
+        assert view.shape == (4, 4) and view[2, 2] == 9
+        assert meta['exposure_level'] == 6. and np.isnan(meta['azimuth'])
+        del view
+        reader.close()
+
+        with pytest.raises(ValueError):
+            rb.write(np.zeros((5, 4), np.uint8))
+
+
+
+def test_ring_step(name):
+    buf = io.BytesIO()
+    Image.new("RGB", (32, 16), (200, 0, 0)).save(buf, "JPEG")
+    frame = {'data': buf.getvalue(), 'dt': T0, 'camera': name,
+        'config': {}, 'features': {'zenith': 40.}}
+
+    # without a ring the frame is passed on
+    assert ring.ring_step(dict(frame))['camera'] == name
+
+    with ring.frame_ring(name, shape=(8, 8, 3), slots=4, create=True) as rb:
+        out = ring.ring_step(dict(frame))
+        assert out['image'].size == (32, 16)
+        meta, view = rb.latest()
+        # downscaled to fit into the ring
+        assert view.shape == (4, 8, 3) and meta['zenith'] == 40.
+        assert abs(int(view[2, 4, 0]) - 200) < 10
+        del view
+        ring._rings.pop(name).close()
@@ -0,0 +1,93 @@
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+from PIL import Image
+
+import archive
+import camera
+import sunglare
+
+
+GEOMETRY = {'center': (256, 256), 'radius': 250, 'size': (512, 512),
+    'north': 30., 'flip': True}
+
+
+
+def sun_disk(zenith, azimuth, radius, size=(512, 512)):
+    """ Frame with a saturated disk of radius degrees around the sun """
+    g = sunglare.fisheye(**GEOMETRY)
+    vectors, area = g.grid(size)
+    sun = sunglare.direction(zenith, azimuth)
+    distance = np.degrees(np.arccos(np.clip(vectors.dot(sun), -1, 1)))
+    img = np.full(size[::-1] + (3,), 60, np.uint8)
+    img[distance < radius] = 255
+
+    return img
+
+
+
+def cap(radius):
+    """ Solid angle of a spherical cap in square degrees """
+    return 2 * np.pi * (1 - np.cos(np.radians(radius))) * \
+        np.degrees(1.) ** 2
+
+
+
+def test_back_project_inverts_project():
+    g = sunglare.fisheye(**GEOMETRY)
+    zenith = np.array([0.1, 30., 60., 85.])
+    azimuth = np.array([10., 100., 200., 300.])
+    for size in (None, (128, 128)):
+        x, y = g.project(zenith, azimuth, size)
+        z, a = g.back_project(x, y, size)
+        assert np.allclose(z, zenith) and np.allclose(a, azimuth)
+
+
+
+def test_metrics_of_a_sun_disk():
+    zenith = np.array([20., 70., 70., 95.])
+    azimuth = np.array([180., 90., 250., 180.])
+    radius = [5.5, 10.5, 2.5, 5.5]
+    images = np.stack([sun_disk(z, a, r) for z, a, r in \
+        zip(zenith, azimuth, radius)])
+    m = sunglare.glare_metrics(images, zenith, azimuth, GEOMETRY)
+
+    # great-circle rings, also far from the zenith
+    assert list(m['bloom_radius'][:3]) == [5., 10., 2.]
+    assert list(m['glare']) == [True, True, False, False]
+    for area, r in zip(m['saturated_area'][:3], radius[:3]):
+        assert abs(area / cap(r) - 1) < 0.1
+    assert m['circumsolar_brightness'][2] < 0.3
+    assert np.isnan(m['bloom_radius'][3]) and np.isnan(m['profile'][3]).all()
+
+    assert sunglare.to_columns(m, 3) == dict((c, None) for c in \
+        sunglare.COLUMNS)
+    columns = sunglare.to_columns(m, 1)
+    assert columns['glare_flag'] == 1
+    assert json.loads(columns['sun_profile'])[0] == 1.0
+
+
+
+def test_analyze_skips_unreadable_frames(tmp_path):
+    lat, lon = 53.13, 8.13
+    idx = archive.archive_index(str(tmp_path / "archive.db"))
+    times = [datetime(2016, 6, 21, 8) + timedelta(hours=h) for h in range(4)]
+    sd = camera.solar_data(times, lat, lon)
+    for i, dt in enumerate(times):
+        fname = str(tmp_path / dt.strftime("%Y%m%d_%H%M%S.jpg"))
+        if i == 1:
+            with open(fname, "wb") as f:
+                f.write(b"broken")
+        else:
+            size = (512, 512) if i != 3 else (256, 256)
+            img = sun_disk(sd['zenith'][i], sd['azimuth'][i], 5.5 + 5 * i,
+                (512, 512))
+            Image.fromarray(img).resize(size).save(fname, quality=95)
+        idx.add_file(fname, dt=dt, camera="roof", lat=lat, lon=lon)
+
+    stats = sunglare.analyze(idx, lat, lon, GEOMETRY, camera="roof",
+        scale=1, batch=2)
+    assert stats == {'frames': 3, 'flagged': 3, 'failed': 1}
+    radius = [rec['sun_bloom_radius'] for rec in idx.query("roof")]
+    assert radius == [5., None, 15., 20.]
@@ -0,0 +1,97 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import tracing
+
+
+T0 = datetime(2016, 6, 1, 12)
+
+
+
+@pytest.fixture
+def records():
+    records = []
+    tracing.add_hook(records.append)
+    yield records
+    tracing.remove_hook(records.append)
+
+
+
+def test_nested_spans(records):
+    with tracing.frame("roof", T0):
+        with tracing.span("step.annotate"):
+            with tracing.span("draw", size=3):
+                time.sleep(0.01)
+        with tracing.span("request", camera="tower"):
+            pass
+    with tracing.span("idle"):
+        pass
+
+    assert [r['stage'] for r in records] == ["draw", "step.annotate",
+        "request", "idle"]
+    draw, step = records[0], records[1]
+    assert draw['camera'] == "roof" and draw['dt'] == T0 and draw['size'] == 3
+    assert step['duration'] >= draw['duration'] >= 0.01
+    assert step['start'] <= draw['start']
+    assert records[2]['camera'] == "tower"
+    assert records[3]['camera'] == "" and records[3]['dt'] is None
+
+
+
+def test_errors_are_recorded(records):
+    with pytest.raises(KeyError):
+        with tracing.span("save"):
+            raise KeyError("x")
+    assert records[0]['error'] == "KeyError"
+
+
+
+def test_failing_hook_is_ignored(records):
+    def broken(record): raise ValueError()
+    tracing.add_hook(broken)
+    try:
+        with tracing.span("save"):
+            pass
+    finally:
+        tracing.remove_hook(broken)
+    assert len(records) == 1
+
+
+
+def test_no_hooks_no_records():
+    s = tracing.span("save")
+    with s:
+        pass
+    assert s.start is None
+
+
+
+def test_profiler_sampling(tmp_path):
+    fname = str(tmp_path / "profile.jsonl")
+    prof = tracing.profiler(fname, sample=0.3).start()
+    times = [T0 + timedelta(seconds=10 * i) for i in range(200)]
+    try:
+        for dt in times:
+            with tracing.frame("roof", dt):
+                with tracing.span("download"):
+                    pass
+                with tracing.span("save"):
+                    pass
+    finally:
+        prof.stop()
+
+    with open(fname) as f:
+        lines = [json.loads(line) for line in f]
+    sampled = set(rec['dt'] for rec in lines)
+    # all stages of a sampled frame are recorded
+    assert len(lines) == 2 * len(sampled)
+    assert 30 < len(sampled) < 90
+    assert sampled == set(dt.isoformat() for dt in times \
+        if prof.sampled("roof", dt))
+
+    summary = tracing.summarize(fname)
+    assert summary['save']['count'] == len(sampled)
+    assert summary['download']['p50'] <= summary['download']['max']
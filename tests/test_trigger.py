@@ -0,0 +1,81 @@
+import io
+from datetime import datetime, timedelta
+
+import numpy as np
+from PIL import Image
+
+import trigger
+
+
+T0 = datetime(2016, 6, 1, 12)
+
+
+
+def probe(seed, level=128):
+    rs = np.random.RandomState(seed)
+    img = np.clip(level + rs.randint(-60, 60, (64, 64)), 0, 255)
+    buf = io.BytesIO()
+    Image.fromarray(img.astype(np.uint8)).save(buf, "JPEG")
+
+    return buf.getvalue()
+
+
+
+def test_reference_only_after_accept():
+    trig = trigger.change_trigger(threshold=6, max_age=600)
+    assert trig.check(probe(0), T0)['reason'] == "first"
+    # not stored: the next probe is still the first one
+    assert trig.check(probe(0), T0 + timedelta(seconds=10))['reason'] == \
+        "first"
+    trig.accept()
+
+    same = trig.check(probe(0), T0 + timedelta(seconds=20))
+    assert not same['capture'] and same['distance'] == 0
+
+    changed = trig.check(probe(1), T0 + timedelta(seconds=30))
+    assert changed['reason'] == "change"
+    # the changed frame was dropped, the reference is unchanged
+    assert trig.check(probe(1), T0 + timedelta(seconds=40))['capture']
+    trig.accept()
+    assert not trig.check(probe(1), T0 + timedelta(seconds=50))['capture']
+
+
+
+def test_brightness_and_max_age():
+    trig = trigger.change_trigger(threshold=64, brightness=0.05, max_age=60)
+    trig.check(probe(0), T0)
+    trig.accept()
+    assert trig.check(probe(0, 200), T0 + timedelta(seconds=10))['reason'] \
+        == "brightness"
+    assert trig.check(probe(0), T0 + timedelta(seconds=60))['reason'] == \
+        "max_age"
+
+
+
+def test_days_are_pruned():
+    trig = trigger.change_trigger()
+    for day in range(3):
+        dt = T0 + timedelta(days=day)
+        trig.record(dt, 1000, 50000)
+        trig.record(dt, 1000)
+    assert list(trig.days) == [(T0 + timedelta(days=2)).strftime("%Y%m%d")]
+    stats = trig.daily()
+    assert stats['captured'] == 1 and stats['skipped'] == 1
+    assert stats['saved_bytes'] == 50000 - 2000
+
+
+
+def test_accept_out_of_order():
+    trig = trigger.change_trigger(threshold=6)
+    t1, t2 = T0, T0 + timedelta(seconds=10)
+    trig.check(probe(0), t1)
+    trig.accept()
+    assert trig.check(probe(1), t1 + timedelta(seconds=5))['capture']
+    assert trig.check(probe(2), t2)['capture']
+
+    # the later frame is archived first, the earlier one does not replace it
+    trig.accept(t2)
+    trig.accept(t1 + timedelta(seconds=5))
+    assert trig.reference_time == t2
+    assert not trig.check(probe(2), t2 + timedelta(seconds=10))['capture']
+    assert len(trig.pending) == 0